@@ -1,69 +1,101 @@
 import argparse
-import json
 import logging
-import base64
 import os
-import requests
-import random
 
+from contextlib import nullcontext
+from functools import lru_cache
 from pathlib import Path
 from typing import Optional, List, Dict, Any
 
-try:
-    from openai import OpenAI
-except ImportError:
-    # 如果用户不使用本地模式，这个库不是必需的
-    OpenAI = None 
+from audio_util import add_dispatch_order_args, describe_durations, duration_order, line_audio_durations
+from dispatch import EndpointPool, ordered_map, parse_endpoints
+from shard_util import filter_shard_lines, parse_shard
+from jsonl_io import JsonlWriter, dumps_line, loads
+from transcript_cache import TranscriptCache, audio_content_hash
+from profiling import add_profile_args, session as profile_session, stage
+import telemetry
+
+# openai 与 tqdm 载入较慢，只在真正呼叫本地接口 / 显示进度条时才载入
+def load_openai():
+    try:
+        from openai import OpenAI
+    except ImportError:
+        # 如果用户不使用本地模式，这个库不是必需的
+        raise ImportError("OpenAI module is needed on calling local api: pip install openai") from None
+    return OpenAI
 
 # 使用 tqdm 显示进度条
-try:
-    from tqdm import tqdm
-except ImportError:
-    def tqdm(iterable, **kwargs):
+def tqdm(iterable, **kwargs):
+    try:
+        from tqdm import tqdm as _tqdm
+    except ImportError:
         print("tqdm is not installed, progress bar will not be shown. "
               "Install it with: pip install tqdm")
         return iterable
+    return _tqdm(iterable, **kwargs)
 
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+@lru_cache(maxsize=None)
+def get_openai_client(api_base: str):
+    """每个端点只建立一次 client，复用其连接池。"""
+    return load_openai()(base_url=api_base, api_key="no-need")
+
 def call_local_api(
     api_base: str,
     model_name: str,
     audio_path: Path,
-    temperature: float
+    temperature: float,
+    endpoint_pool: Optional[EndpointPool] = None,
+    language: str = "zh",
+    transcript_cache: Optional[TranscriptCache] = None,
 ) -> Optional[str]:
     """
     Use OpenAI-compatible local API to transcribe audio file.
+    When `endpoint_pool` is given, the request goes to the endpoint it picks
+    and `api_base` is ignored. When `transcript_cache` is given, audio whose
+    content was already transcribed with the same settings is not sent again.
     """
     
     # 1) Load OpenAI module
-    if OpenAI is None:
-        raise ImportError("OpenAI module is needed on calling local api: pip install openai")
-
-    client = OpenAI(base_url=api_base, api_key="no-need")
+    load_openai()
 
     # 2) Get audio data
     try:
-        with open(audio_path, "rb") as audio_file:
+        with stage("read_audio"), open(audio_path, "rb") as audio_file:
             audio_data = audio_file.read()
     except Exception as e:
         logging.error(f"Error reading audio file {audio_path}: {e}")
         return None
 
+    cache_key = None
+    if transcript_cache is not None:
+        with stage("cache_lookup"):
+            cache_key = TranscriptCache.make_key(audio_content_hash(audio_data), model_name, temperature, language)
+            cached = transcript_cache.get(cache_key)
+        if cached is not None:
+            telemetry.count("cache_hits")
+            return cached
+
     # 3) Call local API
+    lease = endpoint_pool.lease() if endpoint_pool is not None else nullcontext(api_base)
     try:
-        resp = client.audio.transcriptions.create(
-            model=model_name,
-            file=(audio_path.name, audio_data),
-            response_format="json",
-            temperature=temperature,
-            language="zh",
-        )
-
-        return resp.text.strip()
+        with lease as base_url, stage("request"), telemetry.request():
+            resp = get_openai_client(base_url).audio.transcriptions.create(
+                model=model_name,
+                file=(audio_path.name, audio_data),
+                response_format="json",
+                temperature=temperature,
+                language=language,
+            )
+
+        text = resp.text.strip()
+        if transcript_cache is not None:
+            transcript_cache.put(cache_key, text)
+        return text
     except Exception as e:
         logging.error(f"Error calling local API for {audio_path}: {e}")
         return None
@@ -92,8 +124,21 @@ def setup_arg_parser() -> argparse.ArgumentParser:
     parser.add_argument(
         "--api-base",
         type=str,
-        default="http://0.0.0.0:12355/v1",
-        help="本地LLM服务的API基地址 (仅当 --provider='local' 时使用)"
+        nargs="+",
+        default=["http://0.0.0.0:12355/v1"],
+        help="本地LLM服务的API基地址 (仅当 --provider='local' 时使用)。可传入多个 (空格或逗号分隔) 进行负载平衡"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=None,
+        help="同时在途的请求数，预设为端点数量 (单端点时与原本的逐条处理相同)"
+    )
+    parser.add_argument(
+        "--max-endpoint-failures",
+        type=int,
+        default=3,
+        help="端点连续失败多少次后暂时移除，待健康检查恢复后重新加入"
     )
     parser.add_argument(
         "--api-key",
@@ -110,6 +155,22 @@ def setup_arg_parser() -> argparse.ArgumentParser:
     parser.add_argument(
         "--temperature", type=float, default=0.0, help="生成文本的温度。"
     )
+    parser.add_argument(
+        "--language", type=str, default="zh", help="转写语言 (传给 ASR 服务，也是缓存 key 的一部分)"
+    )
+    parser.add_argument(
+        "--transcript-cache",
+        type=str,
+        default=None,
+        help="ASR 转写缓存文件 (SQLite)。以音频内容哈希 + 模型 + temperature + language 为 key，重跑时命中的音频不再调用 ASR"
+    )
+    parser.add_argument(
+        "--shard", type=parse_shard, default=None,
+        help="只处理第 i 个分片 (格式 i/N，依 id 的稳定哈希划分)，之后用 shard_util.py merge 合并"
+    )
+    add_dispatch_order_args(parser)
+    add_profile_args(parser)
+    telemetry.add_metrics_args(parser)
 
     return parser
 
@@ -124,47 +185,82 @@ def process_file(args: argparse.Namespace):
     except Exception as e:
         logging.error(f"Failed to read input file: {e}")
         return
+    lines = filter_shard_lines(lines, args.shard)
 
-    with open(output_path, 'w', encoding='utf-8') as out_f:
-        for line in tqdm(lines, desc="Processing lines"):
-            try:
-                data = json.loads(line)
-                item_id = data.get("id")
-                
-                if not item_id:
-                    logging.warning("Missing 'id' in data, skipping line.")
-                    continue
-                
-                audio_path = audio_dir / f"id_{item_id}.wav"
-                if not audio_path.exists():
-                    logging.warning(f"Audio file not found: {audio_path}, skipping line.")
-                    continue
-
-                text = call_local_api(
-                    api_base=args.api_base,
-                    model_name=args.model_name,
-                    audio_path=audio_path,
-                    temperature=args.temperature,
-                )
-
-                if text is None:
-                    logging.warning(f"Failed to transcribe audio for id {item_id}, skipping line.")
-                    continue
-
-                data['query'] = text
-
-                out_f.write(json.dumps(data, ensure_ascii=False) + '\n')
+    endpoint_pool = EndpointPool(parse_endpoints(args.api_base), max_failures=args.max_endpoint_failures)
+    endpoint_pool.start_health_checks()
+    concurrency = args.concurrency or len(endpoint_pool)
+    transcript_cache = TranscriptCache(args.transcript_cache) if args.transcript_cache else None
+
+    def process_line(line: str) -> Optional[Dict[str, Any]]:
+        try:
+            data = loads(line)
+            item_id = data.get("id")
             
-            except Exception as e:
-                logging.error(f"Error processing line: {e}")
-                continue
-    
+            if not item_id:
+                logging.warning("Missing 'id' in data, skipping line.")
+                return None
+            
+            audio_path = audio_dir / f"id_{item_id}.wav"
+            if not audio_path.exists():
+                logging.warning(f"Audio file not found: {audio_path}, skipping line.")
+                return None
+
+            text = call_local_api(
+                api_base=args.api_base[0],
+                model_name=args.model_name,
+                audio_path=audio_path,
+                temperature=args.temperature,
+                endpoint_pool=endpoint_pool,
+                language=args.language,
+                transcript_cache=transcript_cache,
+            )
+
+            if text is None:
+                logging.warning(f"Failed to transcribe audio for id {item_id}, skipping line.")
+                return None
+
+            data['query'] = text
+            return data
+        
+        except Exception as e:
+            logging.error(f"Error processing line: {e}")
+            return None
+
+    # 依音频时长安排送出顺序 (输出仍依输入顺序)
+    dispatch_order = None
+    if args.dispatch_order != "input":
+        durations = line_audio_durations(lines, audio_dir)
+        dispatch_order = duration_order(durations, args.dispatch_order, args.duration_bucket)
+        logging.info(f"Dispatch order {args.dispatch_order}: {describe_durations(durations)}")
+
+    # 例外或 Ctrl-C 中断时也要关闭缓存 (提交尚未写入的转写)，已付费的 ASR 结果不会遗失
+    try:
+        with JsonlWriter(output_path, flush_interval=1.0) as out_f:
+            # 並行送出請求，但依輸入順序寫出
+            results_iter = ordered_map(process_line, lines, concurrency=concurrency, order=dispatch_order)
+            for data in tqdm(results_iter, total=len(lines), desc="Processing lines"):
+                telemetry.item_done("ok" if data is not None else "skipped")
+                if data is not None:
+                    with stage("serialize"):
+                        record = dumps_line(data)
+                    with stage("write_output"):
+                        out_f.write_raw(record)
+    finally:
+        endpoint_pool.close()
+        if transcript_cache is not None:
+            logging.info(f"Transcript cache: {transcript_cache.summary()}")
+            transcript_cache.close()
+
+    if len(endpoint_pool) > 1:
+        logging.info(f"Endpoint stats: {endpoint_pool.summary()}")
     logging.info(f"Processing complete. Output written to {output_path}")
 
 def main():
     parser = setup_arg_parser()
     args = parser.parse_args()
-    process_file(args)
+    with profile_session(args), telemetry.session(args, "asr_icl"):
+        process_file(args)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,109 @@
+import logging
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional
+
+# --- 音频工具 ---
+# 只读取 WAV (RIFF) header，不解码音频内容
+
+
+def wav_duration_seconds(audio_path: Path) -> Optional[float]:
+    """
+    由 RIFF header 的 byte rate 与 data chunk 大小计算时长 (秒)；无法解析时返回 None。
+    与 wave 模块不同，也支持 float / extensible 等非 PCM 格式。
+    """
+    try:
+        with open(audio_path, "rb") as f:
+            riff, _, wave_tag = struct.unpack("<4sI4s", f.read(12))
+            if riff != b"RIFF" or wave_tag != b"WAVE":
+                return None
+            byte_rate = None
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    return None
+                chunk_id, chunk_size = struct.unpack("<4sI", header)
+                if chunk_id == b"fmt ":
+                    fmt = f.read(chunk_size)
+                    byte_rate = struct.unpack_from("<I", fmt, 8)[0]
+                    if chunk_size % 2:
+                        f.seek(1, 1)
+                elif chunk_id == b"data":
+                    if not byte_rate:
+                        return None
+                    # 串流写入的 WAV 可能把 data 大小记为 0xFFFFFFFF，改用文件大小估算
+                    if chunk_size == 0xFFFFFFFF:
+                        chunk_size = Path(audio_path).stat().st_size - f.tell()
+                    return chunk_size / byte_rate
+                else:
+                    f.seek(chunk_size + (chunk_size % 2), 1)
+    except (OSError, struct.error) as e:
+        logging.debug(f"无法读取 WAV header {audio_path}: {e}")
+        return None
+
+
+# --- 依音频时长排序送出 ---
+# 并发执行时，若长音频排在档案后段才送出，整批结束时间会被最后那一个请求拖长。
+# 依 header 读到的时长重新安排送出顺序 (输出仍依输入顺序写出)。
+
+DISPATCH_ORDERS = ["input", "longest-first", "bucketed"]
+
+
+def add_dispatch_order_args(parser):
+    parser.add_argument(
+        "--dispatch-order", type=str, default="input", choices=DISPATCH_ORDERS,
+        help="请求送出顺序 (只读 WAV header 取得时长，输出仍依输入顺序写出)：input 依档案顺序；"
+             "longest-first 由长到短，最长的请求最先开始，缩短整批的结束时间；"
+             "bucketed 依 --duration-bucket 秒分桶、由长的桶开始，桶内依档案顺序，同一批送出的音频长度相近。"
+             "非 input 时结果会在全部较早的项目完成后才写出"
+    )
+    parser.add_argument(
+        "--duration-bucket", type=float, default=2.0,
+        help="--dispatch-order bucketed 的桶宽 (秒)"
+    )
+
+
+def line_audio_durations(lines: List[str], audio_dir: Path, workers: int = 8) -> List[Optional[float]]:
+    """
+    每一行 (JSONL，含 id) 对应的 id_<id>.wav 时长；缺 id、缺档或无法解析时为 None。
+    header 读取以少量执行绪并行 (网路档案系统上每次开档的延迟较明显)。
+    """
+    from jsonl_io import JSONDecodeError, loads
+
+    def duration(line: str) -> Optional[float]:
+        try:
+            item_id = loads(line).get("id")
+        except (JSONDecodeError, AttributeError):
+            return None
+        return wav_duration_seconds(Path(audio_dir) / f"id_{item_id}.wav") if item_id else None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(duration, lines, chunksize=64))
+
+
+def duration_order(durations: List[Optional[float]], policy: str = "longest-first",
+                   bucket_seconds: float = 2.0) -> Optional[List[int]]:
+    """
+    依时长决定送出顺序 (输入索引的排列)；policy 为 input 时回传 None。
+    读不到时长的项目以已知时长的中位数代替。排序是稳定的，时长相同 (或同一桶) 的项目维持档案顺序。
+    """
+    if policy == "input":
+        return None
+    if policy not in DISPATCH_ORDERS:
+        raise ValueError(f"Unknown dispatch order: {policy}")
+    known = sorted(d for d in durations if d is not None)
+    fill = known[len(known) // 2] if known else 0.0
+    seconds = [fill if d is None else d for d in durations]
+    if policy == "bucketed":
+        width = max(bucket_seconds, 1e-3)
+        return sorted(range(len(seconds)), key=lambda i: -int(seconds[i] // width))
+    return sorted(range(len(seconds)), key=lambda i: -seconds[i])
+
+
+def describe_durations(durations: List[Optional[float]]) -> str:
+    known = sorted(d for d in durations if d is not None)
+    if not known:
+        return f"{len(durations)} 条, 皆无法读取时长"
+    return (f"{len(durations)} 条, 共 {sum(known):.1f}s 音频, 中位数 {known[len(known) // 2]:.2f}s, "
+            f"最长 {known[-1]:.2f}s, 无法读取 {len(durations) - len(known)} 条")
@@ -0,0 +1,300 @@
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from statistics import median
+from typing import Any, Callable, Dict, List, Optional
+
+from synth_data import RecordGenerator, to_model_output, to_raw_semantics, write_dataset
+
+# --- 效能基准 ---
+# micro: 对热点函数 (正规化、格式转换、JSON 抽取、评分) 在合成资料上计时，另以 tracemalloc 量测峰值记忆体；
+# e2e: 以子行程执行各脚本，记录 wall time 与最大 RSS。结果写成 JSON，可用 --compare 与基准档比较。
+
+ROOT = Path(__file__).resolve().parent
+
+
+class MicroBenchmark:
+    """
+    A function under test plus the synthetic inputs it runs over.
+
+    ``prepare(n)`` builds the inputs once (not timed). ``run(data)`` is the
+    timed body. ``reset()`` is called before every repeat, e.g. to clear
+    caches that would otherwise make later repeats unrealistically fast.
+    """
+
+    def __init__(self, name: str, prepare: Callable[[int], Any], run: Callable[[Any], Any],
+                 reset: Optional[Callable[[], None]] = None):
+        self.name = name
+        self.prepare = prepare
+        self.run = run
+        self.reset = reset
+
+
+def _records(n: int, seed: int = 0) -> List[Dict[str, Any]]:
+    return list(RecordGenerator(seed).records(n))
+
+
+def _normalize_text_bench() -> MicroBenchmark:
+    from metrics import _normalize_str, normalize_text
+
+    def prepare(n):
+        return [r["query"] for r in _records(n)]
+
+    def run(queries):
+        for q in queries:
+            normalize_text(q)
+
+    return MicroBenchmark("normalize_text", prepare, run, reset=_normalize_str.cache_clear)
+
+
+def _normalize_semantics_bench() -> MicroBenchmark:
+    from metrics import _normalize_str, normalize_semantics
+
+    def prepare(n):
+        return [r["semantics"] for r in _records(n)]
+
+    def run(frame_lists):
+        for frames in frame_lists:
+            normalize_semantics(frames)
+
+    return MicroBenchmark("normalize_semantics", prepare, run, reset=_normalize_str.cache_clear)
+
+
+def _transform_bench() -> MicroBenchmark:
+    from slu_icl import transform_semantics_to_standard
+
+    def prepare(n):
+        return [to_raw_semantics(r["semantics"]) for r in _records(n)]
+
+    def run(raw_list):
+        for raw in raw_list:
+            transform_semantics_to_standard(raw)
+
+    return MicroBenchmark("transform_semantics_to_standard", prepare, run)
+
+
+def _extract_json_bench() -> MicroBenchmark:
+    from slu_icl import extract_json_string
+
+    def prepare(n):
+        rng = random.Random(0)
+        return [to_model_output(r["semantics"], rng) for r in _records(n)]
+
+    def run(outputs):
+        for text in outputs:
+            extract_json_string(text)
+
+    return MicroBenchmark("extract_json_string", prepare, run)
+
+
+def _calculate_metrics_bench(tmp_dir: str) -> MicroBenchmark:
+    from metrics import _normalize_str, calculate_metrics
+
+    def prepare(n):
+        paths = write_dataset(os.path.join(tmp_dir, f"metrics_{n}"), n)
+        return paths["predictions"], paths["labels"]
+
+    def run(paths):
+        calculate_metrics(*paths)
+
+    return MicroBenchmark("calculate_metrics", prepare, run, reset=_normalize_str.cache_clear)
+
+
+def micro_benchmarks(tmp_dir: str) -> List[MicroBenchmark]:
+    return [
+        _normalize_text_bench(),
+        _normalize_semantics_bench(),
+        _transform_bench(),
+        _extract_json_bench(),
+        _calculate_metrics_bench(tmp_dir),
+    ]
+
+
+def run_micro(bench: MicroBenchmark, n: int, repeat: int) -> Dict[str, Any]:
+    """
+    计时 repeat 次 (回报最小值与中位数)，再以 tracemalloc 额外跑一次量测峰值记忆体。
+    tracemalloc 会拖慢执行，所以不与计时混在同一次。
+    """
+    data = bench.prepare(n)
+    timings = []
+    for _ in range(repeat):
+        if bench.reset is not None:
+            bench.reset()
+        gc.collect()
+        start = time.perf_counter()
+        bench.run(data)
+        timings.append(time.perf_counter() - start)
+
+    if bench.reset is not None:
+        bench.reset()
+    gc.collect()
+    tracemalloc.start()
+    bench.run(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    best = min(timings)
+    return {
+        "n": n,
+        "seconds_min": round(best, 6),
+        "seconds_median": round(median(timings), 6),
+        "per_item_us": round(best / n * 1e6, 4),
+        "peak_alloc_bytes": peak,
+    }
+
+
+# 子行程以 runpy 执行脚本，结束时由脚本自己的行程回报峰值 RSS。os.wait4 的 ru_maxrss 会把 exec 之前
+# fork 出的 benchmark 父行程副本 (含已产生的资料) 也算进去，量到的是测试框架而不是脚本。
+PEAK_RSS_MARKER = "__benchmark_peak_rss__"
+_PEAK_RSS_PROBE = f"""
+import atexit, runpy, sys
+
+def _report():
+    try:
+        with open("/proc/self/status") as f:
+            peak = next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmHWM:"))
+    except (OSError, StopIteration):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = peak if sys.platform == "darwin" else peak * 1024
+    sys.stderr.write("\\n{PEAK_RSS_MARKER} %d\\n" % peak)
+    sys.stderr.flush()
+
+atexit.register(_report)
+sys.argv = sys.argv[1:]
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+
+def run_script(args: List[str]) -> Dict[str, Any]:
+    """
+    在子行程执行 `python <args>`，回传 wall time 与脚本本身的峰值 RSS (Linux 为 VmHWM)。
+    """
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-c", _PEAK_RSS_PROBE] + args,
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+    )
+    elapsed = time.perf_counter() - start
+    stderr = proc.stderr.decode(errors="replace")
+    if proc.returncode != 0:
+        raise RuntimeError(f"{' '.join(args)} exited with {proc.returncode}: {stderr[-500:]}")
+    max_rss = None
+    for line in reversed(stderr.splitlines()):
+        if line.startswith(PEAK_RSS_MARKER):
+            max_rss = int(line.split()[1])
+            break
+    return {"seconds": round(elapsed, 6), "max_rss_bytes": max_rss}
+
+
+def e2e_commands(paths: Dict[str, str], work_dir: str) -> Dict[str, List[str]]:
+    return {
+        "metrics": ["metrics.py", paths["predictions"], paths["labels"]],
+        "metrics_sorted_join": ["metrics.py", paths["predictions"], paths["labels"], "--join", "sorted"],
+        "fast_path": ["fast_path.py", "--train-input-file", paths["train"],
+                      "--output-file", os.path.join(work_dir, "fast_path.json"), "--eval-file", paths["labels"]],
+        "data_util": ["data_util.py", "--input-file", paths["train"],
+                      "--output-file", os.path.join(work_dir, "sft.jsonl")],
+        "shard_merge": ["shard_util.py", "merge", paths["predictions"],
+                        "--output-file", os.path.join(work_dir, "merged.jsonl"), "--reference-file", paths["labels"]],
+    }
+
+
+def compare_results(current: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """
+    比较两份结果中同名的项目 (时间取 seconds_min / seconds)，回传变慢超过 threshold 倍的项目。
+    """
+    regressions = []
+    for key, entry in sorted(current["results"].items()):
+        base = baseline.get("results", {}).get(key)
+        if base is None:
+            continue
+        field = "seconds_min" if "seconds_min" in entry else "seconds"
+        ratio = entry[field] / base[field] if base[field] > 0 else float("inf")
+        flag = "REGRESSION" if ratio > threshold else ""
+        print(f"{key:<60} {base[field]:10.4f}s -> {entry[field]:10.4f}s  x{ratio:5.2f} {flag}")
+        if flag:
+            regressions.append(key)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro and end-to-end benchmarks on synthetic MAC-SLU data")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="Record counts for the micro benchmarks (inputs are held in memory)")
+    parser.add_argument("--e2e-sizes", type=int, nargs="*", default=[100000],
+                        help="Record counts for the end-to-end script runs (files are streamed; up to 10^7)")
+    parser.add_argument("--only", type=str, nargs="+", default=None,
+                        help="Run only benchmarks whose name contains one of these strings")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--work-dir", type=str, default=None,
+                        help="Directory for generated data (default: a temporary directory)")
+    parser.add_argument("--output-json", type=str, default=None, help="Write results to this JSON file")
+    parser.add_argument("--compare", type=str, default=None, help="Baseline JSON from an earlier --output-json")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="With --compare, exit with code 1 if any time exceeds baseline x threshold")
+    args = parser.parse_args()
+
+    def selected(name):
+        return args.only is None or any(s in name for s in args.only)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = args.work_dir or tmp_dir
+        for bench in micro_benchmarks(work_dir):
+            for n in args.sizes:
+                key = f"micro/{bench.name}/n={n}"
+                if not selected(key):
+                    continue
+                results[key] = run_micro(bench, n, args.repeat)
+                logging.info(f"{key}: {results[key]}")
+
+        for n in args.e2e_sizes:
+            data_dir = os.path.join(work_dir, f"e2e_{n}")
+            paths = {name: os.path.join(data_dir, f"{name}.jsonl") for name in ["labels", "predictions", "train"]}
+            commands = {name: cmd for name, cmd in e2e_commands(paths, data_dir).items()
+                        if selected(f"e2e/{name}/n={n}")}
+            if not commands:
+                continue
+            if not all(os.path.exists(p) for p in paths.values()):
+                write_dataset(data_dir, n)
+            for name, command in commands.items():
+                key = f"e2e/{name}/n={n}"
+                results[key] = run_script(command)
+                logging.info(f"{key}: {results[key]}")
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+    if args.output_json:
+        with open(args.output_json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        logging.info(f"Results written to {args.output_json}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare_results(report, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) slower than {args.threshold}x baseline", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
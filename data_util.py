@@ -1,13 +1,22 @@
 import argparse
 import json
 import logging
+from array import array
+from bisect import bisect_left, insort
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator, Optional, Tuple
 
-try:
-    from tqdm import tqdm
-except ImportError:
-    def tqdm(iterable, **kwargs): return iterable
+from jsonl_io import JsonlWriter, iter_lines, loads
+from shard_util import Shard, in_shard, parse_shard
+from profiling import add_profile_args, session as profile_session
+
+def tqdm(iterable, **kwargs):
+    # 只在真正轉換時才載入 tqdm
+    try:
+        from tqdm import tqdm as _tqdm
+    except ImportError:
+        return iterable
+    return _tqdm(iterable, **kwargs)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -58,46 +67,336 @@ def transform_semantics_to_standard(raw_semantics: Dict[str, Any]) -> List[Dict[
             standard_list.append(new_frame)
     return standard_list
 
-def process_file(input_path: str, output_path: str = None):
-    input_file = Path(input_path)
-    output_file = Path(output_path) if output_path else input_file.with_name(f"{input_file.stem}_sft_ready.jsonl")
-
-    if not input_file.exists():
-        logging.error(f"找不到檔案: {input_file}")
-        return
-
-    logging.info(f"開始轉換: {input_file}")
-
-    with open(input_file, 'r', encoding='utf-8') as f_in, \
-         open(output_file, 'w', encoding='utf-8') as f_out:
-        
-        for line in tqdm(f_in, desc="SFT 格式化中"):
+def iter_payloads(input_file: Path, shard: Optional[Shard] = None) -> Iterator[Dict[str, str]]:
+    """逐行讀取原始資料並轉成 Llama-Factory 指令微調格式 (instruction / input / output)。"""
+    with open(input_file, 'rb') as f_in:
+        for line in tqdm(iter_lines(f_in), desc="SFT 格式化中"):
             try:
-                data = json.loads(line)
+                data = loads(line)
+                if not in_shard(data.get("id"), shard):
+                    continue
                 query = data.get("query", "")
                 raw_semantics = data.get("semantics", {})
                 
                 # 執行語義重組
                 standard_list = transform_semantics_to_standard(raw_semantics)
                 
-                # 封裝為 Llama-Factory 指令微調格式
-                payload = {
+                # 封裝為 Llama-Factory 指令微調格式 (output 維持與提示詞相同的標準庫 JSON 格式)
+                yield {
                     "instruction": SFT_SYSTEM_PROMPT.strip(),
                     "input": query,
                     "output": json.dumps(standard_list, ensure_ascii=False)
                 }
                 
-                f_out.write(json.dumps(payload, ensure_ascii=False) + "\n")
-                
             except Exception as e:
                 logging.warning(f"跳過錯誤行: {e}")
                 continue
 
+
+# --- 依 token 長度分桶 / 打包 ---
+# 以本地 tokenizer 離線計算每筆樣本的長度，輸出長度統計；可選擇依長度寫成多個分桶檔，
+# 或預先打包成不超過 context 長度的序列 (附邊界資訊)，減少訓練時的 padding。
+
+class TokenCounter:
+    """
+    Token lengths of SFT records from a local tokenizer.
+
+    `path` is a ``tokenizer.json`` file, or a model directory containing
+    one (read with the ``tokenizers`` library); directories without it are
+    loaded with ``transformers.AutoTokenizer`` offline. The instruction is
+    the same system prompt for every record, so it is tokenized once.
+    `template_tokens` adds the tokens the chat template wraps around each
+    example (role markers, BOS/EOS), which depend on the model's template.
+    """
+
+    def __init__(self, path: str, template_tokens: int = 0):
+        self.path = path
+        self.template_tokens = template_tokens
+        self._encode_batch = self._load(Path(path))
+        self._instruction_tokens: Dict[str, int] = {}
+
+    @staticmethod
+    def _load(path: Path):
+        tokenizer_file = path / "tokenizer.json" if path.is_dir() else path
+        if tokenizer_file.is_file():
+            try:
+                from tokenizers import Tokenizer
+            except ImportError:
+                raise ImportError("Counting tokens from tokenizer.json needs the tokenizers library: pip install tokenizers") from None
+            tokenizer = Tokenizer.from_file(str(tokenizer_file))
+            return lambda texts: [len(e.ids) for e in tokenizer.encode_batch(texts, add_special_tokens=False)]
+        if not path.is_dir():
+            raise FileNotFoundError(f"Tokenizer not found: {path}")
+        try:
+            from transformers import AutoTokenizer
+        except ImportError:
+            raise ImportError(f"{path} has no tokenizer.json; loading it needs transformers: pip install transformers") from None
+        tokenizer = AutoTokenizer.from_pretrained(str(path), local_files_only=True)
+        return lambda texts: [len(ids) for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]]
+
+    def count(self, payloads: List[Dict[str, str]]) -> List[int]:
+        texts = []
+        for payload in payloads:
+            texts.append(payload["input"])
+            texts.append(payload["output"])
+        counts = self._encode_batch(texts) if texts else []
+        lengths = []
+        for i, payload in enumerate(payloads):
+            instruction = payload["instruction"]
+            if instruction not in self._instruction_tokens:
+                self._instruction_tokens[instruction] = self._encode_batch([instruction])[0]
+            lengths.append(self._instruction_tokens[instruction] + counts[2 * i] + counts[2 * i + 1] + self.template_tokens)
+        return lengths
+
+
+def _batches(payloads: Iterator[Dict[str, str]], size: int) -> Iterator[List[Dict[str, str]]]:
+    batch = []
+    for payload in payloads:
+        batch.append(payload)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def padding_waste(lengths: List[int], batch_size: int) -> float:
+    """依序每 batch_size 筆為一批、補齊到批內最長時，padding 佔總 token 數的比例。"""
+    padded = sum(max(lengths[i:i + batch_size]) * len(lengths[i:i + batch_size]) for i in range(0, len(lengths), batch_size))
+    return 1 - sum(lengths) / padded if padded else 0.0
+
+
+def length_stats(lengths: List[int], batch_sizes: List[int], boundaries: Optional[List[int]] = None) -> Dict[str, Any]:
+    """
+    長度分佈 (分位數、各分桶筆數)，以及在輸入順序與依長度排序 (理想分桶) 下的 padding 比例。
+    """
+    ordered = sorted(lengths)
+    n = len(ordered)
+    stats: Dict[str, Any] = {"count": n}
+    if not n:
+        return stats
+    stats.update({
+        "total_tokens": sum(ordered),
+        "min": ordered[0],
+        "max": ordered[-1],
+        "mean": round(sum(ordered) / n, 2),
+        "percentiles": {f"p{q}": ordered[min(n - 1, (q * n + 99) // 100 - 1)] for q in (50, 90, 95, 99)},
+        "padding_waste": {
+            str(b): {"input_order": round(padding_waste(lengths, b), 4), "length_sorted": round(padding_waste(ordered, b), 4)}
+            for b in batch_sizes
+        },
+    })
+    if boundaries:
+        names = bucket_names(boundaries)
+        stats["buckets"] = {name: 0 for name in names}
+        for length in ordered:
+            stats["buckets"][names[bucket_index(boundaries, length)]] += 1
+    return stats
+
+
+def bucket_names(boundaries: List[int]) -> List[str]:
+    edges = [0] + boundaries
+    return [f"len{lo + 1 if lo else 0}-{hi}" for lo, hi in zip(edges, boundaries)] + [f"len{boundaries[-1] + 1}-inf"]
+
+
+def bucket_index(boundaries: List[int], length: int) -> int:
+    """第一個上界 >= length 的分桶；超過最大上界的放在最後一個 (overflow) 分桶。"""
+    for i, hi in enumerate(boundaries):
+        if length <= hi:
+            return i
+    return len(boundaries)
+
+
+def pack_sequences(lengths: List[int], context_length: int) -> List[List[int]]:
+    """
+    Best-fit decreasing：由長到短，每筆放進剩餘空間最小但放得下的序列，放不下時開新序列。
+    回傳各序列包含的樣本索引；超過 context_length 的樣本單獨成一個序列。
+    剩餘空間只有 context_length 種取值，以「剩餘空間 -> 序列」的表加上排序好的剩餘空間列表 (bisect) 查找。
+    """
+    packs: List[List[int]] = []
+    by_remaining: Dict[int, List[int]] = {}
+    capacities: List[int] = []
+    for idx in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        length = lengths[idx]
+        if length >= context_length:
+            packs.append([idx])
+            continue
+        pos = bisect_left(capacities, length)
+        if pos < len(capacities):
+            remaining = capacities[pos]
+            target = by_remaining[remaining].pop()
+            if not by_remaining[remaining]:
+                del capacities[pos]
+        else:
+            target = len(packs)
+            packs.append([])
+            remaining = context_length
+        packs[target].append(idx)
+        remaining -= length
+        if remaining > 0:
+            bins = by_remaining.setdefault(remaining, [])
+            if not bins:
+                insort(capacities, remaining)
+            bins.append(target)
+    return packs
+
+
+def write_length_aware(
+    payloads: Iterator[Dict[str, str]],
+    output_file: Path,
+    counter: TokenCounter,
+    boundaries: Optional[List[int]] = None,
+    pack_to: Optional[int] = None,
+    stats_file: Optional[Path] = None,
+    batch_sizes: Tuple[int, ...] = (8, 16, 32),
+    tokenize_batch: int = 1024,
+) -> Dict[str, Any]:
+    """
+    計算每筆樣本的 token 長度並寫出：
+    - boundaries：依長度寫入 <stem>.len<lo>-<hi>.jsonl 各分桶檔 (串流，記憶體固定)；
+    - pack_to：以 pack_sequences 打包後依序列順序寫入 output_file，並在 <stem>.packs.jsonl
+      記錄每個序列的行範圍、各樣本長度與 cu_seqlens (樣本邊界的累計 token 位置)；
+    - 皆未指定時維持輸入順序寫入 output_file。
+    長度統計寫入 stats_file。
+    """
+    lengths = array('l')
+    kept_payloads = []
+    writers: Dict[int, JsonlWriter] = {}
+    names = bucket_names(boundaries) if boundaries else []
+    out = JsonlWriter(output_file) if pack_to is None and not boundaries else None
+    try:
+        for batch in _batches(payloads, tokenize_batch):
+            batch_lengths = counter.count(batch)
+            lengths.extend(batch_lengths)
+            if pack_to is not None:
+                kept_payloads.extend(batch)
+                continue
+            for payload, length in zip(batch, batch_lengths):
+                if boundaries:
+                    i = bucket_index(boundaries, length)
+                    if i not in writers:
+                        writers[i] = JsonlWriter(output_file.with_name(f"{output_file.stem}.{names[i]}{output_file.suffix}"))
+                    writers[i].write(payload)
+                else:
+                    out.write(payload)
+    finally:
+        for writer in writers.values():
+            writer.close()
+        if out is not None:
+            out.close()
+
+    lengths = list(lengths)
+    stats = length_stats(lengths, list(batch_sizes), boundaries)
+    if boundaries:
+        logging.info("分桶檔: " + ", ".join(
+            f"{output_file.stem}.{names[i]}{output_file.suffix} ({stats['buckets'][names[i]]})" for i in sorted(writers)
+        ))
+
+    if pack_to is not None:
+        packs = pack_sequences(lengths, pack_to)
+        manifest_file = output_file.with_name(f"{output_file.stem}.packs.jsonl")
+        line = 0
+        with JsonlWriter(output_file) as out, JsonlWriter(manifest_file) as manifest:
+            for pack_id, members in enumerate(packs):
+                pack_lengths = [lengths[idx] for idx in members]
+                cu_seqlens = [0]
+                for idx, length in zip(members, pack_lengths):
+                    out.write(kept_payloads[idx])
+                    cu_seqlens.append(cu_seqlens[-1] + length)
+                manifest.write({
+                    "pack": pack_id,
+                    "lines": [line, line + len(members)],
+                    "lengths": pack_lengths,
+                    "cu_seqlens": cu_seqlens,
+                    "tokens": cu_seqlens[-1],
+                    "padding": max(0, pack_to - cu_seqlens[-1]),
+                    "overflow": cu_seqlens[-1] > pack_to,
+                })
+                line += len(members)
+        stats["packing"] = {
+            "context_length": pack_to,
+            "sequences": len(packs),
+            "fill_rate": round(sum(lengths) / (len(packs) * pack_to), 4) if packs else 0.0,
+            "overflow_records": sum(1 for length in lengths if length > pack_to),
+        }
+        logging.info(f"打包: {len(lengths)} 筆 -> {len(packs)} 個序列 (填充率 {stats['packing']['fill_rate']:.1%})，邊界資訊: {manifest_file}")
+
+    if stats_file is not None:
+        with open(stats_file, 'w', encoding='utf-8') as f:
+            json.dump(stats, f, ensure_ascii=False, indent=2)
+    if lengths:
+        waste = ", ".join(f"batch {b}: {v['input_order']:.1%} -> {v['length_sorted']:.1%}" for b, v in stats["padding_waste"].items())
+        logging.info(
+            f"長度統計: {stats['count']} 筆, 平均 {stats['mean']}, p50 {stats['percentiles']['p50']}, "
+            f"p99 {stats['percentiles']['p99']}, 最長 {stats['max']}; padding 比例 (輸入順序 -> 依長度) {waste}"
+        )
+    return stats
+
+
+def process_file(input_path: str, output_path: str = None, shard: Optional[Shard] = None,
+                 tokenizer: Optional[str] = None, template_tokens: int = 0,
+                 bucket_boundaries: Optional[List[int]] = None, pack_to: Optional[int] = None,
+                 stats_path: Optional[str] = None):
+    input_file = Path(input_path)
+    if output_path:
+        output_file = Path(output_path)
+    elif shard is not None:
+        output_file = input_file.with_name(f"{input_file.stem}_sft_ready.shard{shard[0]}of{shard[1]}.jsonl")
+    else:
+        output_file = input_file.with_name(f"{input_file.stem}_sft_ready.jsonl")
+
+    if not input_file.exists():
+        logging.error(f"找不到檔案: {input_file}")
+        return
+
+    logging.info(f"開始轉換: {input_file}")
+
+    if tokenizer is None:
+        with JsonlWriter(output_file) as f_out:
+            for payload in iter_payloads(input_file, shard):
+                f_out.write(payload)
+    else:
+        try:
+            counter = TokenCounter(tokenizer, template_tokens)
+        except (FileNotFoundError, ImportError) as e:
+            logging.error(f"無法載入 tokenizer: {e}")
+            return
+        stats_file = Path(stats_path) if stats_path else output_file.with_name(f"{output_file.stem}.lengths.json")
+        write_length_aware(
+            iter_payloads(input_file, shard), output_file, counter,
+            boundaries=sorted(bucket_boundaries) if bucket_boundaries else None,
+            pack_to=pack_to, stats_file=stats_file,
+        )
+        logging.info(f"長度統計已儲存於: {stats_file}")
+
     logging.info(f"轉換完成！檔案儲存於: {output_file}")
 
-if __name__ == "__main__":
+def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--input-file", type=str, required=True)
     parser.add_argument("--output-file", type=str)
+    parser.add_argument("--shard", type=parse_shard, default=None,
+                        help="只處理第 i 個分片 (格式 i/N，依 id 的穩定雜湊劃分)")
+    parser.add_argument("--tokenizer", type=str, default=None,
+                        help="本地 tokenizer.json (或含 tokenizer 的模型目錄)；提供時計算每筆樣本的 token 長度並輸出長度統計")
+    parser.add_argument("--template-tokens", type=int, default=0,
+                        help="chat template 為每筆樣本額外加入的 token 數 (角色標記、BOS/EOS 等)，計入長度")
+    parser.add_argument("--bucket-boundaries", type=int, nargs="+", default=None,
+                        help="依 token 長度分桶的上界 (例如 128 256 512)，寫成 <stem>.len<lo>-<hi>.jsonl；需要 --tokenizer")
+    parser.add_argument("--pack-to", type=int, default=None,
+                        help="預先打包成不超過此 context 長度的序列，輸出依序列排列並寫出 <stem>.packs.jsonl 邊界資訊；需要 --tokenizer")
+    parser.add_argument("--length-stats", type=str, default=None,
+                        help="長度統計 JSON 路徑 (預設 <output stem>.lengths.json)")
+    add_profile_args(parser)
     args = parser.parse_args()
-    process_file(args.input_file, args.output_file)
\ No newline at end of file
+    if (args.bucket_boundaries or args.pack_to) and not args.tokenizer:
+        parser.error("--bucket-boundaries / --pack-to 需要 --tokenizer")
+    if args.bucket_boundaries and args.pack_to:
+        parser.error("--bucket-boundaries 與 --pack-to 只能擇一")
+    with profile_session(args):
+        process_file(args.input_file, args.output_file, args.shard, tokenizer=args.tokenizer,
+                     template_tokens=args.template_tokens, bucket_boundaries=args.bucket_boundaries,
+                     pack_to=args.pack_to, stats_path=args.length_stats)
+
+if __name__ == "__main__":
+    main()
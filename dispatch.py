@@ -0,0 +1,486 @@
+import hashlib
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import telemetry
+
+# --- 多端點負載平衡 ---
+# slu_icl.py / asr_icl.py 共用：把請求分散到多個 vLLM (OpenAI 相容) 服務
+
+
+def parse_endpoints(values: Iterable[str]) -> List[str]:
+    """
+    支援 `--api-base URL1 URL2` 與 `--api-base URL1,URL2` 兩種寫法，去除重複與結尾斜線。
+    """
+    endpoints = []
+    for value in values:
+        for url in value.split(","):
+            url = url.strip().rstrip("/")
+            if url and url not in endpoints:
+                endpoints.append(url)
+    return endpoints
+
+
+def probe_endpoint(url: str, timeout: float = 2.0) -> bool:
+    """
+    以 GET {api_base}/models 檢查服務是否可用。
+    """
+    import urllib.request  # 只在健康檢查時才需要 (import 本身要數十 ms)
+
+    try:
+        with urllib.request.urlopen(f"{url}/models", timeout=timeout) as resp:
+            return 200 <= resp.status < 300
+    except Exception:
+        return False
+
+
+def probe_health(url: str, timeout: float = 2.0) -> Optional[bool]:
+    """
+    以 GET {server root}/health (vLLM 的就绪路由) 检查服务；服务没有此路由 (404) 时回传 None。
+    """
+    import urllib.error
+    import urllib.request
+
+    root = url[:-len("/v1")] if url.endswith("/v1") else url
+    try:
+        with urllib.request.urlopen(f"{root}/health", timeout=timeout) as resp:
+            return 200 <= resp.status < 300
+    except urllib.error.HTTPError as e:
+        return None if e.code == 404 else False
+    except Exception:
+        return False
+
+
+def wait_until_ready(urls: List[str], timeout: float = 600.0, interval: float = 2.0) -> List[str]:
+    """
+    轮询直到端点的 /health 与 /models 都可用 (服务载入模型期间两者会失败)，回传在 timeout 内就绪的端点。
+    """
+    deadline = time.monotonic() + timeout
+    pending = list(urls)
+    ready = []
+    while True:
+        for url in list(pending):
+            if probe_health(url) is not False and probe_endpoint(url):
+                logging.info(f"端点就绪: {url}")
+                pending.remove(url)
+                ready.append(url)
+        if not pending or time.monotonic() >= deadline:
+            break
+        logging.info(f"等待端点就绪: {pending}")
+        time.sleep(interval)
+    if pending:
+        logging.error(f"端点在 {timeout:.0f}s 内未就绪: {pending}")
+    return [url for url in urls if url in ready]
+
+
+class Endpoint:
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.completed = 0
+        self.failed = 0
+
+
+class EndpointPool:
+    """
+    Least-outstanding-requests balancer over several OpenAI-compatible servers.
+
+    Endpoints that fail `max_failures` requests in a row (or fail a health
+    probe) are ejected; a background thread re-probes them every
+    `health_interval` seconds and re-admits them once `/models` answers.
+
+    With ``policy="prefix-affinity"`` requests carrying the same affinity key
+    (e.g. a hash of the system prompt + few-shot examples) prefer the same
+    server via rendezvous hashing, so its prefix cache stays warm. The
+    preferred server is only used while its in-flight count exceeds the
+    least-loaded one's by at most `affinity_slack` times the mean in-flight
+    count per endpoint. The allowance therefore grows with concurrency: at
+    one request per endpoint the choice is plain least-outstanding (ties go
+    to the preferred server), so a single shared prefix cannot pin the
+    whole run to one GPU.
+    """
+
+    POLICIES = ["least-outstanding", "prefix-affinity"]
+
+    def __init__(
+        self,
+        urls: List[str],
+        policy: str = "least-outstanding",
+        max_failures: int = 3,
+        health_interval: float = 10.0,
+        affinity_slack: float = 0.25,
+    ):
+        if not urls:
+            raise ValueError("EndpointPool needs at least one endpoint")
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown load balancing policy: {policy}")
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.policy = policy
+        self.max_failures = max_failures
+        self.health_interval = health_interval
+        self.affinity_slack = affinity_slack
+        self._lock = threading.Lock()
+        self._rr = 0
+        self._stop = threading.Event()
+        self._health_thread = None
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    # --- health checks ---
+    def check_health(self):
+        """
+        探測所有端點；全部失敗時保留原狀，交由請求本身回報錯誤。
+        """
+        results = {ep.url: probe_endpoint(ep.url) for ep in self.endpoints}
+        if not any(results.values()):
+            logging.error(f"所有端點健康檢查失敗: {list(results)}")
+            return
+        with self._lock:
+            for ep in self.endpoints:
+                if not results[ep.url] and ep.healthy:
+                    logging.warning(f"端點健康檢查失敗，暫時移除: {ep.url}")
+                elif results[ep.url] and not ep.healthy:
+                    logging.info(f"端點恢復，重新加入: {ep.url}")
+                ep.healthy = results[ep.url]
+                if ep.healthy:
+                    ep.consecutive_failures = 0
+
+    def start_health_checks(self):
+        if len(self.endpoints) < 2 or self._health_thread is not None:
+            return
+        self.check_health()
+        self._health_thread = threading.Thread(target=self._health_loop, daemon=True)
+        self._health_thread.start()
+
+    def _health_loop(self):
+        while not self._stop.wait(self.health_interval):
+            ejected = [ep for ep in self.endpoints if not ep.healthy]
+            for ep in ejected:
+                if probe_endpoint(ep.url):
+                    with self._lock:
+                        ep.healthy = True
+                        ep.consecutive_failures = 0
+                    logging.info(f"端點恢復，重新加入: {ep.url}")
+
+    def close(self):
+        self._stop.set()
+
+    # --- selection ---
+    def _rendezvous(self, candidates: List[Endpoint], key: str) -> Endpoint:
+        return max(candidates, key=lambda ep: hashlib.md5(f"{key}|{ep.url}".encode("utf-8")).digest())
+
+    def _select(self, affinity_key: Optional[str]) -> Endpoint:
+        candidates = [ep for ep in self.endpoints if ep.healthy]
+        if not candidates:
+            # 全部被移除時仍嘗試送出，避免整個 run 卡住
+            candidates = self.endpoints
+        least = min(ep.outstanding for ep in candidates)
+
+        if self.policy == "prefix-affinity" and affinity_key is not None:
+            preferred = self._rendezvous(candidates, affinity_key)
+            # 容许的额外负载与每台的平均在途数成比例
+            mean = sum(ep.outstanding for ep in candidates) / len(candidates)
+            if preferred.outstanding <= least + self.affinity_slack * mean:
+                return preferred
+
+        # least outstanding；同分時輪詢，避免總是打到第一台
+        n = len(candidates)
+        self._rr = (self._rr + 1) % n
+        for offset in range(n):
+            ep = candidates[(self._rr + offset) % n]
+            if ep.outstanding == least:
+                return ep
+        return candidates[0]
+
+    @contextmanager
+    def lease(self, affinity_key: Optional[str] = None) -> Iterator[str]:
+        """
+        取得一個端點 URL；區塊內拋出例外視為該端點失敗 (例外會繼續往外拋)。
+        """
+        with self._lock:
+            ep = self._select(affinity_key)
+            ep.outstanding += 1
+        try:
+            yield ep.url
+        except Exception:
+            with self._lock:
+                ep.outstanding -= 1
+                ep.failed += 1
+                ep.consecutive_failures += 1
+                if ep.healthy and ep.consecutive_failures >= self.max_failures and len(self.endpoints) > 1:
+                    ep.healthy = False
+                    logging.warning(f"端點連續失敗 {ep.consecutive_failures} 次，暫時移除: {ep.url}")
+            raise
+        else:
+            with self._lock:
+                ep.outstanding -= 1
+                ep.completed += 1
+                ep.consecutive_failures = 0
+
+    def summary(self) -> str:
+        return ", ".join(
+            f"{ep.url} (完成 {ep.completed}, 失敗 {ep.failed}{', 已移除' if not ep.healthy else ''})"
+            for ep in self.endpoints
+        )
+
+
+def ordered_map(fn: Callable, items: Iterable, concurrency: int = 1, window: Optional[int] = None,
+                order: Optional[Sequence[int]] = None) -> Iterator:
+    """
+    以 thread pool 並行執行 fn(item)，但依輸入順序 yield 結果。
+    同時在途的工作數量上限為 window (預設 concurrency * 4)，大檔案也不會一次全部送出。
+    order 為輸入索引的排列時依此順序送出 (例如長音頻優先)；此時全部項目一次提交，window 不適用。
+    generator 被提前關閉時 (例如提前停止) 會取消尚未開始的工作。
+    """
+    if concurrency <= 1:
+        for item in items:
+            yield fn(item)
+        return
+
+    window = window or concurrency * 4
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    pending = deque()
+    try:
+        if order is not None:
+            # thread pool 依提交順序開始執行
+            items = list(items)
+            futures = [None] * len(items)
+            for index in order:
+                futures[index] = executor.submit(fn, items[index])
+            pending.extend(futures)
+        else:
+            for item in items:
+                pending.append(executor.submit(fn, item))
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+
+class RetryableError(Exception):
+    """
+    Raised by a work function when the item should be attempted again later
+    (connection errors, timeouts, 408/429/5xx responses).
+    """
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """
+    没有 HTTP 状态码 (连线失败、逾时) 或状态码为 408 / 409 / 429 / 5xx 时视为暂时性错误。
+    """
+    status = getattr(exc, "status_code", None)
+    return status is None or status in (408, 409, 429) or status >= 500
+
+
+class CircuitBreaker:
+    """
+    Error-rate circuit breaker over the most recent `window` outcomes.
+
+    Closed: requests flow normally. Once at least `min_requests` outcomes are
+    recorded and the failure share reaches `threshold`, the breaker opens
+    and no new request is dispatched for `cooldown` seconds. It then lets a
+    single probe through (half-open): success closes it again, failure
+    re-opens it with the cooldown doubled (up to `max_cooldown`).
+
+    Not thread-safe; RetryScheduler only touches it from its dispatch loop.
+    """
+
+    def __init__(self, window: int = 20, threshold: float = 0.5, min_requests: int = 10,
+                 cooldown: float = 5.0, max_cooldown: float = 60.0):
+        self.outcomes = deque(maxlen=window)
+        self.threshold = threshold
+        self.min_requests = min_requests
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.times_opened = 0
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = "half-open"
+            logging.info("熔断器半开：送出一个探测请求")
+        return self.state == "half-open" and not self.probe_in_flight
+
+    def on_dispatch(self):
+        if self.state == "half-open":
+            self.probe_in_flight = True
+
+    def seconds_until_retry(self) -> Optional[float]:
+        if self.state != "open":
+            return None
+        return max(0.0, self.opened_at + self.cooldown - time.monotonic())
+
+    def record(self, success: bool):
+        if self.state == "half-open":
+            if not self.probe_in_flight:
+                # 熔断前已送出的请求陆续返回，不算探测结果
+                return
+            self.probe_in_flight = False
+            if success:
+                logging.info("探测成功，熔断器关闭，恢复送出请求")
+                self.state = "closed"
+                self.cooldown = self.base_cooldown
+                self.outcomes.clear()
+            else:
+                self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+                self._open()
+            return
+        if self.state == "open":
+            return
+        self.outcomes.append(success)
+        failures = self.outcomes.count(False)
+        if len(self.outcomes) >= self.min_requests and failures >= self.threshold * len(self.outcomes):
+            self._open()
+
+    def _open(self):
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.times_opened += 1
+        telemetry.count("breaker_opens")
+        logging.warning(f"错误率过高，熔断器打开：暂停送出请求 {self.cooldown:.1f}s")
+
+
+class RetryScheduler:
+    """
+    Like ``ordered_map`` but failure-aware.
+
+    When ``fn(item)`` raises ``RetryableError`` the item is moved to the back
+    of the queue after a jittered exponential backoff
+    (``base_delay * 2**(attempt-1)``, capped at `max_delay`, scaled by a
+    random factor in [0.5, 1.5)), so the remaining items keep flowing while
+    it waits. After `max_attempts` attempts (or on any other exception) the
+    item is given up: ``on_failure(item, exc)`` supplies its result and the
+    item is listed in ``failures``. A CircuitBreaker pauses dispatch while
+    the recent error rate is too high.
+
+    Results are yielded in input order; fresh items are only submitted while
+    they are less than `window` positions ahead of the oldest unfinished one.
+    """
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 1.0, max_delay: float = 30.0,
+                 breaker: Optional[CircuitBreaker] = None, seed: Optional[int] = None):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker or CircuitBreaker()
+        self.rng = random.Random(seed)
+        self.failures: List[Tuple[Any, BaseException, int]] = []
+        self.retries = 0
+
+    def backoff(self, attempt: int) -> float:
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay * self.rng.uniform(0.5, 1.5)
+
+    def map(self, fn: Callable, items: Iterable, concurrency: int = 1, window: Optional[int] = None,
+            on_failure: Optional[Callable[[Any, BaseException], Any]] = None,
+            order: Optional[Sequence[int]] = None) -> Iterator:
+        """
+        order 为输入索引的排列时，新项目依此顺序送出 (结果仍依输入顺序)，window 不适用。
+        generator 被提前关闭时会取消尚未开始的工作，已在执行中的请求则等其结束。
+        """
+        concurrency = max(1, concurrency)
+        window = window or concurrency * 4
+        if order is not None:
+            items = list(items)
+            source = ((index, items[index]) for index in order)
+            window = len(items) + 1
+        else:
+            source = enumerate(items)
+        fresh = None        # 下一个尚未送出的新项目 (index, item)
+        source_done = False
+        retry_queue = deque()   # 退避结束、等待重送的 (index, item, attempt)
+        deferred = []           # heap of (ready_at, seq, index, item, attempt)：退避中
+        seq = itertools.count()
+        in_flight: Dict[Any, Tuple[int, Any, int]] = {}
+        done: Dict[int, Any] = {}
+        next_index = 0
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        try:
+            while True:
+                now = time.monotonic()
+                while deferred and deferred[0][0] <= now:
+                    _, _, index, item, attempt = heapq.heappop(deferred)
+                    retry_queue.append((index, item, attempt))
+
+                while len(in_flight) < concurrency and self.breaker.allow():
+                    if fresh is None and not source_done:
+                        fresh = next(source, None)
+                        source_done = fresh is None
+                    # 新项目优先 (失败的项目排在后面)，但不超出 window；超出时先重送失败的项目
+                    if fresh is not None and fresh[0] < next_index + window:
+                        (index, item), attempt = fresh, 1
+                        fresh = None
+                    elif retry_queue:
+                        index, item, attempt = retry_queue.popleft()
+                    else:
+                        break
+                    self.breaker.on_dispatch()
+                    in_flight[executor.submit(fn, item)] = (index, item, attempt)
+
+                while next_index in done:
+                    yield done.pop(next_index)
+                    next_index += 1
+
+                if not in_flight and not retry_queue and not deferred and fresh is None and source_done:
+                    break
+
+                timeouts = [entry[0] - time.monotonic() for entry in deferred[:1]]
+                retry_in = self.breaker.seconds_until_retry()
+                if retry_in is not None:
+                    timeouts.append(retry_in)
+                timeout = max(0.0, min(timeouts)) if timeouts else None
+                if not in_flight:
+                    time.sleep(timeout if timeout is not None else 0.01)
+                    continue
+                finished, _ = wait(list(in_flight), timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    index, item, attempt = in_flight.pop(future)
+                    try:
+                        done[index] = future.result()
+                        self.breaker.record(True)
+                        continue
+                    except RetryableError as e:
+                        self.breaker.record(False)
+                        if attempt < self.max_attempts:
+                            delay = self.backoff(attempt)
+                            self.retries += 1
+                            telemetry.count("retries")
+                            logging.warning(f"第 {attempt} 次尝试失败，{delay:.1f}s 后重试: {e}")
+                            heapq.heappush(deferred, (time.monotonic() + delay, next(seq), index, item, attempt + 1))
+                            continue
+                        error = e
+                    except Exception as e:
+                        error = e
+                    logging.error(f"放弃 (共尝试 {attempt} 次): {error}")
+                    self.failures.append((item, error, attempt))
+                    telemetry.count("gave_up")
+                    done[index] = on_failure(item, error) if on_failure is not None else None
+        finally:
+            for future in in_flight:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def summary(self) -> str:
+        return (f"重试 {self.retries} 次, 放弃 {len(self.failures)} 项, "
+                f"熔断 {self.breaker.times_opened} 次")
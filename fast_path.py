@@ -0,0 +1,149 @@
+import argparse
+import json
+import logging
+import threading
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional
+
+from jsonl_io import dumps_bytes, iter_lines, loads
+from metrics import normalize_semantics, normalize_text
+from profiling import add_profile_args, session as profile_session, stage
+
+# --- 高频指令快速路径 ---
+# 车内指令 ("打开空调"、"下一首") 常逐字重复：由训练集预先建立 正规化查询 → 标准语义帧 的对照表，
+# 命中时直接回传，不送进数千 token 的 LLM prompt。只保留标注一致 (无歧义) 的查询。
+
+
+def _label_key(frames: List[Dict[str, Any]]) -> str:
+    # 以正规化后的语义帧 (忽略顺序) 判断两笔标注是否相同
+    return json.dumps(sorted(json.dumps(f, ensure_ascii=False, sort_keys=True) for f in normalize_semantics(frames)),
+                      ensure_ascii=False)
+
+
+class ExactMatchTable:
+    """
+    Normalized query -> standard semantic frames, built from training JSONL.
+
+    A query is kept only if every training occurrence carries the same
+    (normalized) label and it occurs at least `min_count` times.
+    ``lookup()`` is thread-safe and counts hits and misses.
+    """
+
+    def __init__(self, entries: Optional[Dict[str, List[Dict[str, Any]]]] = None):
+        self.entries = entries or {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, query: str) -> bool:
+        return normalize_text(query or "") in self.entries
+
+    @classmethod
+    def from_training_file(cls, train_file: str, min_count: int = 1) -> "ExactMatchTable":
+        from slu_icl import transform_semantics_to_standard
+
+        labels = defaultdict(Counter)
+        first_frames = {}
+        with open(train_file, 'rb') as f:
+            for line in iter_lines(f):
+                try:
+                    data = loads(line)
+                    semantics = data.get("semantics", [])
+                    # 训练集为原始格式 ({"意图1": {...}})；已是标准格式的列表则直接使用
+                    frames = semantics if isinstance(semantics, list) else transform_semantics_to_standard(semantics)
+                except (json.JSONDecodeError, AttributeError, KeyError, TypeError):
+                    continue
+                query = normalize_text(data.get("query", ""))
+                if not query:
+                    continue
+                label = _label_key(frames)
+                labels[query][label] += 1
+                first_frames.setdefault((query, label), frames)
+
+        entries = {}
+        ambiguous = 0
+        for query, counter in labels.items():
+            if len(counter) > 1:
+                ambiguous += 1
+                continue
+            label, count = next(iter(counter.items()))
+            if count >= min_count:
+                entries[query] = first_frames[(query, label)]
+        logging.info(
+            f"快速路径对照表: {len(entries)} 个查询 (训练集不同查询 {len(labels)}, 标注有歧义而略过 {ambiguous})"
+        )
+        return cls(entries)
+
+    @classmethod
+    def load(cls, path: str) -> "ExactMatchTable":
+        with open(path, 'rb') as f:
+            return cls(loads(f.read())["entries"])
+
+    def save(self, path: str):
+        with open(path, 'wb') as f:
+            f.write(dumps_bytes({"version": 1, "entries": self.entries}))
+
+    def lookup(self, query: str) -> Optional[List[Dict[str, Any]]]:
+        frames = self.entries.get(normalize_text(query or ""))
+        with self._lock:
+            if frames is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return frames
+
+    def summary(self) -> str:
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        return f"命中 {self.hits} / {total} ({rate:.1%})"
+
+
+def is_correct(frames: List[Dict[str, Any]], gold: Any) -> Optional[bool]:
+    """
+    与参考答案比较 (正规化后、忽略顺序)；没有可用的参考答案时回传 None。
+    """
+    if not isinstance(gold, list):
+        return None
+    return _label_key(frames) == _label_key(gold)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the exact-match fast-path table from training data")
+    parser.add_argument("--train-input-file", type=str, required=True, help="训练集 JSONL (query + semantics)")
+    parser.add_argument("--output-file", type=str, required=True, help="输出的对照表 JSON")
+    parser.add_argument("--min-count", type=int, default=1, help="查询至少出现几次才收录")
+    parser.add_argument("--eval-file", type=str, default=None,
+                        help="可选：以标准格式标注的 JSONL 评估对照表的命中率与准确率")
+    add_profile_args(parser)
+    args = parser.parse_args()
+    with profile_session(args):
+        run(args)
+
+
+def run(args: argparse.Namespace):
+    with stage("build_table"):
+        table = ExactMatchTable.from_training_file(args.train_input_file, min_count=args.min_count)
+    table.save(args.output_file)
+    logging.info(f"对照表已保存到 {args.output_file}")
+
+    if args.eval_file:
+        correct = 0
+        with stage("evaluate"), open(args.eval_file, 'rb') as f:
+            for line in iter_lines(f):
+                try:
+                    data = loads(line)
+                except json.JSONDecodeError:
+                    continue
+                frames = table.lookup(data.get("query", ""))
+                if frames is not None and is_correct(frames, data.get("semantics")):
+                    correct += 1
+        accuracy = correct / table.hits if table.hits else 0.0
+        print(f"命中率: {table.summary()}, 命中准确率: {accuracy:.4f} ({correct}/{table.hits})")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
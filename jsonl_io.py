@@ -0,0 +1,154 @@
+import json
+import time
+from typing import IO, Any, Iterator, Optional, Union
+
+# --- 共用 JSON / JSONL 读写 ---
+# 有 orjson (或 msgspec) 时用它编解码，否则退回标准库。大档案以大区块读入再切行，
+# 写出则先累积在缓冲区，满了或超过 flush_interval 秒才一次写入。
+# 注意：orjson / msgspec 输出紧凑格式 ({"a":1})，标准库为 {"a": 1}；两者皆不跳脱非 ASCII 字元。
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+msgspec = None
+if orjson is None:
+    try:
+        import msgspec
+    except ImportError:
+        pass
+
+JSONDecodeError = json.JSONDecodeError
+
+if orjson is not None:
+    BACKEND = "orjson"
+
+    def _loads(data):
+        return orjson.loads(data)
+
+    def dumps_bytes(obj) -> bytes:
+        return orjson.dumps(obj)
+
+elif msgspec is not None:
+    BACKEND = "msgspec"
+    _encoder = msgspec.json.Encoder()
+    _decoder = msgspec.json.Decoder()
+
+    def _loads(data):
+        try:
+            return _decoder.decode(data)
+        except msgspec.DecodeError as e:
+            # 呼叫端一律捕捉 json.JSONDecodeError
+            raise JSONDecodeError(str(e), data if isinstance(data, str) else "", 0) from None
+
+    def dumps_bytes(obj) -> bytes:
+        return _encoder.encode(obj)
+
+else:
+    BACKEND = "json"
+
+    def _loads(data):
+        return json.loads(data)
+
+    def dumps_bytes(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    """
+    解析一个 JSON 文件 (str 或 UTF-8 bytes)。不合法的 UTF-8 以替代字元处理，与以 errors='replace' 开档一致。
+    """
+    try:
+        return _loads(data)
+    except (JSONDecodeError, UnicodeDecodeError):
+        if isinstance(data, bytes):
+            return _loads(data.decode("utf-8", errors="replace"))
+        raise
+
+
+def dumps(obj: Any) -> str:
+    return dumps_bytes(obj).decode("utf-8")
+
+
+def dumps_line(obj: Any) -> bytes:
+    """
+    一笔 JSONL 记录 (UTF-8 bytes，含结尾换行)。
+    """
+    return dumps_bytes(obj) + b"\n"
+
+
+def iter_lines(f: IO[bytes], chunk_size: int = 1 << 20) -> Iterator[bytes]:
+    """
+    以 chunk_size 的区块读取二进位档案并切成行 (不含换行)。空白行照样回传，行号与档案一致。
+    """
+    remainder = b""
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        lines = (remainder + chunk).split(b"\n")
+        remainder = lines.pop()
+        yield from lines
+    if remainder:
+        yield remainder
+
+
+def read_lines(path: str) -> list:
+    """
+    整份档案的所有行 (bytes，不含换行)；供需要先计数或分片的呼叫端使用。
+    """
+    with open(path, 'rb') as f:
+        return list(iter_lines(f))
+
+
+class JsonlWriter:
+    """
+    Buffered JSONL writer.
+
+    Records are encoded with the fastest available backend and appended to
+    an in-memory buffer. The buffer is written to the file once it reaches
+    `buffer_size` bytes, or, when `flush_interval` is set, once that many
+    seconds have passed since the last write, so that readers tailing the
+    file (e.g. ``metrics.py --follow``) keep seeing progress.
+    """
+
+    def __init__(self, path: str, buffer_size: int = 1 << 20, flush_interval: Optional[float] = None,
+                 mode: str = 'wb'):
+        self.f = open(path, mode)
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self._buffer = bytearray()
+        self._last_flush = time.monotonic()
+
+    def write(self, obj: Any):
+        self.write_raw(dumps_line(obj))
+
+    def write_raw(self, line: Union[str, bytes]):
+        """
+        写入已编码好的一行 (须含结尾换行)。
+        """
+        self._buffer += line.encode("utf-8") if isinstance(line, str) else line
+        if len(self._buffer) >= self.buffer_size or (
+            self.flush_interval is not None and time.monotonic() - self._last_flush >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self.f.write(self._buffer)
+            self._buffer.clear()
+        self.f.flush()
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        if not self.f.closed:
+            self.flush()
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
@@ -0,0 +1,6 @@
+"""
+MAC-SLU 命令列入口：``python -m mac_slu <command> ...``。
+
+各子命令仍由原本的脚本 (slu_icl.py、metrics.py ...) 实作；这里刻意不 import 任何东西，
+只在执行子命令时才载入对应模块。
+"""
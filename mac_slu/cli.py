@@ -0,0 +1,128 @@
+import os
+import sys
+
+# --- 统一命令列入口 ---
+# 编排流程中这些脚本会被启动上千次 (常常只是评分或转换一个小分片)，因此入口只做字串比对，
+# 子命令的模块在执行时才 import；openai / numpy / tqdm 等较慢的依赖也都在各模块内延迟载入。
+
+# 只用 os.path：pathlib 本身的 import 就要约 10 ms
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 子命令 -> (模块, 说明, import 时间预算 ms)
+# 预算约为实测值的 2 倍；较慢的机器或 CI 以 --scale 放宽。载入重依赖则由下面的 HEAVY_MODULES 另外检查
+COMMANDS = {
+    "slu": ("slu_icl", "LLM few-shot SLU inference (slu_icl.py)", 120),
+    "asr": ("asr_icl", "ASR transcription for the cascade pipeline (asr_icl.py)", 100),
+    "metrics": ("metrics", "Score predictions against ground truth (metrics.py)", 70),
+    "data": ("data_util", "Convert labelled JSONL to SFT format (data_util.py)", 70),
+    "shard": ("shard_util", "Split inputs / merge per-shard outputs (shard_util.py)", 60),
+    "fast-path": ("fast_path", "Build or evaluate the exact-match table (fast_path.py)", 80),
+    "server": ("slu_server", "SLU serving daemon, mock model and load test (slu_server.py)", 180),
+    "synth": ("synth_data", "Generate synthetic records from the prompt ontology (synth_data.py)", 90),
+    "bench": ("benchmark", "Micro and end-to-end benchmarks with JSON baselines (benchmark.py)", 120),
+    "sweep": ("sweep", "Run a grid of slu_icl.py configurations with shared state (sweep.py)", 80),
+    "store": ("results_store", "Columnar results store: import, score and diff runs (results_store.py)", 80),
+}
+
+# 任何子命令在 import 阶段都不得载入的重依赖 (只能在实际用到时才 import)
+HEAVY_MODULES = (
+    "numpy", "openai", "pyarrow", "pandas", "torch", "tqdm", "requests",
+    "transformers", "tokenizers", "librosa", "soundfile", "duckdb", "vllm",
+)
+
+
+def usage() -> str:
+    width = len("check-imports")
+    lines = ["usage: python -m mac_slu <command> [args ...]", "", "commands:"]
+    for name, (_, help_text, _) in COMMANDS.items():
+        lines.append(f"  {name.ljust(width)}  {help_text}")
+    lines.append(f"  {'check-imports'.ljust(width)}  Fail if a command's module import loads a heavy dependency or exceeds its time budget")
+    return "\n".join(lines)
+
+
+def import_profile(module: str):
+    """
+    以 ``python -X importtime`` 在新的直译器中 import `module`，
+    回传 (累计 import 时间 ms, 期间载入的所有顶层套件名称)。
+    """
+    import subprocess
+
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{proc.stderr.strip().splitlines()[-1]}")
+    elapsed_ms, loaded = None, set()
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = line.split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2].strip()
+        loaded.add(name.split(".")[0])
+        if name == module and not parts[2].startswith("  "):
+            elapsed_ms = int(parts[1]) / 1000
+    if elapsed_ms is None:
+        raise RuntimeError(f"No importtime entry for {module}")
+    return elapsed_ms, loaded
+
+
+def check_imports(argv) -> int:
+    """
+    对每个子命令检查模块 import：载入 HEAVY_MODULES 中的套件，或 import 时间
+    (取 --repeat 次中的最小值) 超过预算时回传非零。
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="mac_slu check-imports", description="Check that command modules import no heavy dependencies and stay within their import-time budgets.")
+    parser.add_argument("commands", nargs="*", metavar="command", help=f"Commands to check (default: all of {', '.join(COMMANDS)})")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per module; the fastest one is compared to the budget")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiply every budget (e.g. for slow CI machines)")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.commands if name not in COMMANDS]
+    if unknown:
+        parser.error(f"unknown command(s): {', '.join(unknown)}")
+
+    failed = 0
+    for name in args.commands or COMMANDS:
+        module, _, budget_ms = COMMANDS[name]
+        budget_ms *= args.scale
+        try:
+            profiles = [import_profile(module) for _ in range(max(1, args.repeat))]
+        except RuntimeError as e:
+            print(f"{name:<10} ERROR  {e}")
+            failed += 1
+            continue
+        elapsed_ms = min(ms for ms, _ in profiles)
+        heavy = [dep for dep in HEAVY_MODULES if dep in profiles[0][1]]
+        status = "HEAVY" if heavy else "ok" if elapsed_ms <= budget_ms else "SLOW"
+        failed += status != "ok"
+        print(f"{name:<10} {status:<5}  import {module}: {elapsed_ms:7.1f} ms (budget {budget_ms:.0f} ms)")
+        if heavy:
+            print(f"{'':<10}        loads {', '.join(heavy)} at import time; import it where it is used")
+    return 1 if failed else 0
+
+
+def main(argv=None) -> int:
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if not argv or argv[0] in ("-h", "--help"):
+        print(usage())
+        return 0 if argv else 2
+
+    command, rest = argv[0], argv[1:]
+    if command == "check-imports":
+        return check_imports(rest)
+    if command not in COMMANDS:
+        print(f"mac_slu: unknown command {command!r}\n\n{usage()}", file=sys.stderr)
+        return 2
+
+    # 脚本位于仓库根目录，彼此以顶层模块互相 import
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    import importlib
+
+    module = importlib.import_module(COMMANDS[command][0])
+    sys.argv = [f"mac_slu {command}"] + rest
+    result = module.main()
+    return result if isinstance(result, int) else 0
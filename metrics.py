@@ -1,8 +1,52 @@
+import hashlib
 import json
+import mmap
+import os
+import struct
 import argparse
 import sys
 import re
-from collections import defaultdict
+import time
+from pathlib import Path
+from array import array
+from collections import Counter
+from functools import lru_cache, partial
+from itertools import zip_longest
+
+from jsonl_io import iter_lines, loads
+from profiling import add_profile_args, session as profile_session, timed
+
+# 只有細項統計 / bootstrap / 顯著性檢定需要 numpy，第一次用到時才載入 (import 需數十 ms)
+np = None
+
+def _require_numpy(purpose):
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError(f"numpy is needed for {purpose}: pip install numpy") from None
+        np = numpy
+    return np
+
+# Chinese numeral mapping (Simple character replacement)
+# KEEPING CHINESE CHARACTERS HERE AS REQUESTED
+CN_NUM_MAP = {
+    '零': '0', '一': '1', '二': '2', '三': '3', '四': '4',
+    '五': '5', '六': '6', '七': '7', '八': '8', '九': '9',
+    '两': '2'
+}
+_CN_NUM_TABLE = str.maketrans(CN_NUM_MAP)
+
+# Logic: Replace any character that is NOT a word char, digit, or whitespace with empty string.
+# \w in Python 3 re includes alphanumeric characters (including Chinese characters) and underscores.
+_PUNCT_RE = re.compile(r'[^\w\s]')
+
+@lru_cache(maxsize=1 << 16)
+def _normalize_str(text):
+    # domain / intent / slot key 高度重複，快取可省下大檔案上絕大部分的正規化成本
+    text = text.lower().translate(_CN_NUM_TABLE)
+    return _PUNCT_RE.sub('', text).strip()
 
 def normalize_text(text):
     """
@@ -14,27 +58,7 @@ def normalize_text(text):
     """
     if not isinstance(text, str):
         return str(text)
-
-    # 1. Convert to lowercase
-    text = text.lower()
-
-    # 2. Chinese numeral mapping (Simple character replacement)
-    # KEEPING CHINESE CHARACTERS HERE AS REQUESTED
-    cn_num_map = {
-        '零': '0', '一': '1', '二': '2', '三': '3', '四': '4',
-        '五': '5', '六': '6', '七': '7', '八': '8', '九': '9',
-        '两': '2'
-    }
-    for k, v in cn_num_map.items():
-        text = text.replace(k, v)
-
-    # 3. Remove punctuation
-    # Logic: Replace any character that is NOT a word char, digit, or whitespace with empty string.
-    # \w in Python 3 re includes alphanumeric characters (including Chinese characters) and underscores.
-    text = re.sub(r'[^\w\s]', '', text)
-
-    # 4. Remove leading/trailing whitespace
-    return text.strip()
+    return _normalize_str(text)
 
 def normalize_semantics(semantics_list):
     """
@@ -74,18 +98,18 @@ def normalize_semantics(semantics_list):
     
     return normalized_list
 
-def calculate_metrics(predict_file, ground_truth_file):
+@timed("load_ground_truth")
+def load_ground_truth(ground_truth_file):
     """
-    修改版本：支援 ID 匹配，自動跳過缺失或不對齊的數據。
+    讀取 Ground Truth 並建立 id -> record 索引。
     """
-    # 1. 讀取 Ground Truth 並建立索引
     gt_map = {}
     try:
-        # 使用 errors='replace' 防止非法位元組導致崩潰
-        with open(ground_truth_file, 'r', encoding='utf-8', errors='replace') as f_gt:
-            for line_idx, line in enumerate(f_gt, 1):
+        # loads() 以替代字元處理非法位元組，不會崩潰
+        with open(ground_truth_file, 'rb') as f_gt:
+            for line_idx, line in enumerate(iter_lines(f_gt), 1):
                 try:
-                    data = json.loads(line.strip())
+                    data = loads(line)
                     sample_id = str(data.get("id", ""))
                     if not sample_id:
                         print(f"Warning: Ground truth line {line_idx} missing 'id', skipped.", file=sys.stderr)
@@ -96,6 +120,640 @@ def calculate_metrics(predict_file, ground_truth_file):
     except FileNotFoundError as e:
         print(f"Error: Ground truth file not found - {e}", file=sys.stderr)
         sys.exit(1)
+    return gt_map
+
+def compare_semantics(pred_semantics, gt_semantics):
+    """
+    比較已正規化的預測與 GT，回傳
+    (exact_match, intent_match, pred_intents, gt_intents, pred_slot_set, gt_slot_set)。
+    """
+    # 1. Overall Accuracy
+    exact_match = pred_semantics == gt_semantics
+
+    # 2. Intent Accuracy
+    pred_intents = sorted([(s.get("domain"), s.get("intent")) for s in pred_semantics])
+    gt_intents = sorted([(s.get("domain"), s.get("intent")) for s in gt_semantics])
+    intent_match = pred_intents == gt_intents
+
+    # 3. Slot Metrics
+    pred_slot_set = set()
+    for s in pred_semantics:
+        slots = s.get("slots", {})
+        if isinstance(slots, dict):
+            for k, v in slots.items():
+                pred_slot_set.add((k, v))
+
+    gt_slot_set = set()
+    for s in gt_semantics:
+        slots = s.get("slots", {})
+        if isinstance(slots, dict):
+            for k, v in slots.items():
+                gt_slot_set.add((k, v))
+
+    return exact_match, intent_match, pred_intents, gt_intents, pred_slot_set, gt_slot_set
+
+def score_sample(pred_semantics, gt_semantics):
+    """
+    對單一樣本評分，回傳 (exact_match, intent_match, slot_tp, slot_fp, slot_fn)。
+    輸入為未正規化的 semantics list。
+    """
+    exact_match, intent_match, _, _, pred_slot_set, gt_slot_set = compare_semantics(
+        normalize_semantics(pred_semantics), normalize_semantics(gt_semantics)
+    )
+    return (
+        exact_match,
+        intent_match,
+        len(pred_slot_set.intersection(gt_slot_set)),
+        len(pred_slot_set.difference(gt_slot_set)),
+        len(gt_slot_set.difference(pred_slot_set)),
+    )
+
+def summarize_counts(processed_count, overall_match_count, intent_match_count, slot_tp, slot_fp, slot_fn):
+    """
+    由累計的計數計算最終指標 (除數為 processed_count)。
+    """
+    overall_accuracy = overall_match_count / processed_count if processed_count > 0 else 0.0
+    intent_accuracy = intent_match_count / processed_count if processed_count > 0 else 0.0
+
+    slot_precision = slot_tp / (slot_tp + slot_fp) if (slot_tp + slot_fp) > 0 else 0.0
+    slot_recall = slot_tp / (slot_tp + slot_fn) if (slot_tp + slot_fn) > 0 else 0.0
+    slot_f1 = 2 * (slot_precision * slot_recall) / (slot_precision + slot_recall) if (slot_precision + slot_recall) > 0 else 0.0
+
+    return {
+        "total_count": processed_count, # 這是實際有對齊到的樣本數
+        "overall_match_count": overall_match_count,
+        "overall_accuracy": overall_accuracy,
+        "intent_match_count": intent_match_count,
+        "intent_accuracy": intent_accuracy,
+        "slot_tp": slot_tp, "slot_fp": slot_fp, "slot_fn": slot_fn,
+        "slot_precision": slot_precision,
+        "slot_recall": slot_recall,
+        "slot_f1": slot_f1,
+    }
+
+class _BincountBuffer:
+    """
+    以 array 暫存整數 id，每累積 flush_size 筆才用 np.bincount 併入計數陣列。
+    避免在熱迴圈中逐筆對 NumPy 陣列做純量索引，記憶體也維持固定。
+    """
+
+    def __init__(self, size, flush_size=1 << 20):
+        self.counts = np.zeros(size, dtype=np.int64)
+        self.flush_size = flush_size
+        self._pending = array('q')
+
+    def extend(self, ids):
+        self._pending.extend(ids)
+        if len(self._pending) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            self.counts += np.bincount(
+                np.frombuffer(self._pending, dtype=np.int64), minlength=len(self.counts)
+            )
+            self._pending = array('q')
+
+    def result(self):
+        self.flush()
+        return self.counts
+
+
+def _safe_divide(numer, denom):
+    numer = np.asarray(numer, dtype=np.float64)
+    denom = np.asarray(denom, dtype=np.float64)
+    return np.divide(numer, denom, out=np.zeros_like(numer), where=denom > 0)
+
+
+class BreakdownAccumulator:
+    """
+    依 GT 標籤集合把 domain / (domain, intent) / slot key 映射成整數 id，
+    單次掃描累計 per-domain、per-intent、per-slot-key 計數與 intent 混淆矩陣。
+    GT 中未出現的預測標籤歸入 OTHER_LABEL；多意圖對不齊的部分記為 NONE_LABEL。
+    """
+
+    OTHER_LABEL = "<other>"
+    NONE_LABEL = "<none>"
+
+    def __init__(self, gt_records):
+        _require_numpy("the metrics breakdown")
+
+        # gt_records 可為 gt_map.values() 或逐行讀取的 generator
+        domains, intents, slot_keys = set(), set(), set()
+        for data in gt_records:
+            for s in normalize_semantics(data.get("semantics", [])):
+                domains.add(s.get("domain"))
+                intents.add((s.get("domain"), s.get("intent")))
+                slots = s.get("slots", {})
+                if isinstance(slots, dict):
+                    slot_keys.update(slots.keys())
+
+        self.domain_labels = sorted(domains, key=str)
+        self.intent_labels = sorted(intents, key=str)
+        self.slot_labels = sorted(slot_keys, key=str) + [self.OTHER_LABEL]
+        self.domain_ids = {d: i for i, d in enumerate(self.domain_labels)}
+        self.intent_ids = {p: i for i, p in enumerate(self.intent_labels)}
+        self.slot_ids = {k: i for i, k in enumerate(self.slot_labels)}
+
+        # 混淆矩陣的索引：[0, K) 為 GT intent，K 為 <other>，K+1 為 <none>
+        n_intent = len(self.intent_labels)
+        self.intent_other_id = n_intent
+        self.intent_none_id = n_intent + 1
+        self.n_confusion = n_intent + 2
+
+        n_domain = len(self.domain_labels)
+        n_slot = len(self.slot_labels)
+        self.domain_support = _BincountBuffer(n_domain)
+        self.domain_exact = _BincountBuffer(n_domain)
+        self.domain_intent = _BincountBuffer(n_domain)
+        self.intent_support = _BincountBuffer(n_intent)
+        self.intent_exact = _BincountBuffer(n_intent)
+        self.intent_intent = _BincountBuffer(n_intent)
+        self.slot_tp = _BincountBuffer(n_slot)
+        self.slot_fp = _BincountBuffer(n_slot)
+        self.slot_fn = _BincountBuffer(n_slot)
+        self.confusion = _BincountBuffer(self.n_confusion * self.n_confusion)
+
+    def add(self, exact_match, intent_match, pred_intents, gt_intents, pred_slot_set, gt_slot_set):
+        """
+        餵入 compare_semantics() 的結果。
+        """
+        domain_ids = [self.domain_ids[d] for d in {d for d, _ in gt_intents}]
+        intent_ids = [self.intent_ids[pair] for pair in set(gt_intents)]
+        self.domain_support.extend(domain_ids)
+        self.intent_support.extend(intent_ids)
+        if exact_match:
+            self.domain_exact.extend(domain_ids)
+            self.intent_exact.extend(intent_ids)
+        if intent_match:
+            self.domain_intent.extend(domain_ids)
+            self.intent_intent.extend(intent_ids)
+
+        slot_ids = self.slot_ids
+        other_slot = slot_ids[self.OTHER_LABEL]
+        self.slot_tp.extend([slot_ids[k] for k, _ in pred_slot_set & gt_slot_set])
+        self.slot_fp.extend([slot_ids.get(k, other_slot) for k, _ in pred_slot_set - gt_slot_set])
+        self.slot_fn.extend([slot_ids[k] for k, _ in gt_slot_set - pred_slot_set])
+
+        # 多意圖對齊：相同的 (domain, intent) 先配對在對角線，其餘依排序順序兩兩配對
+        n = self.n_confusion
+        if intent_match:
+            self.confusion.extend([i_id * n + i_id for i_id in map(self.intent_ids.__getitem__, gt_intents)])
+            return
+        pred_counter = Counter(pred_intents)
+        gt_counter = Counter(gt_intents)
+        cells = []
+        for pair, count in (pred_counter & gt_counter).items():
+            i_id = self.intent_ids[pair]
+            cells.extend([i_id * n + i_id] * count)
+        rest_gt = sorted((gt_counter - pred_counter).elements(), key=str)
+        rest_pred = sorted((pred_counter - gt_counter).elements(), key=str)
+        for gt_pair, pred_pair in zip_longest(rest_gt, rest_pred):
+            row = self.intent_none_id if gt_pair is None else self.intent_ids[gt_pair]
+            if pred_pair is None:
+                col = self.intent_none_id
+            else:
+                col = self.intent_ids.get(pred_pair, self.intent_other_id)
+            cells.append(row * n + col)
+        self.confusion.extend(cells)
+
+    def results(self):
+        domain_support = self.domain_support.result()
+        intent_support = self.intent_support.result()
+        domain_exact_acc = _safe_divide(self.domain_exact.result(), domain_support)
+        domain_intent_acc = _safe_divide(self.domain_intent.result(), domain_support)
+        intent_exact_acc = _safe_divide(self.intent_exact.result(), intent_support)
+        intent_intent_acc = _safe_divide(self.intent_intent.result(), intent_support)
+
+        tp = self.slot_tp.result()
+        fp = self.slot_fp.result()
+        fn = self.slot_fn.result()
+        precision = _safe_divide(tp, tp + fp)
+        recall = _safe_divide(tp, tp + fn)
+        f1 = _safe_divide(2 * precision * recall, precision + recall)
+
+        confusion = self.confusion.result().reshape(self.n_confusion, self.n_confusion)
+        confusion_labels = [f"{d}/{i}" for d, i in self.intent_labels] + [self.OTHER_LABEL, self.NONE_LABEL]
+
+        return {
+            "domains": [
+                {
+                    "domain": d,
+                    "support": int(domain_support[idx]),
+                    "overall_accuracy": float(domain_exact_acc[idx]),
+                    "intent_accuracy": float(domain_intent_acc[idx]),
+                }
+                for idx, d in enumerate(self.domain_labels)
+            ],
+            "intents": [
+                {
+                    "domain": d,
+                    "intent": i,
+                    "support": int(intent_support[idx]),
+                    "overall_accuracy": float(intent_exact_acc[idx]),
+                    "intent_accuracy": float(intent_intent_acc[idx]),
+                }
+                for idx, (d, i) in enumerate(self.intent_labels)
+            ],
+            "slot_keys": [
+                {
+                    "slot": k,
+                    "tp": int(tp[idx]), "fp": int(fp[idx]), "fn": int(fn[idx]),
+                    "precision": float(precision[idx]),
+                    "recall": float(recall[idx]),
+                    "f1": float(f1[idx]),
+                }
+                for idx, k in enumerate(self.slot_labels)
+            ],
+            "intent_confusion": {
+                "labels": confusion_labels,
+                "matrix": confusion.tolist(),
+            },
+        }
+
+def export_breakdown_json(breakdown, output_path):
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(breakdown, f, ensure_ascii=False, indent=2)
+
+def export_breakdown_csv(breakdown, output_dir):
+    """
+    寫出 domains.csv、intents.csv、slot_keys.csv 與 intent_confusion.csv。
+    """
+    import csv
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for name in ["domains", "intents", "slot_keys"]:
+        rows = breakdown[name]
+        if not rows:
+            continue
+        with open(output_dir / f"{name}.csv", 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+
+    labels = breakdown["intent_confusion"]["labels"]
+    with open(output_dir / "intent_confusion.csv", 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["gt \\ pred"] + labels)
+        for label, row in zip(labels, breakdown["intent_confusion"]["matrix"]):
+            writer.writerow([label] + row)
+
+# --- 信賴區間與顯著性檢定 ---
+# 每個樣本的結果向量欄位順序: exact match, intent match, slot TP, slot FP, slot FN
+OUTCOME_FIELDS = ["exact", "intent", "slot_tp", "slot_fp", "slot_fn"]
+CI_METRICS = ["overall_accuracy", "intent_accuracy", "slot_precision", "slot_recall", "slot_f1"]
+
+def _metrics_from_sums(sums, n):
+    """
+    sums 的最後一維為 OUTCOME_FIELDS 的加總，可帶任意前置 batch 維度。
+    """
+    exact, intent, tp, fp, fn = np.moveaxis(np.asarray(sums, dtype=np.float64), -1, 0)
+    precision = _safe_divide(tp, tp + fp)
+    recall = _safe_divide(tp, tp + fn)
+    return {
+        "overall_accuracy": exact / n,
+        "intent_accuracy": intent / n,
+        "slot_precision": precision,
+        "slot_recall": recall,
+        "slot_f1": _safe_divide(2 * precision * recall, precision + recall),
+    }
+
+# 每個 chunk 的暫存陣列上限 (bytes)：重抽樣索引與 bincount 結果各為 (size, n) 的 int64
+BOOTSTRAP_CHUNK_BYTES = 256 << 20
+
+
+def _chunk_rows(n, chunk_size):
+    """
+    每個 chunk 的重抽樣次數：不超過 chunk_size，且暫存陣列不超過 BOOTSTRAP_CHUNK_BYTES
+    (n = 1e6 時 1000 列會配置約 16 GB)。
+    """
+    return max(1, min(chunk_size, BOOTSTRAP_CHUNK_BYTES // (16 * max(n, 1))))
+
+def _resample_counts(rng, n, size):
+    """
+    回傳 (size, n) 矩陣，每列為一次 bootstrap 重抽樣中各樣本被抽中的次數。
+    以單次 bincount 完成，之後用矩陣乘法一次求出所有重抽樣的加總。
+    """
+    idx = rng.integers(0, n, size=(size, n))
+    idx += np.arange(size)[:, None] * n
+    return np.bincount(idx.ravel(), minlength=size * n).reshape(size, n)
+
+@timed("bootstrap")
+def bootstrap_ci(outcomes, n_resamples=10000, confidence=0.95, seed=0, chunk_size=1000):
+    """
+    對 calculate_metrics(..., outcomes=True) 的結果做向量化 bootstrap，
+    回傳 {metric: (low, high)}。
+    """
+    _require_numpy("bootstrap confidence intervals")
+    matrix = outcomes["matrix"].astype(np.float64)
+    n = len(matrix)
+    rng = np.random.default_rng(seed)
+    chunk_size = _chunk_rows(n, chunk_size)
+
+    samples = {m: [] for m in CI_METRICS}
+    for start in range(0, n_resamples, chunk_size):
+        size = min(chunk_size, n_resamples - start)
+        sums = _resample_counts(rng, n, size) @ matrix
+        for metric, values in _metrics_from_sums(sums, n).items():
+            samples[metric].append(values)
+
+    alpha = (1.0 - confidence) / 2
+    intervals = {}
+    for metric in CI_METRICS:
+        low, high = np.quantile(np.concatenate(samples[metric]), [alpha, 1.0 - alpha])
+        intervals[metric] = (float(low), float(high))
+    return intervals
+
+@timed("significance")
+def paired_significance(outcomes_a, outcomes_b, n_resamples=10000, confidence=0.95, seed=0, chunk_size=1000):
+    """
+    以共同的樣本 id 配對兩個系統，回傳每個指標的
+    {"a", "b", "delta", "ci": paired bootstrap 區間, "p_value": 雙尾 paired permutation test}。
+    delta 為 b - a。
+    """
+    _require_numpy("significance tests")
+    index_b = {sample_id: i for i, sample_id in enumerate(outcomes_b["ids"])}
+    pairs = [(i, index_b[sample_id]) for i, sample_id in enumerate(outcomes_a["ids"]) if sample_id in index_b]
+    if not pairs:
+        raise ValueError("No common sample ids between the two prediction files.")
+    rows_a, rows_b = (np.fromiter(col, dtype=np.int64, count=len(pairs)) for col in zip(*pairs))
+    a = outcomes_a["matrix"][rows_a].astype(np.float64)
+    b = outcomes_b["matrix"][rows_b].astype(np.float64)
+    n = len(a)
+    sum_a, sum_b = a.sum(axis=0), b.sum(axis=0)
+    metrics_a = _metrics_from_sums(sum_a, n)
+    metrics_b = _metrics_from_sums(sum_b, n)
+    observed = {m: metrics_b[m] - metrics_a[m] for m in CI_METRICS}
+
+    rng = np.random.default_rng(seed)
+    chunk_size = _chunk_rows(n, chunk_size)
+    diff = b - a
+    boot_deltas = {m: [] for m in CI_METRICS}
+    exceed = {m: 0 for m in CI_METRICS}
+    for start in range(0, n_resamples, chunk_size):
+        size = min(chunk_size, n_resamples - start)
+
+        # paired bootstrap：兩個系統使用同一組重抽樣
+        counts = _resample_counts(rng, n, size)
+        boot_a = _metrics_from_sums(counts @ a, n)
+        boot_b = _metrics_from_sums(counts @ b, n)
+
+        # permutation：每個樣本以 1/2 機率交換 a / b 的結果
+        swapped = rng.integers(0, 2, size=(size, n)).astype(np.float64) @ diff
+        perm_a = _metrics_from_sums(sum_a + swapped, n)
+        perm_b = _metrics_from_sums(sum_b - swapped, n)
+
+        for m in CI_METRICS:
+            boot_deltas[m].append(boot_b[m] - boot_a[m])
+            exceed[m] += int(np.count_nonzero(np.abs(perm_b[m] - perm_a[m]) >= abs(observed[m]) - 1e-12))
+
+    alpha = (1.0 - confidence) / 2
+    report = {"paired_count": n}
+    for m in CI_METRICS:
+        low, high = np.quantile(np.concatenate(boot_deltas[m]), [alpha, 1.0 - alpha])
+        report[m] = {
+            "a": float(metrics_a[m]),
+            "b": float(metrics_b[m]),
+            "delta": float(observed[m]),
+            "ci": (float(low), float(high)),
+            "p_value": (exceed[m] + 1) / (n_resamples + 1),
+        }
+    return report
+
+# --- 記憶體受限的 GT 對齊 ---
+# join="sorted": 兩個檔案都依 id 排序時做 merge-join，只保留目前一筆 GT。
+# join="index":  在磁碟上建立一次 id -> offset 索引 (GT 檔案未變更時重複使用)，
+#                每筆預測以二分搜尋 + seek 讀取對應的 GT 行。
+
+JOIN_MODES = ["memory", "sorted", "index"]
+
+def iter_jsonl_records(path):
+    """
+    逐行讀取 JSONL，yield (line_idx, record)；無法解析的行直接略過。
+    """
+    with open(path, 'rb') as f:
+        for line_idx, line in enumerate(iter_lines(f), 1):
+            try:
+                yield line_idx, loads(line)
+            except json.JSONDecodeError:
+                continue
+
+class GroundTruthIndex:
+    """
+    On-disk id -> byte offset index for a ground-truth JSONL file.
+
+    Entries are fixed-width (8-byte blake2b hash of the id, 8-byte offset),
+    sorted by hash and searched through mmap, so lookups need no per-id memory.
+    The index is built once with an external sort and reused as long as the
+    ground-truth file size and mtime match its header.
+    """
+
+    MAGIC = b"MSLUIDX1"
+    HEADER = struct.Struct(">8sQQ")
+    ENTRY = struct.Struct(">8sQ")
+
+    def __init__(self, ground_truth_file, index_file=None, chunk_size=1 << 18):
+        self.ground_truth_file = Path(ground_truth_file)
+        self.index_file = Path(index_file) if index_file else self.ground_truth_file.with_name(
+            self.ground_truth_file.name + ".idx"
+        )
+        self.chunk_size = chunk_size
+        if not self._is_fresh():
+            self.build()
+        self._gt = open(self.ground_truth_file, 'rb')
+        self._idx = open(self.index_file, 'rb')
+        self._mm = mmap.mmap(self._idx.fileno(), 0, access=mmap.ACCESS_READ)
+        self.count = (len(self._mm) - self.HEADER.size) // self.ENTRY.size
+
+    @staticmethod
+    def _hash_id(sample_id):
+        return hashlib.blake2b(sample_id.encode('utf-8'), digest_size=8).digest()
+
+    def _signature(self):
+        stat = self.ground_truth_file.stat()
+        return stat.st_size, stat.st_mtime_ns
+
+    def _is_fresh(self):
+        try:
+            with open(self.index_file, 'rb') as f:
+                magic, size, mtime_ns = self.HEADER.unpack(f.read(self.HEADER.size))
+        except (OSError, struct.error):
+            return False
+        return magic == self.MAGIC and (size, mtime_ns) == self._signature()
+
+    def build(self):
+        """
+        外部排序：每 chunk_size 筆排序後寫成暫存 run，最後以 heapq.merge 合併，記憶體固定。
+        """
+        import heapq
+        import shutil
+        import tempfile
+        print(f"Building ground truth index {self.index_file} ...", file=sys.stderr)
+        runs = []
+        tmp_dir = tempfile.mkdtemp(dir=self.index_file.parent)
+        try:
+            chunk = []
+            with open(self.ground_truth_file, 'rb') as f_gt:
+                offset = 0
+                for line in f_gt:
+                    try:
+                        sample_id = str(loads(line).get("id", ""))
+                    except (json.JSONDecodeError, UnicodeDecodeError, AttributeError):
+                        sample_id = ""
+                    if sample_id:
+                        chunk.append(self.ENTRY.pack(self._hash_id(sample_id), offset))
+                    offset += len(line)
+                    if len(chunk) >= self.chunk_size:
+                        runs.append(self._write_run(tmp_dir, len(runs), chunk))
+                        chunk = []
+            if chunk or not runs:
+                runs.append(self._write_run(tmp_dir, len(runs), chunk))
+
+            run_files = [open(run, 'rb') for run in runs]
+            try:
+                tmp_index = self.index_file.with_name(self.index_file.name + ".tmp")
+                with open(tmp_index, 'wb') as f_idx:
+                    f_idx.write(self.HEADER.pack(self.MAGIC, *self._signature()))
+                    f_idx.writelines(heapq.merge(*(iter(partial(f.read, self.ENTRY.size), b"") for f in run_files)))
+                os.replace(tmp_index, self.index_file)
+            finally:
+                for f in run_files:
+                    f.close()
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _write_run(self, tmp_dir, run_idx, chunk):
+        chunk.sort()
+        path = Path(tmp_dir) / f"run_{run_idx}.bin"
+        with open(path, 'wb') as f:
+            f.writelines(chunk)
+        return path
+
+    def _entry(self, pos):
+        start = self.HEADER.size + pos * self.ENTRY.size
+        return self.ENTRY.unpack_from(self._mm, start)
+
+    def get(self, sample_id):
+        """
+        回傳 sample_id 對應的 GT 紀錄，不存在時回傳 None。
+        """
+        key = self._hash_id(sample_id)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        # 雜湊碰撞時逐一比對實際 id
+        while lo < self.count:
+            entry_key, offset = self._entry(lo)
+            if entry_key != key:
+                return None
+            self._gt.seek(offset)
+            data = loads(self._gt.readline())
+            if str(data.get("id", "")) == sample_id:
+                return data
+            lo += 1
+        return None
+
+    def close(self):
+        self._mm.close()
+        self._idx.close()
+        self._gt.close()
+
+def _iter_pairs_by_lookup(f_pred, lookup):
+    for line_idx, pred_line in enumerate(iter_lines(f_pred), 1):
+        try:
+            pred_data = loads(pred_line)
+        except json.JSONDecodeError:
+            print(f"Warning: JSON parse error at prediction line {line_idx}, skipped.", file=sys.stderr)
+            continue
+        sample_id = str(pred_data.get("id", ""))
+        gt_data = lookup(sample_id)
+        # 不在 Ground Truth 中的 ID 直接跳過，不中斷程式
+        if gt_data is not None:
+            yield line_idx, sample_id, pred_data, gt_data
+
+def _iter_pairs_sorted(f_pred, ground_truth_file):
+    """
+    Merge-join：兩個檔案都必須依 shard_util.id_sort_key 排序，否則拋出 ValueError。
+    """
+    from shard_util import id_sort_key
+
+    gt_iter = iter_jsonl_records(ground_truth_file)
+    gt_key, gt_data = None, None
+    prev_pred_key = None
+    last_gt_key = None
+
+    def next_gt():
+        # 每读一笔 GT 都检查顺序，键值一变小立刻报错 (否则对应的预测会被悄悄丢出分母)
+        nonlocal last_gt_key
+        for line_idx, data in gt_iter:
+            sample_id = str(data.get("id", ""))
+            if sample_id:
+                key = id_sort_key(sample_id)
+                if last_gt_key is not None and key < last_gt_key:
+                    raise ValueError(f"Ground truth file is not sorted by id (line {line_idx}); use --join index instead.")
+                last_gt_key = key
+                return key, data
+        return None, None
+
+    gt_key, gt_data = next_gt()
+    for line_idx, pred_line in enumerate(iter_lines(f_pred), 1):
+        try:
+            pred_data = loads(pred_line)
+        except json.JSONDecodeError:
+            print(f"Warning: JSON parse error at prediction line {line_idx}, skipped.", file=sys.stderr)
+            continue
+        sample_id = str(pred_data.get("id", ""))
+        pred_key = id_sort_key(sample_id)
+        if prev_pred_key is not None and pred_key < prev_pred_key:
+            raise ValueError(f"Prediction file is not sorted by id (line {line_idx}); use --join index instead.")
+        prev_pred_key = pred_key
+
+        while gt_key is not None and gt_key < pred_key:
+            gt_key, gt_data = next_gt()
+        if gt_key is None:
+            return
+        if gt_key == pred_key:
+            yield line_idx, sample_id, pred_data, gt_data
+
+    # 预测读完后仍把 GT 读完：排在后面的逆序记录也可能对应到较早的预测
+    while gt_key is not None:
+        gt_key, gt_data = next_gt()
+
+@timed("score")
+def calculate_metrics(predict_file, ground_truth_file, breakdown=False, outcomes=False, join="memory", index_file=None):
+    """
+    修改版本：支援 ID 匹配，自動跳過缺失或不對齊的數據。
+    breakdown=True 時在同一次掃描中累計 per-domain / per-intent / per-slot-key 統計
+    與 intent 混淆矩陣，結果放在回傳值的 "breakdown" 欄位 (需要 numpy)。
+    outcomes=True 時保留每個樣本的結果向量 ({"ids", "matrix"}，欄位見 OUTCOME_FIELDS)，
+    供 bootstrap_ci() / paired_significance() 使用 (需要 numpy)。
+    join 決定 GT 對齊方式："memory" (整份載入 dict)、"sorted" (merge-join)、
+    "index" (磁碟索引，見 GroundTruthIndex)；後兩者記憶體用量不隨資料量成長。
+    """
+    if outcomes:
+        _require_numpy("per-sample outcome vectors")
+    if join not in JOIN_MODES:
+        raise ValueError(f"Unknown join mode: {join}")
+    if not Path(ground_truth_file).exists():
+        print(f"Error: Ground truth file not found - {ground_truth_file}", file=sys.stderr)
+        sys.exit(1)
+
+    # 1. 讀取 Ground Truth 並建立索引
+    gt_map, gt_index = None, None
+    if join == "memory":
+        gt_map = load_ground_truth(ground_truth_file)
+        gt_records = gt_map.values()
+    else:
+        if join == "index":
+            gt_index = GroundTruthIndex(ground_truth_file, index_file)
+        gt_records = (data for _, data in iter_jsonl_records(ground_truth_file))
+    accumulator = BreakdownAccumulator(gt_records) if breakdown else None
+    outcome_ids = []
+    outcome_rows = array('q')
 
     # 2. 迭代處理 Prediction 檔案
     overall_match_count = 0
@@ -104,98 +762,196 @@ def calculate_metrics(predict_file, ground_truth_file):
     processed_count = 0
 
     try:
-        with open(predict_file, 'r', encoding='utf-8', errors='replace') as f_pred:
-            for line_idx, pred_line in enumerate(f_pred, 1):
+        with open(predict_file, 'rb') as f_pred:
+            if join == "sorted":
+                pairs = _iter_pairs_sorted(f_pred, ground_truth_file)
+            elif join == "index":
+                pairs = _iter_pairs_by_lookup(f_pred, gt_index.get)
+            else:
+                pairs = _iter_pairs_by_lookup(f_pred, gt_map.get)
+
+            for line_idx, sample_id, pred_data, gt_data in pairs:
                 try:
-                    pred_data = json.loads(pred_line.strip())
-                    sample_id = str(pred_data.get("id", ""))
-                    
-                    # 檢查 ID 是否存在於 Ground Truth 中
-                    if sample_id not in gt_map:
-                        # 這裡直接跳過，不中斷程式
-                        continue
-                    
-                    gt_data = gt_map[sample_id]
                     processed_count += 1
 
                     # --- 核心邏輯保持不變 ---
-                    pred_semantics = normalize_semantics(pred_data.get("semantics", []))
-                    gt_semantics = normalize_semantics(gt_data.get("semantics", []))
-                    
-                    # 1. Overall Accuracy
-                    if pred_semantics == gt_semantics:
-                        overall_match_count += 1
-                    
-                    # 2. Intent Accuracy
-                    pred_intents = sorted([(s.get("domain"), s.get("intent")) for s in pred_semantics])
-                    gt_intents = sorted([(s.get("domain"), s.get("intent")) for s in gt_semantics])
-                    if pred_intents == gt_intents:
-                        intent_match_count += 1
-
-                    # 3. Slot Metrics
-                    pred_slot_set = set()
-                    for s in pred_semantics:
-                        slots = s.get("slots", {})
-                        if isinstance(slots, dict):
-                            for k, v in slots.items():
-                                pred_slot_set.add((k, v))
-                    
-                    gt_slot_set = set()
-                    for s in gt_semantics:
-                        slots = s.get("slots", {})
-                        if isinstance(slots, dict):
-                            for k, v in slots.items():
-                                gt_slot_set.add((k, v))
-
+                    comparison = compare_semantics(
+                        normalize_semantics(pred_data.get("semantics", [])),
+                        normalize_semantics(gt_data.get("semantics", [])),
+                    )
+                    exact_match, intent_match, _, _, pred_slot_set, gt_slot_set = comparison
+                    overall_match_count += exact_match
+                    intent_match_count += intent_match
                     slot_tp += len(pred_slot_set.intersection(gt_slot_set))
                     slot_fp += len(pred_slot_set.difference(gt_slot_set))
                     slot_fn += len(gt_slot_set.difference(pred_slot_set))
 
-                except json.JSONDecodeError:
-                    print(f"Warning: JSON parse error at prediction line {line_idx}, skipped.", file=sys.stderr)
+                    if accumulator is not None:
+                        accumulator.add(*comparison)
+                    if outcomes:
+                        outcome_ids.append(sample_id)
+                        outcome_rows.extend((
+                            exact_match, intent_match,
+                            len(pred_slot_set.intersection(gt_slot_set)),
+                            len(pred_slot_set.difference(gt_slot_set)),
+                            len(gt_slot_set.difference(pred_slot_set)),
+                        ))
+
                 except Exception as e:
                     print(f"Warning: Unexpected error at line {line_idx}: {e}", file=sys.stderr)
 
     except FileNotFoundError as e:
         print(f"Error: Prediction file not found - {e}", file=sys.stderr)
         sys.exit(1)
+    except ValueError as e:
+        # --join sorted 時檔案未排序
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if gt_index is not None:
+            gt_index.close()
 
     # 檢查是否有成功匹配的數據
     if processed_count == 0:
         print("Error: No matching Sample IDs found between files.", file=sys.stderr)
         return {k: 0.0 for k in ["overall_accuracy", "intent_accuracy", "slot_f1"]} # 簡化返回
 
-    # --- 計算最終指標 (除數改為 processed_count) ---
-    overall_accuracy = overall_match_count / processed_count
-    intent_accuracy = intent_match_count / processed_count
+    results = summarize_counts(processed_count, overall_match_count, intent_match_count, slot_tp, slot_fp, slot_fn)
+    if accumulator is not None:
+        results["breakdown"] = accumulator.results()
+    if outcomes:
+        results["outcomes"] = {
+            "ids": outcome_ids,
+            "matrix": np.frombuffer(outcome_rows, dtype=np.int64).reshape(-1, len(OUTCOME_FIELDS)),
+        }
+    return results
 
-    slot_precision = slot_tp / (slot_tp + slot_fp) if (slot_tp + slot_fp) > 0 else 0.0
-    slot_recall = slot_tp / (slot_tp + slot_fn) if (slot_tp + slot_fn) > 0 else 0.0
-    slot_f1 = 2 * (slot_precision * slot_recall) / (slot_precision + slot_recall) if (slot_precision + slot_recall) > 0 else 0.0
+class StreamingEvaluator:
+    """
+    增量評分器：逐筆餵入預測結果，隨時取得目前的累計指標。
+    可在 slu_icl.py 行程內直接呼叫 update()，或透過 follow_predictions() 追蹤輸出檔。
+    """
 
-    return {
-        "total_count": processed_count, # 這是實際有對齊到的樣本數
-        "overall_match_count": overall_match_count,
-        "overall_accuracy": overall_accuracy,
-        "intent_match_count": intent_match_count,
-        "intent_accuracy": intent_accuracy,
-        "slot_tp": slot_tp, "slot_fp": slot_fp, "slot_fn": slot_fn,
-        "slot_precision": slot_precision,
-        "slot_recall": slot_recall,
-        "slot_f1": slot_f1,
-    }
+    METRIC_CHOICES = ["overall_accuracy", "intent_accuracy", "slot_f1"]
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Calculate NLU Evaluation Metrics (Multi-intent & Normalization supported)",
-        formatter_class=argparse.RawTextHelpFormatter
-    )
-    parser.add_argument("predict_file", help="Path to prediction .jsonl file")
-    parser.add_argument("ground_truth_file", help="Path to ground truth .jsonl file")
-    args = parser.parse_args()
+    def __init__(self, gt_map, early_stop_metric="overall_accuracy", early_stop_threshold=None, min_samples=100):
+        self.gt_map = gt_map
+        self.early_stop_metric = early_stop_metric
+        self.early_stop_threshold = early_stop_threshold
+        self.min_samples = min_samples
+        self.reset()
+
+    def reset(self):
+        self.seen_ids = set()
+        self.processed_count = 0
+        self.overall_match_count = 0
+        self.intent_match_count = 0
+        self.slot_tp, self.slot_fp, self.slot_fn = 0, 0, 0
+
+    def update(self, pred_data):
+        """
+        餵入一筆預測 (dict)。回傳是否有被計分 (不在 GT 中或重複的 id 會被略過)。
+        """
+        sample_id = str(pred_data.get("id", ""))
+        if sample_id not in self.gt_map or sample_id in self.seen_ids:
+            return False
+        self.seen_ids.add(sample_id)
+
+        exact_match, intent_match, tp, fp, fn = score_sample(
+            pred_data.get("semantics", []), self.gt_map[sample_id].get("semantics", [])
+        )
+        self.processed_count += 1
+        self.overall_match_count += exact_match
+        self.intent_match_count += intent_match
+        self.slot_tp += tp
+        self.slot_fp += fp
+        self.slot_fn += fn
+        return True
+
+    @property
+    def complete(self):
+        return self.processed_count >= len(self.gt_map)
 
-    results = calculate_metrics(args.predict_file, args.ground_truth_file)
+    def results(self):
+        return summarize_counts(
+            self.processed_count, self.overall_match_count, self.intent_match_count,
+            self.slot_tp, self.slot_fp, self.slot_fn,
+        )
 
+    def should_stop(self):
+        """
+        達到 min_samples 之後，若 early_stop_metric 低於門檻則回傳 True。
+        """
+        if self.early_stop_threshold is None or self.processed_count < self.min_samples:
+            return False
+        return self.results()[self.early_stop_metric] < self.early_stop_threshold
+
+    def progress_line(self):
+        r = self.results()
+        return (
+            f"[{self.processed_count}/{len(self.gt_map)}] "
+            f"acc={r['overall_accuracy']:.4f} intent_acc={r['intent_accuracy']:.4f} "
+            f"slot_p={r['slot_precision']:.4f} slot_r={r['slot_recall']:.4f} slot_f1={r['slot_f1']:.4f}"
+        )
+
+def follow_predictions(predict_file, evaluator, poll_interval=1.0, idle_timeout=None, report_every=50):
+    """
+    類似 `tail -f`：持續讀取推論中的預測檔並即時評分。
+    遇到以下情況結束並回傳原因: "complete" (所有 GT id 都已評分)、
+    "early_stop" (指標低於門檻)、"idle" (超過 idle_timeout 秒沒有新資料)。
+    """
+    predict_path = Path(predict_file)
+    last_activity = time.monotonic()
+
+    # 推論尚未開始寫檔時先等待
+    while not predict_path.exists():
+        if idle_timeout is not None and time.monotonic() - last_activity > idle_timeout:
+            return "idle"
+        time.sleep(poll_interval)
+
+    with open(predict_path, 'r', encoding='utf-8', errors='replace') as f_pred:
+        buffer = ""
+        line_idx = 0
+        while True:
+            chunk = f_pred.readline()
+            if not chunk:
+                if evaluator.complete:
+                    return "complete"
+                # 檔案被重新寫入 (推論重啟)：從頭開始計分
+                if predict_path.stat().st_size < f_pred.tell():
+                    print("Warning: Prediction file was truncated, restarting evaluation.", file=sys.stderr)
+                    f_pred.seek(0)
+                    buffer = ""
+                    line_idx = 0
+                    evaluator.reset()
+                    continue
+                if idle_timeout is not None and time.monotonic() - last_activity > idle_timeout:
+                    return "idle"
+                time.sleep(poll_interval)
+                continue
+
+            last_activity = time.monotonic()
+            buffer += chunk
+            # 寫入端尚未寫完整行，等下一輪再解析
+            if not buffer.endswith("\n"):
+                continue
+            pred_line, buffer = buffer, ""
+            line_idx += 1
+            if not pred_line.strip():
+                continue
+
+            try:
+                scored = evaluator.update(loads(pred_line))
+            except json.JSONDecodeError:
+                print(f"Warning: JSON parse error at prediction line {line_idx}, skipped.", file=sys.stderr)
+                continue
+
+            if scored and evaluator.processed_count % report_every == 0:
+                print(evaluator.progress_line(), flush=True)
+            if scored and evaluator.should_stop():
+                return "early_stop"
+
+def print_results(results):
     print("-" * 60)
     print(f"Evaluation Results (Normalization Enabled: Case/Punct/Num)")
     print("-" * 60)
@@ -216,5 +972,197 @@ def main():
     print(f"F1 Score:        {results['slot_f1']:.4f}")
     print("-" * 60)
 
+def print_breakdown(breakdown, top_k=10):
+    print("\n--- Per-Domain Accuracy ---")
+    print(f"{'Domain':<16}{'Support':>9}{'Acc':>9}{'IntentAcc':>11}")
+    for row in sorted(breakdown["domains"], key=lambda r: -r["support"]):
+        print(f"{row['domain']:<16}{row['support']:>9}{row['overall_accuracy']:>9.4f}{row['intent_accuracy']:>11.4f}")
+
+    print(f"\n--- Per-Intent Accuracy (top {top_k} by support) ---")
+    print(f"{'Domain/Intent':<24}{'Support':>9}{'Acc':>9}{'IntentAcc':>11}")
+    for row in sorted(breakdown["intents"], key=lambda r: -r["support"])[:top_k]:
+        label = f"{row['domain']}/{row['intent']}"
+        print(f"{label:<24}{row['support']:>9}{row['overall_accuracy']:>9.4f}{row['intent_accuracy']:>11.4f}")
+
+    print(f"\n--- Per-Slot-Key F1 (top {top_k} by support) ---")
+    print(f"{'Slot':<16}{'TP':>7}{'FP':>7}{'FN':>7}{'P':>9}{'R':>9}{'F1':>9}")
+    for row in sorted(breakdown["slot_keys"], key=lambda r: -(r["tp"] + r["fn"]))[:top_k]:
+        print(f"{row['slot']:<16}{row['tp']:>7}{row['fp']:>7}{row['fn']:>7}"
+              f"{row['precision']:>9.4f}{row['recall']:>9.4f}{row['f1']:>9.4f}")
+
+    # 混淆矩陣中最常見的非對角線錯誤
+    labels = breakdown["intent_confusion"]["labels"]
+    matrix = np.asarray(breakdown["intent_confusion"]["matrix"])
+    off_diag = matrix.copy()
+    np.fill_diagonal(off_diag, 0)
+    flat = np.argsort(off_diag, axis=None)[::-1][:top_k]
+    print(f"\n--- Top Intent Confusions ---")
+    for idx in flat:
+        row, col = divmod(int(idx), len(labels))
+        if off_diag[row, col] == 0:
+            break
+        print(f"{off_diag[row, col]:>6}  {labels[row]}  ->  {labels[col]}")
+    print("-" * 60)
+
+def print_confidence_intervals(intervals, confidence):
+    print(f"\n--- {confidence:.0%} Bootstrap Confidence Intervals ---")
+    for metric, (low, high) in intervals.items():
+        print(f"{metric:<18} [{low:.4f}, {high:.4f}]")
+    print("-" * 60)
+
+def print_significance(report, confidence):
+    print(f"\n--- Paired Comparison (B - A, {report['paired_count']} paired samples) ---")
+    print(f"{'Metric':<18}{'A':>9}{'B':>9}{'Delta':>10}  {confidence:.0%} CI{'':<12}{'p-value':>9}")
+    for metric in CI_METRICS:
+        row = report[metric]
+        low, high = row["ci"]
+        print(f"{metric:<18}{row['a']:>9.4f}{row['b']:>9.4f}{row['delta']:>+10.4f}  "
+              f"[{low:+.4f}, {high:+.4f}]{row['p_value']:>9.4f}")
+    print("-" * 60)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Calculate NLU Evaluation Metrics (Multi-intent & Normalization supported)",
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("predict_file", help="Path to prediction .jsonl file (or a results_store.py .parquet / .arrow run)")
+    parser.add_argument("ground_truth_file", help="Path to ground truth .jsonl file (or a results_store.py .parquet / .arrow run)")
+    parser.add_argument("--follow", action="store_true",
+                        help="Live mode: tail the prediction file while inference is still writing it")
+    parser.add_argument("--poll-interval", type=float, default=1.0,
+                        help="Seconds between polls in --follow mode")
+    parser.add_argument("--idle-timeout", type=float, default=None,
+                        help="Stop --follow mode after this many seconds without new predictions")
+    parser.add_argument("--report-every", type=int, default=50,
+                        help="Print running metrics every N scored predictions in --follow mode")
+    parser.add_argument("--early-stop-threshold", type=float, default=None,
+                        help="In --follow mode, exit with code 3 once the metric drops below this value")
+    parser.add_argument("--early-stop-metric", default="overall_accuracy", choices=StreamingEvaluator.METRIC_CHOICES,
+                        help="Metric checked against --early-stop-threshold")
+    parser.add_argument("--min-samples", type=int, default=100,
+                        help="Number of scored predictions before early stopping may trigger")
+    parser.add_argument("--breakdown", action="store_true",
+                        help="Print per-domain / per-intent accuracy, per-slot-key P/R/F1 and top intent confusions (needs numpy)")
+    parser.add_argument("--breakdown-json", default=None,
+                        help="Write the full breakdown (including the intent confusion matrix) to this JSON file")
+    parser.add_argument("--breakdown-csv-dir", default=None,
+                        help="Write domains.csv, intents.csv, slot_keys.csv and intent_confusion.csv to this directory")
+    parser.add_argument("--join", default="memory", choices=JOIN_MODES,
+                        help="How predictions are matched to ground truth:\n"
+                             "  memory: load the whole ground truth file into a dict (default)\n"
+                             "  sorted: streaming merge-join, both files must be sorted by id\n"
+                             "  index:  on-disk id -> offset index, built once and reused (any order)")
+    parser.add_argument("--index-file", default=None,
+                        help="Index path for --join index (default: <ground_truth_file>.idx)")
+    parser.add_argument("--output-json", default=None,
+                        help="Write the metrics and raw counts to this JSON file (e.g. per shard, see shard_util.py merge-metrics)")
+    parser.add_argument("--bootstrap", type=int, default=0,
+                        help="Number of bootstrap resamples for confidence intervals (0 = off, needs numpy)")
+    parser.add_argument("--compare", default=None,
+                        help="Second prediction file (B); runs a paired bootstrap and permutation test of B - A")
+    parser.add_argument("--confidence", type=float, default=0.95,
+                        help="Confidence level for --bootstrap / --compare intervals")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed for --bootstrap / --compare")
+    add_profile_args(parser)
+    args = parser.parse_args()
+    with profile_session(args):
+        run(args)
+
+COLUMNAR_SUFFIXES = (".parquet", ".arrow")
+
+def run_columnar(args):
+    """
+    任一输入为列式结果库档案 (results_store.py) 时：直接由正规化后的栏位评分，--compare 改印逐样本差异。
+    """
+    unsupported = [flag for flag, value in [
+        ("--follow", args.follow), ("--breakdown", args.breakdown or args.breakdown_json or args.breakdown_csv_dir),
+        ("--bootstrap", args.bootstrap > 0), ("--join", args.join != "memory"),
+    ] if value]
+    if unsupported:
+        print(f"Error: {', '.join(unsupported)} not supported with .parquet / .arrow inputs", file=sys.stderr)
+        sys.exit(2)
+    import results_store
+
+    try:
+        gt = results_store.load_samples(args.ground_truth_file)
+        pred = results_store.load_samples(args.predict_file)
+        pred_b = results_store.load_samples(args.compare) if args.compare else None
+    except (ImportError, FileNotFoundError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    results = results_store.score_samples(pred, gt)
+    print_results(results)
+    if pred_b is not None:
+        results["comparison"] = results_store.diff_samples(pred, pred_b, gt)
+        results_store.print_diff(results["comparison"], args.predict_file, args.compare)
+    if args.output_json:
+        with open(args.output_json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+def run(args):
+    if any(str(path).endswith(COLUMNAR_SUFFIXES) for path in (args.predict_file, args.ground_truth_file, args.compare) if path):
+        run_columnar(args)
+        return
+    if args.follow:
+        evaluator = StreamingEvaluator(
+            load_ground_truth(args.ground_truth_file),
+            early_stop_metric=args.early_stop_metric,
+            early_stop_threshold=args.early_stop_threshold,
+            min_samples=args.min_samples,
+        )
+        reason = follow_predictions(
+            args.predict_file, evaluator,
+            poll_interval=args.poll_interval,
+            idle_timeout=args.idle_timeout,
+            report_every=args.report_every,
+        )
+        print_results(evaluator.results())
+        if reason == "early_stop":
+            print(f"Early stop: {args.early_stop_metric} below {args.early_stop_threshold} "
+                  f"after {evaluator.processed_count} samples.", file=sys.stderr)
+            sys.exit(3)
+        return
+
+    want_breakdown = args.breakdown or args.breakdown_json or args.breakdown_csv_dir
+    want_outcomes = args.bootstrap > 0 or args.compare is not None
+    results = calculate_metrics(
+        args.predict_file, args.ground_truth_file,
+        breakdown=bool(want_breakdown), outcomes=want_outcomes,
+        join=args.join, index_file=args.index_file,
+    )
+    if "total_count" not in results:
+        # 沒有對齊到任何樣本 (calculate_metrics 已印出錯誤)
+        return
+    print_results(results)
+
+    n_resamples = args.bootstrap if args.bootstrap > 0 else 10000
+    if args.bootstrap > 0:
+        intervals = bootstrap_ci(results["outcomes"], n_resamples=n_resamples,
+                                 confidence=args.confidence, seed=args.seed)
+        results["confidence_intervals"] = intervals
+        print_confidence_intervals(intervals, args.confidence)
+    if args.compare:
+        results_b = calculate_metrics(args.compare, args.ground_truth_file, outcomes=True,
+                                      join=args.join, index_file=args.index_file)
+        if "outcomes" in results_b:
+            report = paired_significance(results["outcomes"], results_b["outcomes"], n_resamples=n_resamples,
+                                         confidence=args.confidence, seed=args.seed)
+            results["comparison"] = report
+            print_significance(report, args.confidence)
+
+    if args.output_json:
+        results.pop("outcomes", None)
+        with open(args.output_json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    if "breakdown" in results:
+        if args.breakdown:
+            print_breakdown(results["breakdown"])
+        if args.breakdown_json:
+            export_breakdown_json(results["breakdown"], args.breakdown_json)
+        if args.breakdown_csv_dir:
+            export_breakdown_csv(results["breakdown"], args.breakdown_csv_dir)
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,234 @@
+import argparse
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+# --- 各阶段的 profiling hooks ---
+# 以 stage("名称") / @timed("名称") 标记流程中的阶段 (音频编码、建立 messages、API 请求、JSON 抽取、写出...)。
+# 没有 --profile 时 stage() 回传共用的空 context manager，开销只有一次函数呼叫。
+
+PROFILE_MODES = ["stages", "cprofile", "sample"]
+
+_active: Optional["StageProfiler"] = None
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _StageTimer:
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler: "StageProfiler", name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class StageProfiler:
+    """
+    Thread-safe accumulator of wall-clock time per named stage.
+
+    Stages may nest (e.g. ``extract_json`` inside ``parse_frames``); each one
+    reports its own inclusive time, so totals are not meant to add up to the
+    run time. With concurrent requests a stage's total can exceed the wall
+    time of the run.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats: Dict[str, Dict[str, float]] = {}
+
+    def timer(self, name: str) -> _StageTimer:
+        return _StageTimer(self, name)
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            entry = self.stats.get(name)
+            if entry is None:
+                entry = self.stats[name] = {"count": 0, "total_s": 0.0, "max_s": 0.0}
+            entry["count"] += 1
+            entry["total_s"] += seconds
+            if seconds > entry["max_s"]:
+                entry["max_s"] = seconds
+
+    def summary(self, wall_s: float) -> Dict[str, object]:
+        with self._lock:
+            stages = {
+                name: {
+                    "count": int(entry["count"]),
+                    "total_s": round(entry["total_s"], 6),
+                    "mean_ms": round(entry["total_s"] / entry["count"] * 1000, 3),
+                    "max_ms": round(entry["max_s"] * 1000, 3),
+                    "share_of_wall": round(entry["total_s"] / wall_s, 4) if wall_s > 0 else 0.0,
+                }
+                for name, entry in sorted(self.stats.items(), key=lambda kv: -kv[1]["total_s"])
+            }
+        return {"wall_s": round(wall_s, 6), "stages": stages}
+
+
+def stage(name: str):
+    """
+    `with stage("request"):` 计时一个阶段；未启用 profiling 时不做任何事。
+    """
+    profiler = _active
+    if profiler is None:
+        return _NULL_STAGE
+    return _StageTimer(profiler, name)
+
+
+def timed(name: str) -> Callable:
+    """
+    函数版的 stage()：每次呼叫计入 `name` 阶段。
+    """
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            profiler = _active
+            if profiler is None:
+                return fn(*args, **kwargs)
+            with _StageTimer(profiler, name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class SamplingProfiler:
+    """
+    Wall-clock sampling profiler over all threads.
+
+    A daemon thread snapshots ``sys._current_frames()`` every `interval`
+    seconds and counts each stack, rooted at its thread name. Waiting threads
+    are sampled too, so time blocked on the network shows up where it is
+    spent. ``write_folded()`` emits the collapsed-stack format read by
+    flamegraph.pl, speedscope and inferno.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.counts: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.counts[";".join(reversed(stack))] += 1
+
+    def write_folded(self, path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.counts.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def add_profile_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--profile",
+        choices=PROFILE_MODES,
+        default=None,
+        help="记录各阶段耗时 (stages)，并可选对整个执行跑 cProfile (cprofile，只涵盖主线程) "
+             "或多线程取样 (sample，输出 flamegraph 用的 folded stacks)"
+    )
+    parser.add_argument(
+        "--profile-dir",
+        type=str,
+        default="profile",
+        help="--profile 的输出目录：stages.json，以及 profile.prof (cprofile) 或 profile.folded (sample)"
+    )
+    parser.add_argument(
+        "--profile-interval-ms",
+        type=float,
+        default=5.0,
+        help="--profile sample 的取样间隔 (毫秒)"
+    )
+
+
+def print_summary(summary: Dict[str, object]):
+    # 印到 stderr：metrics.py 等脚本没有设定 logging，stdout 则留给各脚本原本的输出
+    print(f"Profile: wall {summary['wall_s']:.3f}s", file=sys.stderr)
+    for name, entry in summary["stages"].items():
+        print(
+            f"  {name:<18} n={entry['count']:<8} total {entry['total_s']:9.3f}s  "
+            f"mean {entry['mean_ms']:9.3f}ms  max {entry['max_ms']:9.3f}ms  ({entry['share_of_wall']:.1%} of wall)",
+            file=sys.stderr,
+        )
+
+
+@contextmanager
+def session(args: argparse.Namespace):
+    """
+    依 args.profile 包住整个执行：启用阶段计时与选定的 profiler，结束时写出结果到 args.profile_dir。
+    """
+    global _active
+    mode = getattr(args, "profile", None)
+    if not mode:
+        yield
+        return
+
+    os.makedirs(args.profile_dir, exist_ok=True)
+    _active = StageProfiler()
+    runner = None
+    if mode == "cprofile":
+        import cProfile
+        runner = cProfile.Profile()
+        runner.enable()
+    elif mode == "sample":
+        runner = SamplingProfiler(args.profile_interval_ms / 1000)
+        runner.start()
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall_s = time.perf_counter() - start
+        if mode == "cprofile":
+            runner.disable()
+            runner.dump_stats(os.path.join(args.profile_dir, "profile.prof"))
+        elif mode == "sample":
+            runner.stop()
+            runner.write_folded(os.path.join(args.profile_dir, "profile.folded"))
+        summary = _active.summary(wall_s)
+        _active = None
+        with open(os.path.join(args.profile_dir, "stages.json"), 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print_summary(summary)
+        print(f"Profile written to {args.profile_dir}", file=sys.stderr)
@@ -0,0 +1,438 @@
+import argparse
+import csv
+import json
+import logging
+import sys
+import time
+from itertools import groupby
+from operator import itemgetter
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from jsonl_io import JSONDecodeError, iter_lines, loads
+from metrics import normalize_semantics, summarize_counts
+
+# --- 列式结果库 (Arrow / Parquet) ---
+# 每次推理 (run) 写成结果库目录下的一个档案：<store>/<run>.parquet 或 <run>.arrow (Arrow IPC，可 memory-map)。
+# 每列是一个 (语义帧, 槽位) 组合：id, frame_index, domain, intent, slot_key, slot_value，
+# 值都已经过 metrics.normalize_text 正规化，评分与比较时不必再解析 JSON、也不必再正规化。
+#   - 没有槽位的语义帧占一列 (slot_key / slot_value 为 null)
+#   - 没有语义帧的样本也占一列 (frame_index 为 null)，样本不会从分母消失
+#   - 缺少 slots 键与空 slots 视为相同 (JSONL 评分中两者的 exact match 不同，实际输出不会出现)
+# run 的中继资料 (模型、n-shot、输入档、建立时间、样本数...) 以 JSON 存在 schema metadata 的 "mac_slu.run" 键。
+# 标注档也可以写成一个 run，之后对数百个 run 评分只需读取列式档案。
+
+# pyarrow 为选用依赖，第一次用到时才载入
+pa = None
+
+COLUMNS = ["id", "frame_index", "domain", "intent", "slot_key", "slot_value"]
+METADATA_KEY = b"mac_slu.run"
+FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+
+# slu_icl.py 写入 run 中继资料的参数 (不含 api_key 等敏感设定)
+RUN_ARG_KEYS = [
+    "input_file", "output_file", "audio_dir", "provider", "model_name", "stage", "n_shot",
+    "train_input_file", "train_audio_dir", "seed", "temperature", "max_tokens", "self_consistency",
+    "pack_size", "audio_transport", "fast_path", "fast_path_table", "shard",
+]
+
+
+def _require_pyarrow(purpose: str):
+    global pa
+    if pa is None:
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError(f"pyarrow is needed for {purpose}: pip install pyarrow") from None
+        pa = pyarrow
+    return pa
+
+
+def _schema():
+    return pa.schema([
+        ("id", pa.string()),
+        ("frame_index", pa.int32()),
+        ("domain", pa.string()),
+        ("intent", pa.string()),
+        ("slot_key", pa.string()),
+        ("slot_value", pa.string()),
+    ])
+
+
+def flatten_record(record: Dict[str, Any]) -> List[Tuple]:
+    """
+    一笔预测 / 标注记录 -> 正规化后的列 (依 COLUMNS 的顺序)；帧内槽位依键排序，同样的语义帧永远产生同样的列。
+    """
+    sample_id = str(record.get("id", ""))
+    rows = []
+    for index, frame in enumerate(normalize_semantics(record.get("semantics", []))):
+        domain, intent = frame.get("domain"), frame.get("intent")
+        slots = frame.get("slots")
+        if isinstance(slots, dict) and slots:
+            rows.extend((sample_id, index, domain, intent, key, value) for key, value in sorted(slots.items()))
+        else:
+            rows.append((sample_id, index, domain, intent, None, None))
+    return rows or [(sample_id, None, None, None, None, None)]
+
+
+def run_path(store: str, run: str, fmt: str = "parquet") -> Path:
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown results store format: {fmt}")
+    return Path(store) / f"{run}{FORMATS[fmt]}"
+
+
+def run_metadata_from_args(args: argparse.Namespace, script: str) -> Dict[str, Any]:
+    metadata = {"script": script}
+    for key in RUN_ARG_KEYS:
+        value = getattr(args, key, None)
+        metadata[key] = str(value) if isinstance(value, Path) else value
+    return metadata
+
+
+class RunWriter:
+    """
+    Collects one run's records as flattened, normalized columns.
+
+    Rows are buffered per column and written on ``close()``, so the sample
+    count and any metadata added while the run was going end up in the
+    file's schema metadata. The format follows the path suffix: ``.parquet``
+    (zstd-compressed) or ``.arrow`` (Arrow IPC file, memory-mapped when read).
+    The file is written under a temporary name and renamed, so scans never
+    see a partial run.
+    """
+
+    def __init__(self, path: str, run: Optional[str] = None, metadata: Optional[Dict[str, Any]] = None):
+        _require_pyarrow("the columnar results store")
+        self.path = Path(path)
+        if self.path.suffix not in FORMATS.values():
+            raise ValueError(f"Results store files must end in .parquet or .arrow: {self.path}")
+        self.metadata = {"run": run or self.path.stem, **(metadata or {})}
+        self.columns: Dict[str, List[Any]] = {name: [] for name in COLUMNS}
+        self.samples = 0
+
+    def add(self, record: Dict[str, Any]):
+        rows = flatten_record(record)
+        for name, values in zip(COLUMNS, zip(*rows)):
+            self.columns[name].extend(values)
+        self.samples += 1
+
+    def close(self) -> Path:
+        self.metadata.setdefault("created", time.strftime("%Y-%m-%dT%H:%M:%S"))
+        self.metadata["samples"] = self.samples
+        schema = _schema().with_metadata({METADATA_KEY: json.dumps(self.metadata, ensure_ascii=False).encode("utf-8")})
+        table = pa.Table.from_pydict(self.columns, schema=schema)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        if self.path.suffix == ".parquet":
+            import pyarrow.parquet as pq
+            # 高度重复的字串栏位使用字典编码，档案小、读取快
+            pq.write_table(table, tmp_path, compression="zstd", use_dictionary=True)
+        else:
+            import pyarrow.feather as feather
+            feather.write_feather(table, tmp_path, compression="zstd")
+        tmp_path.replace(self.path)
+        return self.path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        return False
+
+
+def import_jsonl(jsonl_file: str, path: str, run: Optional[str] = None,
+                 metadata: Optional[Dict[str, Any]] = None) -> int:
+    """
+    把既有的预测 / 标注 JSONL 转成列式档案，回传样本数。
+    """
+    metadata = {"source": str(jsonl_file), **(metadata or {})}
+    with RunWriter(path, run=run, metadata=metadata) as writer, open(jsonl_file, 'rb') as f:
+        for line in iter_lines(f):
+            if not line.strip():
+                continue
+            try:
+                record = loads(line)
+            except JSONDecodeError:
+                continue
+            if isinstance(record, dict) and record.get("id"):
+                writer.add(record)
+    return writer.samples
+
+
+def _read_table(path: Path):
+    _require_pyarrow("reading the columnar results store")
+    if path.suffix == ".parquet":
+        import pyarrow.parquet as pq
+        return pq.read_table(path, columns=COLUMNS)
+    import pyarrow.feather as feather
+    return feather.read_table(path, columns=COLUMNS, memory_map=True)
+
+
+def read_metadata(path: str) -> Dict[str, Any]:
+    """
+    只读取 schema (不读资料) 取得 run 中继资料。
+    """
+    _require_pyarrow("reading the columnar results store")
+    path = Path(path)
+    if path.suffix == ".parquet":
+        import pyarrow.parquet as pq
+        schema = pq.read_schema(path)
+    else:
+        with pa.memory_map(str(path)) as source:
+            schema = pa.ipc.open_file(source).schema
+    raw = (schema.metadata or {}).get(METADATA_KEY)
+    return json.loads(raw) if raw else {"run": path.stem}
+
+
+def list_runs(store: str) -> Dict[str, Path]:
+    """
+    结果库中的 run 名称 -> 档案路径 (依名称排序)。
+    """
+    paths = sorted(p for suffix in FORMATS.values() for p in Path(store).glob(f"*{suffix}"))
+    return {p.stem: p for p in paths}
+
+
+def group_samples(ids: Iterable[str], frame_indices: Iterable[Optional[int]], domains: Iterable[Optional[str]],
+                  intents: Iterable[Optional[str]], slot_keys: Iterable[Optional[str]],
+                  slot_values: Iterable[Optional[str]]) -> Dict[str, Tuple]:
+    """
+    由各栏位重建每个样本的列：id -> 该样本所有列的元组。同一样本的列须相邻 (RunWriter 的写入顺序)。
+    flatten_record 产生的列是标准形式 (语义帧依序、帧内槽位依键排序)，所以两个样本的列元组相等
+    即代表正规化后的语义帧完全相同；意图与槽位集合只在评分需要时才由列推导。
+    """
+    rows = zip(ids, frame_indices, domains, intents, slot_keys, slot_values)
+    return {sample_id: tuple(group) for sample_id, group in groupby(rows, key=itemgetter(0))}
+
+
+def _intents(rows: Tuple) -> List[Tuple]:
+    """样本的 (domain, intent) 排序列表，同 metrics.compare_semantics。"""
+    frames = dict.fromkeys(row[1:4] for row in rows if row[1] is not None)
+    return sorted(((domain, intent) for _, domain, intent in frames), key=lambda pair: (pair[0] or "", pair[1] or ""))
+
+
+def _slot_set(rows: Tuple) -> set:
+    return {(row[4], row[5]) for row in rows if row[4] is not None}
+
+
+def load_samples(path: str) -> Dict[str, Tuple]:
+    """
+    读取一个 run 的比较签名。.jsonl 档案会当场正规化 (与 metrics.py 相同的成本)，列式档案则直接读取。
+    """
+    path = Path(path)
+    if path.suffix in FORMATS.values():
+        table = _read_table(path)
+        return group_samples(*(table.column(name).to_pylist() for name in COLUMNS))
+    rows = []
+    with open(path, 'rb') as f:
+        for line in iter_lines(f):
+            if not line.strip():
+                continue
+            try:
+                record = loads(line)
+            except JSONDecodeError:
+                continue
+            if isinstance(record, dict) and record.get("id"):
+                rows.extend(flatten_record(record))
+    return group_samples(*(zip(*rows) if rows else [()] * len(COLUMNS)))
+
+
+def score_samples(pred: Dict[str, Tuple], gt: Dict[str, Tuple]) -> Dict[str, Any]:
+    """
+    对齐到标注的预测样本的指标 (格式同 metrics.calculate_metrics)。完全相同的样本只需计算槽位数。
+    """
+    processed = exact = intent = tp = fp = fn = 0
+    for sample_id, pred_rows in pred.items():
+        gt_rows = gt.get(sample_id)
+        if gt_rows is None:
+            continue
+        processed += 1
+        if pred_rows == gt_rows:
+            exact += 1
+            intent += 1
+            tp += len(_slot_set(pred_rows))
+            continue
+        intent += _intents(pred_rows) == _intents(gt_rows)
+        pred_slots, gt_slots = _slot_set(pred_rows), _slot_set(gt_rows)
+        hits = len(pred_slots & gt_slots)
+        tp += hits
+        fp += len(pred_slots) - hits
+        fn += len(gt_slots) - hits
+    return summarize_counts(processed, exact, intent, tp, fp, fn)
+
+
+def diff_samples(pred_a: Dict[str, Tuple], pred_b: Dict[str, Tuple], gt: Dict[str, Tuple]) -> Dict[str, Any]:
+    """
+    比较两个 run 在共同样本上的差异 (B 相对于 A)：
+    fixed 为 A 错 B 对、broken 为 A 对 B 错 (以 exact match 判定)，changed 为输出不同的样本数，
+    另附两边的指标与差值。
+    """
+    common = {sample_id: gt[sample_id] for sample_id in pred_a.keys() & pred_b.keys() if sample_id in gt}
+    fixed, broken, changed = [], [], 0
+    for sample_id, gt_rows in common.items():
+        rows_a, rows_b = pred_a[sample_id], pred_b[sample_id]
+        if rows_a == rows_b:
+            continue
+        changed += 1
+        if rows_b == gt_rows:
+            fixed.append(sample_id)
+        elif rows_a == gt_rows:
+            broken.append(sample_id)
+    score_a = score_samples({k: pred_a[k] for k in common}, common)
+    score_b = score_samples({k: pred_b[k] for k in common}, common)
+    delta = {key: score_b[key] - score_a[key] for key in score_a if key != "total_count"}
+    return {
+        "common_count": len(common),
+        "changed_count": changed,
+        "fixed_count": len(fixed),
+        "broken_count": len(broken),
+        "fixed_ids": sorted(fixed),
+        "broken_ids": sorted(broken),
+        "a": score_a,
+        "b": score_b,
+        "delta": delta,
+    }
+
+
+def score_paths(predict_file: str, ground_truth_file: str) -> Dict[str, Any]:
+    """
+    metrics.py 的列式入口：任一边可为 .parquet / .arrow 或 .jsonl。
+    """
+    return score_samples(load_samples(predict_file), load_samples(ground_truth_file))
+
+
+def scan_store(store: str, ground_truth: str, runs: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """
+    对结果库中的 run (预设全部，标注 run 除外) 评分；标注只读取一次。
+    """
+    available = list_runs(store)
+    gt_path = Path(ground_truth) if Path(ground_truth).exists() else available.get(ground_truth)
+    if gt_path is None:
+        raise FileNotFoundError(f"Ground truth not found as a file or as a run in {store}: {ground_truth}")
+    gt = load_samples(gt_path)
+    rows = []
+    for run in runs or [name for name, path in available.items() if path != gt_path]:
+        if run not in available:
+            logging.warning(f"结果库中没有 run: {run}")
+            continue
+        start = time.perf_counter()
+        row = {"run": run, **read_metadata(available[run])}
+        row.update(score_samples(load_samples(available[run]), gt))
+        row["scan_seconds"] = round(time.perf_counter() - start, 4)
+        rows.append(row)
+    return rows
+
+
+def _resolve(store: Optional[str], spec: str) -> Path:
+    """run 名称 (结果库中) 或档案路径。"""
+    if Path(spec).exists():
+        return Path(spec)
+    path = list_runs(store).get(spec) if store else None
+    if path is None:
+        raise FileNotFoundError(f"No such run or file: {spec}")
+    return path
+
+
+def print_scan(rows: List[Dict[str, Any]], columns: List[str]):
+    """依 overall_accuracy 由高到低印出各 run 的指标。"""
+    metric_columns = ["overall_accuracy", "intent_accuracy", "slot_f1", "total_count"]
+    header = ["run"] + columns + metric_columns
+    table = [[str(row.get(key, "")) for key in ["run"] + columns]
+             + [f"{row[col]:.4f}" if isinstance(row.get(col), float) else str(row.get(col, "")) for col in metric_columns]
+             for row in sorted(rows, key=lambda r: -r.get("overall_accuracy", 0.0))]
+    widths = [max(len(h), *(len(line[i]) for line in table)) for i, h in enumerate(header)] if table else [len(h) for h in header]
+    print("  ".join(h.ljust(w) for h, w in zip(header, widths)))
+    for line in table:
+        print("  ".join(cell.ljust(w) for cell, w in zip(line, widths)))
+
+
+def print_diff(report: Dict[str, Any], name_a: str, name_b: str, top_k: int = 20):
+    print("-" * 60)
+    print(f"Run diff: B={name_b} vs A={name_a} on {report['common_count']} common samples")
+    print("-" * 60)
+    for key in ["overall_accuracy", "intent_accuracy", "slot_precision", "slot_recall", "slot_f1"]:
+        print(f"{key:<18} A {report['a'][key]:.4f}  B {report['b'][key]:.4f}  delta {report['delta'][key]:+.4f}")
+    print(f"Changed outputs: {report['changed_count']}  fixed (A wrong, B right): {report['fixed_count']}  "
+          f"broken (A right, B wrong): {report['broken_count']}")
+    for label, key in [("Fixed", "fixed_ids"), ("Broken", "broken_ids")]:
+        if report[key]:
+            shown = report[key][:top_k]
+            more = f" ... (+{len(report[key]) - len(shown)})" if len(report[key]) > len(shown) else ""
+            print(f"{label} ids: {', '.join(shown)}{more}")
+    print("-" * 60)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Columnar (Arrow / Parquet) store of predictions for scoring and comparing many runs")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p_import = subparsers.add_parser("import", help="Convert a prediction or ground truth JSONL into a run in the store")
+    p_import.add_argument("jsonl_file", help="Prediction or ground truth .jsonl file")
+    p_import.add_argument("--store", required=True, help="Results store directory")
+    p_import.add_argument("--run", default=None, help="Run name (default: file stem)")
+    p_import.add_argument("--format", default="parquet", choices=list(FORMATS))
+    p_import.add_argument("--meta", action="append", default=[], metavar="KEY=VALUE",
+                          help="Extra run metadata (repeatable)")
+
+    p_list = subparsers.add_parser("list", help="List runs and their metadata")
+    p_list.add_argument("--store", required=True)
+
+    p_score = subparsers.add_parser("score", help="Score runs against ground truth straight from the columnar files")
+    p_score.add_argument("--store", required=True)
+    p_score.add_argument("--ground-truth", required=True,
+                         help="Ground truth run name in the store, or a .parquet / .arrow / .jsonl file")
+    p_score.add_argument("--runs", nargs="*", default=None, help="Runs to score (default: all except the ground truth)")
+    p_score.add_argument("--columns", default="model_name,n_shot,stage,temperature",
+                         help="Comma-separated metadata keys shown in the table")
+    p_score.add_argument("--output-json", default=None, help="Write all rows (metadata + metrics) to this JSON file")
+    p_score.add_argument("--output-csv", default=None, help="Write all rows to this CSV file")
+
+    p_diff = subparsers.add_parser("diff", help="Compare two runs sample by sample")
+    p_diff.add_argument("run_a", help="Run name or file (A, baseline)")
+    p_diff.add_argument("run_b", help="Run name or file (B)")
+    p_diff.add_argument("--store", default=None)
+    p_diff.add_argument("--ground-truth", required=True, help="Ground truth run name or file")
+    p_diff.add_argument("--top-k", type=int, default=20, help="Number of fixed / broken ids printed")
+    p_diff.add_argument("--output-json", default=None, help="Write the full report (all ids) to this JSON file")
+
+    args = parser.parse_args()
+    try:
+        if args.command == "import":
+            metadata = dict(item.split("=", 1) for item in args.meta)
+            path = run_path(args.store, args.run or Path(args.jsonl_file).stem, args.format)
+            samples = import_jsonl(args.jsonl_file, path, run=args.run, metadata=metadata)
+            logging.info(f"已写入 {samples} 个样本到 {path}")
+        elif args.command == "list":
+            for run, path in list_runs(args.store).items():
+                print(f"{run}\t{json.dumps(read_metadata(path), ensure_ascii=False)}")
+        elif args.command == "score":
+            start = time.perf_counter()
+            rows = scan_store(args.store, args.ground_truth, args.runs)
+            logging.info(f"已评分 {len(rows)} 个 run, 耗时 {time.perf_counter() - start:.2f}s")
+            print_scan(rows, [c for c in args.columns.split(",") if c])
+            if args.output_json:
+                with open(args.output_json, 'w', encoding='utf-8') as f:
+                    json.dump(rows, f, ensure_ascii=False, indent=2)
+            if args.output_csv:
+                fieldnames = list(dict.fromkeys(key for row in rows for key in row))
+                with open(args.output_csv, 'w', encoding='utf-8', newline='') as f:
+                    writer = csv.DictWriter(f, fieldnames=fieldnames)
+                    writer.writeheader()
+                    writer.writerows(rows)
+        else:
+            gt = load_samples(_resolve(args.store, args.ground_truth))
+            report = diff_samples(load_samples(_resolve(args.store, args.run_a)),
+                                  load_samples(_resolve(args.store, args.run_b)), gt)
+            print_diff(report, args.run_a, args.run_b, top_k=args.top_k)
+            if args.output_json:
+                with open(args.output_json, 'w', encoding='utf-8') as f:
+                    json.dump(report, f, ensure_ascii=False, indent=2)
+    except (ImportError, FileNotFoundError, ValueError) as e:
+        logging.error(str(e))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
@@ -0,0 +1,54 @@
+import json
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+from metrics import normalize_semantics
+
+# --- Self-consistency 投票 ---
+# 同一个请求以 n=K 取得 K 个采样 (prompt 只 prefill 一次)，再对正规化后的语义帧逐帧多数决。
+
+
+def frame_key(frame: Dict[str, Any]) -> Optional[str]:
+    """
+    正规化后的 (domain, intent, slots) 作为投票用的 key；非 dict 的帧回传 None。
+    """
+    normalized = normalize_semantics([frame])
+    if not normalized:
+        return None
+    return json.dumps(normalized[0], ensure_ascii=False, sort_keys=True)
+
+
+def vote_frames(samples: List[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """
+    Majority vote over the semantic frames of K samples.
+
+    A frame is kept when it appears (after normalization) in more than half
+    of the samples; duplicates within one sample count once. Kept frames are
+    returned in first-seen order, as they were first emitted. If no frame
+    reaches a majority, the most common whole frame set wins instead.
+    """
+    if not samples:
+        return []
+
+    counts = Counter()
+    first_seen: Dict[str, Dict[str, Any]] = {}
+    set_counts = Counter()
+    set_first: Dict[str, List[Dict[str, Any]]] = {}
+    for frames in samples:
+        keys = []
+        for frame in frames:
+            key = frame_key(frame)
+            if key is None or key in keys:
+                continue
+            keys.append(key)
+            first_seen.setdefault(key, frame)
+        counts.update(keys)
+        set_key = json.dumps(sorted(keys), ensure_ascii=False)
+        set_counts[set_key] += 1
+        set_first.setdefault(set_key, frames)
+
+    voted = [frame for key, frame in first_seen.items() if counts[key] * 2 > len(samples)]
+    if voted:
+        return voted
+    # Counter.most_common 在同票时保留先出现的顺序
+    return set_first[set_counts.most_common(1)[0][0]]
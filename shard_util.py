@@ -0,0 +1,175 @@
+import argparse
+import json
+import logging
+import sys
+import zlib
+from typing import Iterable, List, Optional, Tuple
+
+from jsonl_io import JsonlWriter, iter_lines, loads
+from profiling import add_profile_args, session as profile_session, stage
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# --- 多機分片 ---
+# --shard i/N：以 id 的穩定雜湊決定每筆資料屬於哪個分片，不需要任何協調服務。
+# 同一份輸入在任何機器、任何 Python 版本上切出的分片都相同 (不使用內建 hash())。
+
+Shard = Tuple[int, int]
+
+
+def parse_shard(spec: str) -> Shard:
+    """
+    argparse type：解析 "i/N" (0 <= i < N)。
+    """
+    try:
+        index, count = (int(x) for x in spec.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"shard must look like i/N, got {spec!r}")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"shard index must satisfy 0 <= i < N, got {spec!r}")
+    return index, count
+
+
+def shard_of(item_id, count: int) -> int:
+    return zlib.crc32(str(item_id).encode("utf-8")) % count
+
+
+def in_shard(item_id, shard: Optional[Shard]) -> bool:
+    if shard is None:
+        return True
+    index, count = shard
+    return shard_of(item_id, count) == index
+
+
+def filter_shard_lines(lines: Iterable[str], shard: Optional[Shard]) -> List[str]:
+    """
+    只保留屬於此分片的 JSONL 行；無法解析的行交給各腳本原本的錯誤處理 (只保留在分片 0)。
+    """
+    lines = list(lines)
+    if shard is None:
+        return lines
+    kept = []
+    for line in lines:
+        try:
+            item_id = loads(line).get("id")
+        except (json.JSONDecodeError, AttributeError):
+            if shard[0] == 0:
+                kept.append(line)
+            continue
+        if in_shard(item_id, shard):
+            kept.append(line)
+    logging.info(f"Shard {shard[0]}/{shard[1]}: {len(kept)} / {len(lines)} lines")
+    return kept
+
+
+def id_sort_key(item_id: str):
+    # 純數字 id 依數值排序，其餘依字串排序並排在數字之後
+    return (0, int(item_id), "") if item_id.isdigit() else (1, 0, item_id)
+
+
+def merge_outputs(shard_files: List[str], output_file: str, reference_file: Optional[str] = None) -> dict:
+    """
+    合併各分片的 JSONL 輸出並依 id 排序 (有 reference_file 時依其順序)。
+    回傳重複與缺少的 id 統計；重複 id 只保留第一次出現的紀錄。
+    """
+    records = {}
+    duplicates = []
+    for shard_file in shard_files:
+        with open(shard_file, 'rb') as f:
+            for line_idx, line in enumerate(iter_lines(f), 1):
+                if not line.strip():
+                    continue
+                try:
+                    item_id = str(loads(line).get("id", ""))
+                except json.JSONDecodeError:
+                    logging.warning(f"{shard_file}:{line_idx} is not valid JSON, skipped.")
+                    continue
+                if item_id in records:
+                    duplicates.append(item_id)
+                    continue
+                records[item_id] = line + b"\n"
+
+    missing = []
+    if reference_file:
+        order = []
+        with open(reference_file, 'rb') as f:
+            for line in iter_lines(f):
+                try:
+                    order.append(str(loads(line).get("id", "")))
+                except json.JSONDecodeError:
+                    continue
+        missing = [item_id for item_id in order if item_id not in records]
+        extra = sorted(set(records) - set(order), key=id_sort_key)
+        order = [item_id for item_id in order if item_id in records] + extra
+    else:
+        order = sorted(records, key=id_sort_key)
+
+    with JsonlWriter(output_file) as f_out:
+        for item_id in order:
+            f_out.write_raw(records[item_id])
+
+    if duplicates:
+        logging.warning(f"{len(duplicates)} duplicate ids (kept first occurrence): {duplicates[:20]}")
+    if missing:
+        logging.warning(f"{len(missing)} ids missing from shard outputs: {missing[:20]}")
+    logging.info(f"Merged {len(records)} records from {len(shard_files)} files into {output_file}")
+    return {"merged": len(records), "duplicates": duplicates, "missing": missing}
+
+
+def merge_metrics(metrics_files: List[str]) -> dict:
+    """
+    合併各分片 `metrics.py --output-json` 的結果：加總計數後重新計算指標，不重新評分。
+    """
+    from metrics import summarize_counts
+
+    totals = {k: 0 for k in ["total_count", "overall_match_count", "intent_match_count", "slot_tp", "slot_fp", "slot_fn"]}
+    for metrics_file in metrics_files:
+        with open(metrics_file, 'r', encoding='utf-8') as f:
+            results = json.load(f)
+        for key in totals:
+            totals[key] += int(results.get(key, 0))
+    return summarize_counts(
+        totals["total_count"], totals["overall_match_count"], totals["intent_match_count"],
+        totals["slot_tp"], totals["slot_fp"], totals["slot_fn"],
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge sharded MAC-SLU outputs and metrics")
+    add_profile_args(parser)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    merge_parser = subparsers.add_parser("merge", help="Merge shard output JSONL files in id order")
+    merge_parser.add_argument("inputs", nargs="+", help="Shard output JSONL files")
+    merge_parser.add_argument("--output-file", required=True, help="Merged JSONL file path")
+    merge_parser.add_argument("--reference-file", default=None,
+                              help="Original input JSONL; output follows its order and missing ids are reported")
+    merge_parser.add_argument("--strict", action="store_true",
+                              help="Exit with code 1 if any id is duplicated or missing")
+
+    metrics_parser = subparsers.add_parser("merge-metrics", help="Sum per-shard metrics JSON (from metrics.py --output-json)")
+    metrics_parser.add_argument("inputs", nargs="+", help="Per-shard metrics JSON files")
+    metrics_parser.add_argument("--output-json", default=None, help="Write the combined metrics to this JSON file")
+
+    args = parser.parse_args()
+    with profile_session(args):
+        run(args)
+
+
+def run(args: argparse.Namespace):
+    if args.command == "merge":
+        with stage("merge"):
+            report = merge_outputs(args.inputs, args.output_file, args.reference_file)
+        if args.strict and (report["duplicates"] or report["missing"]):
+            sys.exit(1)
+    else:
+        from metrics import print_results
+        results = merge_metrics(args.inputs)
+        print_results(results)
+        if args.output_json:
+            with open(args.output_json, 'w', encoding='utf-8') as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
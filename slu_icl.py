@@ -1,29 +1,53 @@
 import argparse
+import hashlib
 import json
 import logging
-import base64
+import copy
 import os
-import requests
-import random
+import re
+import threading
+import time
 
+from contextlib import nullcontext
+from importlib.util import find_spec
+from functools import lru_cache
 from pathlib import Path
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple
+from urllib.parse import urlparse
 
-# --- 新增 ---: 导入 OpenAI 库用于本地接口调用
-try:
-    from openai import OpenAI
-except ImportError:
-    # 如果用户不使用本地模式，这个库不是必需的
-    OpenAI = None 
+from dispatch import (
+    CircuitBreaker, EndpointPool, RetryableError, RetryScheduler,
+    is_retryable, ordered_map, parse_endpoints, wait_until_ready,
+)
+from shard_util import filter_shard_lines, parse_shard
+from audio_util import (
+    add_dispatch_order_args, describe_durations, duration_order, line_audio_durations, wav_duration_seconds,
+)
+from token_budget import TokenBudget
+from fast_path import ExactMatchTable, is_correct
+from self_consistency import vote_frames
+from jsonl_io import JsonlWriter, dumps_line, loads
+from profiling import add_profile_args, session as profile_session, stage, timed
+import telemetry
+
+# openai 与 tqdm 载入较慢，只在真正呼叫本地接口 / 显示进度条时才载入
+def load_openai():
+    try:
+        from openai import OpenAI
+    except ImportError:
+        # 如果用户不使用本地模式，这个库不是必需的
+        raise ImportError("OpenAI module is needed on calling local api: pip install openai") from None
+    return OpenAI
 
 # 使用 tqdm 显示进度条
-try:
-    from tqdm import tqdm
-except ImportError:
-    def tqdm(iterable, **kwargs):
+def tqdm(iterable, **kwargs):
+    try:
+        from tqdm import tqdm as _tqdm
+    except ImportError:
         print("tqdm is not installed, progress bar will not be shown. "
               "Install it with: pip install tqdm")
         return iterable
+    return _tqdm(iterable, **kwargs)
 
 # --- 日志配置 ---
 logging.basicConfig(
@@ -329,7 +353,10 @@ SLOT_LIST = """
 
 # --- 【核心修改】合并后的系统提示 ---
 # 指导LLM同时执行意图识别和槽位填充，并输出统一的列表格式
-SYSTEM_PROMPT_TEMPLATE = f"""
+# 第一次使用时才组出完整提示词 (只跑 metrics / 数据转换时不需要)
+@lru_cache(maxsize=None)
+def system_prompt() -> str:
+    return f"""
 你是一个专业的车载系统自然语言理解（NLU）专家。
 你的任务是基于用户的查询（Query），同时完成两项任务：
 1.  **意图识别 (Intent Classification)**: 识别出查询中包含的所有领域（Domain）和意图（Intent）。
@@ -358,6 +385,14 @@ SYSTEM_PROMPT_TEMPLATE = f"""
 
 """
 
+
+def __getattr__(name: str) -> Any:
+    # 相容旧的 SYSTEM_PROMPT_TEMPLATE 常数
+    if name == "SYSTEM_PROMPT_TEMPLATE":
+        return system_prompt()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 def setup_arg_parser() -> argparse.ArgumentParser:
     """设置命令行参数解析器"""
     parser = argparse.ArgumentParser(description="使用 LLM API 进行统一的语音语言理解 (SLU)")
@@ -383,8 +418,85 @@ def setup_arg_parser() -> argparse.ArgumentParser:
     parser.add_argument(
         "--api-base",
         type=str,
-        default="http://0.0.0.0:12355/v1",
-        help="本地LLM服务的API基地址 (仅当 --provider='local' 时使用)"
+        nargs="+",
+        default=["http://0.0.0.0:12355/v1"],
+        help="本地LLM服务的API基地址 (仅当 --provider='local' 时使用)。可传入多个 (空格或逗号分隔) 进行负载平衡"
+    )
+    parser.add_argument(
+        "--lb-policy",
+        type=str,
+        default="least-outstanding",
+        choices=EndpointPool.POLICIES,
+        help="多端点负载平衡策略: 'least-outstanding' 或 'prefix-affinity' (相同 few-shot 前缀优先送往同一台，保持 prefix cache)"
+    )
+    parser.add_argument(
+        "--affinity-slack",
+        type=float,
+        default=0.25,
+        help="prefix-affinity 下，偏好的端点比最空闲的端点多出的在途请求数上限，以每台平均在途数的倍数表示 "
+             "(0 表示只在同样空闲时才偏好)"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=None,
+        help="同时在途的请求数，预设为端点数量 (单端点时与原本的逐条处理相同)"
+    )
+    parser.add_argument(
+        "--max-endpoint-failures",
+        type=int,
+        default=3,
+        help="端点连续失败多少次后暂时移除，待健康检查恢复后重新加入"
+    )
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=3,
+        help="每条请求最多尝试的次数；暂时性错误 (连线失败、逾时、429/5xx) 的项目移到队列后方，"
+             "以带抖动的指数退避稍后重送 (1 表示不重试)"
+    )
+    parser.add_argument(
+        "--retry-base-delay",
+        type=float,
+        default=1.0,
+        help="第一次重试前的退避秒数，之后每次加倍 (上限 --retry-max-delay)，并乘上 0.5~1.5 的随机抖动"
+    )
+    parser.add_argument(
+        "--retry-max-delay",
+        type=float,
+        default=30.0,
+        help="重试退避的上限秒数"
+    )
+    parser.add_argument(
+        "--request-timeout",
+        type=float,
+        default=None,
+        help="单个请求的逾时秒数 (预设沿用 openai 客户端的设定)；逾时视为暂时性错误"
+    )
+    parser.add_argument(
+        "--breaker-threshold",
+        type=float,
+        default=0.5,
+        help="熔断器：最近 --breaker-window 个请求的失败比例达到此值时暂停送出请求"
+    )
+    parser.add_argument(
+        "--breaker-window",
+        type=int,
+        default=20,
+        help="熔断器计算错误率的最近请求数"
+    )
+    parser.add_argument(
+        "--breaker-cooldown",
+        type=float,
+        default=5.0,
+        help="熔断后暂停的秒数；之后送出一个探测请求，失败则暂停时间加倍 (上限 60 秒)"
+    )
+    parser.add_argument(
+        "--failure-manifest",
+        type=str,
+        default=None,
+        help="重试用尽仍失败的项目清单 (JSONL，原始输入记录加上 error / attempts，可直接作为 --input-file 重跑)；"
+             "预设为 <output-file>.failures.jsonl"
     )
     parser.add_argument(
         "--api-key",
@@ -401,9 +513,34 @@ def setup_arg_parser() -> argparse.ArgumentParser:
     parser.add_argument(
         "--temperature", type=float, default=0.0, help="生成文本的温度。"
     )
+    parser.add_argument(
+        "--self-consistency",
+        type=int,
+        default=1,
+        metavar="K",
+        help="每个请求以 n=K 取得 K 个采样 (prompt 只 prefill 一次)，对正规化后的语义帧逐帧多数决；需搭配 --temperature > 0 (1 表示不投票)"
+    )
+    parser.add_argument(
+        "--ready-timeout",
+        type=float,
+        default=0,
+        help="正式执行前轮询端点的 /health 与 /models，最多等待的秒数 (0 表示不等待)"
+    )
+    parser.add_argument(
+        "--warmup-requests",
+        type=int,
+        default=0,
+        help="正式执行前对每个端点送出共用前缀 (system prompt + few-shot) 的次数，用于预热 prefix cache"
+    )
     parser.add_argument(
         "--max-tokens", type=int, default=512, help="模型生成的最大token数量。"
     )
+    parser.add_argument(
+        "--dynamic-max-tokens",
+        action="store_true",
+        help="依输入长度与训练集 (--train-input-file) 的语义帧统计为每个请求估计 max_tokens，"
+             "输出被截断时才以较大预算重试 (上限为 --max-tokens)"
+    )
 
     # few-shot
     parser.add_argument(
@@ -428,6 +565,38 @@ def setup_arg_parser() -> argparse.ArgumentParser:
         default=None,
         help="可选的训练集音频目录路径，用于few-shot示例选择。"
     )
+    parser.add_argument(
+        "--pack-size",
+        type=int,
+        default=1,
+        help="文本模式下每个请求打包的查询数，输出以 id 为 key 的 JSON 物件；缺少的 id 逐条重送 (1 表示不打包)"
+    )
+    parser.add_argument(
+        "--pack-max-tokens",
+        type=int,
+        default=2048,
+        help="打包请求的 max_tokens 上限；逐条预算 (--max-tokens 或 --dynamic-max-tokens 的估计) 的总和超过时截到此值。"
+             "须让提示词加上此值不超过模型的 context 长度，否则整个打包请求会被拒绝"
+    )
+    parser.add_argument(
+        "--fast-path",
+        action="store_true",
+        help="文本模式下，先以 --train-input-file 建立的对照表查询逐字相同且标注一致的指令，命中时不调用模型"
+    )
+    parser.add_argument(
+        "--fast-path-table",
+        type=str,
+        default=None,
+        help="使用 fast_path.py 预先建立的对照表 JSON (隐含 --fast-path)"
+    )
+    parser.add_argument(
+        "--audio-transport",
+        type=str,
+        default="base64",
+        choices=AUDIO_TRANSPORTS,
+        help="音频传递方式：'base64' (inline data URL) 或 'file' (file:// URL，需与 vLLM 共享文件系统并以 "
+             "--allowed-local-media-path 启动服务；被拒绝时自动改回 base64)"
+    )
 
     parser.add_argument(
         "--stage",
@@ -436,14 +605,99 @@ def setup_arg_parser() -> argparse.ArgumentParser:
         choices=[1, 2],
         help="多階段提示詞：預設為 1 (單階段提示詞)，可選 2 (雙階段提示詞)"
     )
+
+    # multi-node sharding
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=None,
+        help="只处理第 i 个分片 (格式 i/N，依 id 的稳定哈希划分)，之后用 shard_util.py merge 合并"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="few-shot 抽样的随机种子；多机分片时需设定相同的种子，各分片才会使用相同的示例"
+    )
+
+    # columnar results store
+    parser.add_argument(
+        "--results-store",
+        type=str,
+        default=None,
+        help="另外把结果写入列式结果库目录 (results_store.py，需要 pyarrow)：正规化后的语义帧扁平化为 "
+             "id / frame_index / domain / intent / slot_key / slot_value 栏位，附带本次执行的参数"
+    )
+    parser.add_argument(
+        "--run-name",
+        type=str,
+        default=None,
+        help="结果库中的 run 名称 (预设为输出文件名，不含副档名)"
+    )
+    parser.add_argument(
+        "--store-format",
+        type=str,
+        default="parquet",
+        choices=["parquet", "arrow"],
+        help="结果库档案格式：parquet (压缩较小) 或 arrow (Arrow IPC，读取时可 memory-map)"
+    )
+
+    # live evaluation
+    parser.add_argument(
+        "--live-eval-file",
+        type=str,
+        default=None,
+        help="可选的标注JSONL文件 (如 icl_label.jsonl)，推理过程中即时计算 accuracy / slot F1。"
+    )
+    parser.add_argument(
+        "--early-stop-threshold",
+        type=float,
+        default=None,
+        help="搭配 --live-eval-file：评估样本数达到 --early-stop-min-samples 后，指标低于此值即提前停止。"
+    )
+    parser.add_argument(
+        "--early-stop-metric",
+        type=str,
+        default="overall_accuracy",
+        choices=["overall_accuracy", "intent_accuracy", "slot_f1"],
+        help="提前停止所依据的指标。"
+    )
+    parser.add_argument(
+        "--early-stop-min-samples",
+        type=int,
+        default=100,
+        help="允许提前停止之前至少需要评估的样本数。"
+    )
+    add_dispatch_order_args(parser)
+    add_profile_args(parser)
+    telemetry.add_metrics_args(parser)
     return parser
 
+# 批次实验 (sweep.py) 时多个配置共用同一份音频的 base64 编码；None 表示不快取
+_audio_cache: Optional[Dict[str, str]] = None
+
+
+def enable_audio_cache():
+    """之后的 encode_audio_to_base64 结果保留在记忆体中 (整个测试集的音频约 1.33 倍大小)。"""
+    global _audio_cache
+    if _audio_cache is None:
+        _audio_cache = {}
+
+
+@timed("encode_audio")
 def encode_audio_to_base64(audio_path: Path) -> Optional[str]:
     """读取音频文件，进行Base64编码，并返回字符串。"""
+    import base64
+    cache = _audio_cache
+    if cache is not None and str(audio_path) in cache:
+        return cache[str(audio_path)]
     try:
         with open(audio_path, "rb") as audio_file:
             binary_data = audio_file.read()
-            return base64.b64encode(binary_data).decode('utf-8')
+            encoded = base64.b64encode(binary_data).decode('utf-8')
+            if cache is not None:
+                cache[str(audio_path)] = encoded
+            return encoded
     except FileNotFoundError:
         logging.error(f"音频文件未找到: {audio_path}")
         return None
@@ -452,27 +706,288 @@ def encode_audio_to_base64(audio_path: Path) -> Optional[str]:
         return None
 
 
+# --- 音频传输方式 ---
+# "file": 客户端与 vLLM 共享文件系统时 (服务端以 --allowed-local-media-path 启动)，以 file:// URL 传递音频，
+# 省去 base64 编码 (+33% 体积) 与请求 JSON 的序列化/解析/解码。服务端拒绝时自动改回 inline base64。
+AUDIO_TRANSPORTS = ["base64", "file"]
+
+
+class ClientSettings:
+    """
+    Per-run OpenAI client options and audio transport state.
+
+    ``process_file`` builds one from its arguments, so sweep configurations
+    running side by side keep their own request timeout and retry count,
+    and a server rejecting file:// audio for one run does not switch the
+    transport of another. Callers outside a run (the serving daemon,
+    warm-up, ad-hoc calls) share ``DEFAULT_CLIENT``.
+    """
+
+    def __init__(self, timeout: Optional[float] = None, max_retries: int = 2):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.file_url_rejected = threading.Event()
+
+    def openai_client(self, api_base: str):
+        return get_openai_client(api_base, self.timeout, self.max_retries)
+
+
+DEFAULT_CLIENT = ClientSettings()
+
+
+def audio_url_for(audio_path: Path, audio_transport: str = "base64", client: Optional[ClientSettings] = None) -> Optional[str]:
+    if audio_transport == "file" and not (client or DEFAULT_CLIENT).file_url_rejected.is_set():
+        audio_path = Path(audio_path).resolve()
+        if not audio_path.exists():
+            logging.error(f"音频文件未找到: {audio_path}")
+            return None
+        return audio_path.as_uri()
+    audio_base64 = encode_audio_to_base64(audio_path)
+    return f"data:audio/wav;base64,{audio_base64}" if audio_base64 else None
+
+
+# vLLM 拒绝 file:// 音频时的错误讯息 (未开放 --allowed-local-media-path、路径不在允许目录内...)；
+# 其他 400 (超出 context 长度、参数错误) 不应改变传输方式
+_FILE_URL_ERROR_RE = re.compile(r"allowed[-_ ]local[-_ ]media[-_ ]path|local files?|file:/|file url", re.IGNORECASE)
+
+
+def _inline_file_audio(messages: List[Dict[str, Any]]) -> bool:
+    """
+    把 messages 中的 file:// 音频改为 inline base64；回传是否有任何替换。
+    音频无法读取时抛出 FileNotFoundError，而不是送出没有内容的 data URL。
+    """
+    from urllib.request import url2pathname
+
+    replaced = False
+    for message in messages:
+        content = message.get("content")
+        if not isinstance(content, list):
+            continue
+        for part in content:
+            url = part.get("audio_url", {}).get("url", "") if part.get("type") == "audio_url" else ""
+            if url.startswith("file://"):
+                audio_path = Path(url2pathname(urlparse(url).path))
+                audio_base64 = encode_audio_to_base64(audio_path)
+                if not audio_base64:
+                    raise FileNotFoundError(f"无法读取音频: {audio_path}")
+                part["audio_url"]["url"] = f"data:audio/wav;base64,{audio_base64}"
+                replaced = True
+    return replaced
+
+
+# --- JSON 解析：預編譯正則，避免每次呼叫重建 ---
+_THINK_TAG_RE = re.compile(r'<think>.*?(?:</think>|$)', flags=re.DOTALL)
+_CODE_FENCE_RE = re.compile(r'```(?:json)?\s*|```')
+_TRAILING_COMMA_RE = re.compile(r',\s*([}\]])')
+
+
+def _strip_model_output(text: str) -> str:
+    # 1. 移除 <think> 標籤及其內容 (含被截斷、沒有 </think> 的情況)
+    text = _THINK_TAG_RE.sub('', text)
+    
+    # 2. 移除 Markdown 程式碼塊語法 (```json ... ```)
+    return _CODE_FENCE_RE.sub('', text).strip()
+
+
+@timed("extract_json")
 def extract_json_string(text: Any) -> str:
-    import re
     if not isinstance(text, str):
         return "[]"
 
-    # 1. 移除 <think> 標籤及其內容
-    text = re.sub(r'<think>.*?</think>', '', text, flags=re.DOTALL)
-    
-    # 2. 移除 Markdown 程式碼塊語法 (```json ... ```)
-    text = re.sub(r'```(?:json)?\s*|```', '', text).strip()
+    text = _strip_model_output(text)
     
     # 3. 尋找 JSON 列表的邊界 [ ... ]
     start = text.find('[')
     end = text.rfind(']')
     
-    if start != -1 and end != -1:
+    if start != -1 and end > start:
         return text[start:end+1]
+
+    # 4. 生成被 max_tokens 截斷時沒有結尾的 ]，保留剩餘內容交給 parse_semantic_frames 修復
+    if start != -1:
+        return text[start:]
     
-    # 4. 如果沒找到 [ ]，但內容看起來像空結果，回傳標準空列表字串
+    # 5. 如果沒找到 [ ]，但內容看起來像空結果，回傳標準空列表字串
     return "[]"
 
+
+def _scan_json_object(text: str, start: int) -> int:
+    """
+    從 text[start] 的 '{' 開始做字串感知的括號匹配。
+    回傳配對的 '}' 之後一個位置；文字提前結束 (被截斷) 時回傳 -1。
+    """
+    depth = 0
+    in_string = False
+    escaped = False
+    for pos in range(start, len(text)):
+        ch = text[pos]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in '{[':
+            depth += 1
+        elif ch in '}]':
+            depth -= 1
+            if depth == 0:
+                return pos + 1
+    return -1
+
+
+def _as_frame(obj: Any) -> Optional[Dict[str, Any]]:
+    """只接受含 domain 與 intent 的 dict；slots 缺失或型別錯誤時補成空 dict。"""
+    if not isinstance(obj, dict) or "domain" not in obj or "intent" not in obj:
+        return None
+    if not isinstance(obj.get("slots"), dict):
+        obj["slots"] = {}
+    return obj
+
+
+@timed("parse_frames")
+def parse_semantic_frames(text: Any) -> Tuple[List[Dict[str, Any]], Dict[str, int]]:
+    """
+    Tolerant parser for model output.
+
+    Tries a plain ``json.loads`` first; if that fails (e.g. generation was cut
+    off by max_tokens, or the list has trailing commas), scans the list frame by
+    frame and keeps every complete ``{domain, intent, slots}`` object. A frame
+    cut off by the end of the output is dropped, never closed and returned.
+
+    Returns ``(frames, stats)`` where stats counts ``recovered`` frames,
+    ``repaired`` frames (needed a fix to parse), ``dropped`` fragments, whether
+    the output was ``truncated``, and ``repaired_output`` when an untruncated
+    list only parsed after a fix (e.g. trailing commas between frames).
+    """
+    stats = {"recovered": 0, "repaired": 0, "dropped": 0, "truncated": 0, "repaired_output": 0}
+    json_str = extract_json_string(text)
+
+    # 1. Fast path：完整且合法的 JSON List
+    try:
+        parsed = json.loads(json_str)
+        if isinstance(parsed, list):
+            frames = []
+            for obj in parsed:
+                frame = _as_frame(obj)
+                if frame is None:
+                    stats["dropped"] += 1
+                else:
+                    frames.append(frame)
+            stats["recovered"] = len(frames)
+            return frames, stats
+    except json.JSONDecodeError:
+        pass
+
+    # 2. Slow path：逐個語義幀掃描 (從 [ 掃到文末，避免 rfind(']') 切在字串值中間)
+    frames = []
+    json_str = _strip_model_output(text)
+    last_end = 0
+    pos = json_str.find('{', max(json_str.find('['), 0))
+    while pos != -1:
+        end = _scan_json_object(json_str, pos)
+        if end == -1:
+            # 被截斷的最後一個語義幀不完整 (slots 可能缺項)，丟棄而不補齊括號
+            stats["truncated"] = 1
+            stats["dropped"] += 1
+            break
+        chunk = json_str[pos:end]
+        last_end = end
+        repaired = False
+
+        try:
+            obj = json.loads(chunk)
+        except json.JSONDecodeError:
+            repaired = True
+            try:
+                obj = json.loads(_TRAILING_COMMA_RE.sub(r'\1', chunk))
+            except json.JSONDecodeError:
+                obj = None
+
+        frame = _as_frame(obj)
+        if frame is None:
+            stats["dropped"] += 1
+        else:
+            frames.append(frame)
+            stats["recovered"] += 1
+            if repaired:
+                stats["repaired"] += 1
+        pos = json_str.find('{', end)
+
+    if frames and not stats["truncated"]:
+        if ']' not in json_str[last_end:]:
+            # 最後一個語義幀完整，但列表沒有結尾的 ]：在語義幀之間被截斷
+            stats["truncated"] = 1
+        else:
+            # 沒有被截斷卻需要走逐幀掃描：列表本身需要修復 (例如語義幀之間多餘的逗號)
+            stats["repaired_output"] = 1
+    return frames, stats
+
+def _complete_packed_items(text: str, start: int) -> Dict[str, Any]:
+    """
+    从 text[start] 的 '{' 开始逐个读取 "id": value，回传截断或格式错误之前完整的项目。
+    """
+    decoder = json.JSONDecoder()
+    items = {}
+    pos = start + 1
+    try:
+        while True:
+            while pos < len(text) and text[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= len(text) or text[pos] != '"':
+                break
+            key, pos = decoder.raw_decode(text, pos)
+            while pos < len(text) and text[pos] in ' \t\r\n':
+                pos += 1
+            if pos >= len(text) or text[pos] != ':':
+                break
+            pos += 1
+            while pos < len(text) and text[pos] in ' \t\r\n':
+                pos += 1
+            value, pos = decoder.raw_decode(text, pos)
+            items[key] = value
+    except json.JSONDecodeError:
+        pass
+    return items
+
+@timed("parse_frames")
+def parse_packed_frames(text: Any) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    解析打包请求的输出 ({id: [语义帧, ...], ...})；无法解析时回传空 dict，由呼叫端逐条重送。
+    输出被截断时保留截断点之前完整的 id。
+    """
+    json_str = _strip_model_output(text)
+    start, end = json_str.find('{'), json_str.rfind('}')
+    if start == -1:
+        return {}
+    parsed = None
+    if end > start:
+        chunk = json_str[start:end + 1]
+        try:
+            parsed = json.loads(chunk)
+        except json.JSONDecodeError:
+            try:
+                parsed = json.loads(_TRAILING_COMMA_RE.sub(r'\1', chunk))
+            except json.JSONDecodeError:
+                parsed = None
+    if parsed is None:
+        parsed = _complete_packed_items(json_str, start)
+    if not isinstance(parsed, dict):
+        return {}
+
+    results = {}
+    for item_id, value in parsed.items():
+        if isinstance(value, dict):
+            value = [value]
+        if not isinstance(value, list):
+            continue
+        frames, _ = parse_semantic_frames(json.dumps(value, ensure_ascii=False))
+        results[str(item_id)] = frames
+    return results
+
 # Raw semantics -> Standard semantics
 def transform_semantics_to_standard(raw_semantics: Dict[str, Any]) -> List[Dict[str, Any]]:
     """
@@ -504,35 +1019,43 @@ def transform_semantics_to_standard(raw_semantics: Dict[str, Any]) -> List[Dict[
             
     return standard_list
 
-# --- 新增 ---: 专门用于调用本地 OpenAI 兼容接口的函数
-def call_local_api(
-    api_base: str,
-    model_name: str,
-    audio_path: Path,
-    temperature: float,
-    max_tokens: int,
-    text_query: str="",
-    shot_list: Optional[List[Dict[str, Any]]]=None,
-    previous_res: str="",
-) -> Optional[str]:
+@lru_cache(maxsize=None)
+def get_openai_client(api_base: str, timeout: Optional[float] = None, max_retries: int = 2):
+    """每个端点 (与 client 选项组合) 只建立一次 client，复用其连接池。"""
+    options = {"max_retries": max_retries}
+    if timeout:
+        options["timeout"] = timeout
+    return load_openai()(base_url=api_base, api_key="ollama", **options)
+
+
+def shot_prefix_key(shot_list: List[Dict[str, Any]], stage: int = 1) -> str:
     """
-    Use OpenAI-compatible local API to process SLU requests.
+    以 system prompt 与 few-shot 示例算出 prefix 指纹，供 prefix-affinity 负载平衡使用。
     """
-    # 1) Load OpenAI module
-    if OpenAI is None:
-        raise ImportError("OpenAI module is needed on calling local api: pip install openai")
+    shots = [str(shot.get("audio_path")) + "|" + str(shot.get("query")) for shot in shot_list]
+    return hashlib.md5(json.dumps([stage, shots], ensure_ascii=False).encode("utf-8")).hexdigest()
 
-    client = OpenAI(base_url=api_base, api_key="ollama")
 
+@timed("build_messages")
+def build_prefix_messages(
+    shot_list: Optional[List[Dict[str, Any]]]=None,
+    previous_res: str="",
+    audio_transport: str="base64",
+    client: Optional[ClientSettings]=None,
+) -> List[Dict[str, Any]]:
+    """
+    建立 system prompt + few-shot 示例的 messages。同一次执行中所有请求共用此前缀，
+    常驻服务可以只建立一次 (见 slu_server.py)。
+    """
     messages = []
     if previous_res != "":
         messages.append({
             "role": "system",
-            "content": SYSTEM_PROMPT_TEMPLATE
+            "content": system_prompt()
         })
     else:
         STAGE2_SYSTEM_PROMPT_TEMPLATE = f"""
-            {SYSTEM_PROMPT_TEMPLATE}
+            {system_prompt()}
             ---
             這是可能的答案：
             {previous_res}
@@ -542,7 +1065,6 @@ def call_local_api(
             "content": STAGE2_SYSTEM_PROMPT_TEMPLATE 
         })
 
-    # 2) Prepare few-shot examples
     if shot_list is not None and len(shot_list) > 0:
         for shot in shot_list:
             """
@@ -564,8 +1086,8 @@ def call_local_api(
                     ],
                 })
             else:
-                shot_audio_base64 = encode_audio_to_base64(shot["audio_path"])
-                if not shot_audio_base64:
+                shot_audio_url = audio_url_for(shot["audio_path"], audio_transport, client)
+                if not shot_audio_url:
                     continue
                 
                 messages.append({
@@ -573,7 +1095,7 @@ def call_local_api(
                     "content": [
                         {
                             "type": "audio_url",
-                            "audio_url": {"url": f"data:audio/wav;base64,{shot_audio_base64}"}
+                            "audio_url": {"url": shot_audio_url}
                         },
                     ],
                 })
@@ -582,13 +1104,20 @@ def call_local_api(
                 "role": "assistant",
                 "content": json.dumps(standard_output, ensure_ascii=False)
             })
+    return messages
 
-    # 3) Current query
+
+@timed("build_messages")
+def build_query_message(audio_path: Path, text_query: str="", audio_transport: str="base64",
+                        client: Optional[ClientSettings]=None) -> Optional[Dict[str, Any]]:
+    """
+    当前待处理的 user message；audio_path 为 "" 时使用文本查询。
+    """
     if audio_path == "":
         if text_query == "":
             logging.error("Error: 本地API调用时，必须提供音频路径或文本查询。")
             return None
-        messages.append({
+        return {
             "role": "user",
             "content": [
                 {
@@ -596,34 +1125,244 @@ def call_local_api(
                     "text": text_query
                 },
             ],
-        })
+        }
+
+    audio_url = audio_url_for(audio_path, audio_transport, client)
+    if not audio_url:
+        return None
+    return {
+        "role": "user",
+        "content": [
+            {
+                "type": "audio_url",
+                "audio_url": {"url": audio_url}
+            },
+        ],
+    }
+
+
+def request_completion(
+    api_base: str,
+    model_name: str,
+    messages: List[Dict[str, Any]],
+    temperature: float,
+    max_tokens: int,
+    endpoint_pool: Optional[EndpointPool]=None,
+    affinity_key: Optional[str]=None,
+    token_budget: Optional[TokenBudget]=None,
+    client: Optional[ClientSettings]=None,
+) -> str:
+    """
+    送出 chat completion 并回传模型输出文字；错误会往外抛，由呼叫端处理。
+    """
+    return request_completions(
+        api_base=api_base,
+        model_name=model_name,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        endpoint_pool=endpoint_pool,
+        affinity_key=affinity_key,
+        token_budget=token_budget,
+        client=client,
+    )[0]
+
+
+def request_completions(
+    api_base: str,
+    model_name: str,
+    messages: List[Dict[str, Any]],
+    temperature: float,
+    max_tokens: int,
+    endpoint_pool: Optional[EndpointPool]=None,
+    affinity_key: Optional[str]=None,
+    token_budget: Optional[TokenBudget]=None,
+    n: int=1,
+    client: Optional[ClientSettings]=None,
+) -> List[str]:
+    """
+    同 request_completion，但以 n 取得多个采样 (prompt 只 prefill 一次)，回传每个 choice 的输出文字。
+    """
+    client = client or DEFAULT_CLIENT
+    inlined = False
+    while True:
+        lease = endpoint_pool.lease(affinity_key) if endpoint_pool is not None else nullcontext(api_base)
+        try:
+            with lease as base_url, stage("request"), telemetry.request():
+                response = client.openai_client(base_url).chat.completions.create(
+                    model=model_name,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    n=n,
+                    stream=False
+                )
+        except Exception as e:
+            # 服务端未开放 --allowed-local-media-path 或看不到该路径：改用 base64 重送
+            # (messages 可能共用预先建立的前缀，先复制再改写)
+            if not inlined and getattr(e, "status_code", None) == 400 and _FILE_URL_ERROR_RE.search(str(e)):
+                messages = copy.deepcopy(messages)
+                try:
+                    inlined = _inline_file_audio(messages)
+                except FileNotFoundError as missing:
+                    logging.error(str(missing))
+                    # 抛出原本的 400，不会被当成暂时性错误重试
+                    raise e from missing
+                if inlined:
+                    logging.debug(f"file:// 音频被拒绝，改以 inline base64 重送: {e}")
+                    continue
+            raise
+        # base64 重送成功才确认服务端不接受 file://，本次执行之后的请求不再使用
+        if inlined and not client.file_url_rejected.is_set():
+            client.file_url_rejected.set()
+            logging.warning("服务端拒绝 file:// 音频 URL，本次执行改用 inline base64。")
+        telemetry.add_usage(getattr(response, "usage", None))
+        # 动态预算过小导致截断时，以较大的预算重试
+        if token_budget is not None and any(choice.finish_reason == "length" for choice in response.choices):
+            next_max_tokens = token_budget.escalate(max_tokens)
+            if next_max_tokens is not None:
+                max_tokens = next_max_tokens
+                continue
+        break
+    return [(choice.message.content or "").strip() for choice in response.choices]
+
+
+PACKED_INSTRUCTION = (
+    "以下 JSON 列表包含多条彼此独立的查询，请逐条按照上述规则理解。"
+    "只输出一个 JSON 物件：key 为每条查询的 id，value 为该查询的语义帧列表 (格式与单条查询的输出相同)，不要输出其他内容。"
+)
+
+# 执行开头连续这么多个打包请求整个失败时，停用打包改为逐条送出
+PACK_FAILURE_LIMIT = 3
+
+
+def packed_max_tokens(
+    queries: List[str],
+    max_tokens: int,
+    cap: int,
+    token_budget: Optional[TokenBudget]=None,
+) -> int:
+    """
+    打包请求的 max_tokens：逐条预算 (有 token_budget 时用其估计，否则为 max_tokens) 的总和，不超过 cap。
+    预算不足时输出在中途被截断，已完整输出的 id 仍会被采用，其余逐条重送。
+    """
+    if token_budget is not None:
+        total = sum(token_budget.estimate(query=query) for query in queries)
     else:
-        audio_base64 = encode_audio_to_base64(audio_path)
-        if not audio_base64:
-            return None
+        total = max_tokens * len(queries)
+    return max(1, min(total, cap))
+
+
+def call_packed_api(
+    model_name: str,
+    items: List[Tuple[str, str]],
+    temperature: float,
+    max_tokens: int,
+    prefix_messages: List[Dict[str, Any]],
+    endpoint_pool: EndpointPool,
+    affinity_key: Optional[str]=None,
+    client: Optional[ClientSettings]=None,
+) -> Optional[Dict[str, List[Dict[str, Any]]]]:
+    """
+    在一个请求中送出多条 (id, 文本查询)，回传 {id: 语义帧列表}；只包含输出中合法且属于本批的 id。
+    整个请求失败 (例如超出 context 长度的 400) 时回传 None，与「输出缺少部分 id」区分。
+    """
+    load_openai()
+
+    packed_query = json.dumps([{"id": item_id, "query": query} for item_id, query in items], ensure_ascii=False)
+    messages = prefix_messages + [{
+        "role": "user",
+        "content": [
+            {"type": "text", "text": PACKED_INSTRUCTION},
+            {"type": "text", "text": packed_query},
+        ],
+    }]
+    try:
+        text = request_completion(
+            api_base=endpoint_pool.endpoints[0].url,
+            model_name=model_name,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            endpoint_pool=endpoint_pool,
+            affinity_key=affinity_key,
+            client=client,
+        )
+    except Exception as e:
+        logging.error(f"打包请求失败 ({len(items)} 条, max_tokens={max_tokens})，改为逐条送出: {e}")
+        return None
+    ids = {item_id for item_id, _ in items}
+    return {item_id: frames for item_id, frames in parse_packed_frames(text).items() if item_id in ids}
 
-        messages.append({
-            "role": "user",
-            "content": [
-                {
-                    "type": "audio_url",
-                    "audio_url": {"url": f"data:audio/wav;base64,{audio_base64}"}
-                },
-            ],
-        })
+
+# --- 新增 ---: 专门用于调用本地 OpenAI 兼容接口的函数
+def call_local_api(
+    api_base: str,
+    model_name: str,
+    audio_path: Path,
+    temperature: float,
+    max_tokens: int,
+    text_query: str="",
+    shot_list: Optional[List[Dict[str, Any]]]=None,
+    previous_res: str="",
+    endpoint_pool: Optional[EndpointPool]=None,
+    affinity_key: Optional[str]=None,
+    token_budget: Optional[TokenBudget]=None,
+    audio_transport: str="base64",
+    prefix_messages: Optional[List[Dict[str, Any]]]=None,
+    n_samples: int=1,
+    raise_on_error: bool=False,
+    client: Optional[ClientSettings]=None,
+) -> Optional[str]:
+    """
+    Use OpenAI-compatible local API to process SLU requests.
+    When `endpoint_pool` is given, the request goes to the endpoint it picks
+    and `api_base` is ignored. When `token_budget` is given, a response cut
+    off by `max_tokens` is retried with the budget it escalates to.
+    With ``audio_transport="file"`` audio is referenced by file:// URL and
+    re-sent inline if the server rejects it. `prefix_messages` (from
+    ``build_prefix_messages``) replaces building the prompt from `shot_list`.
+    With `n_samples` > 1 the samples of a single request are majority-voted
+    per frame (``self_consistency.vote_frames``) and the result is returned
+    as a JSON list. With `raise_on_error` a transient API error (see
+    ``dispatch.is_retryable``) raises ``RetryableError`` instead of
+    returning None, so a RetryScheduler can try the item again later.
+    `client` carries the run's client options and transport state.
+    """
+    # 1) Load OpenAI module
+    load_openai()
+
+    # 2) System prompt + few-shot examples
+    if prefix_messages is None:
+        prefix_messages = build_prefix_messages(shot_list, previous_res, audio_transport, client)
+
+    # 3) Current query
+    query_message = build_query_message(audio_path, text_query, audio_transport, client)
+    if query_message is None:
+        return None
+    messages = prefix_messages + [query_message]
 
     # 4) Call local API
     try:
-        response = client.chat.completions.create(
-            model=model_name,
+        outputs = request_completions(
+            api_base=api_base,
+            model_name=model_name,
             messages=messages,
             temperature=temperature,
             max_tokens=max_tokens,
-            stream=False
+            endpoint_pool=endpoint_pool,
+            affinity_key=affinity_key,
+            token_budget=token_budget,
+            n=n_samples,
+            client=client,
         )
-        text = response.choices[0].message.content.strip()
-        return extract_json_string(text)
+        if n_samples <= 1:
+            return extract_json_string(outputs[0])
+        samples = [parse_semantic_frames(output)[0] for output in outputs]
+        return json.dumps(vote_frames(samples), ensure_ascii=False)
     except Exception as e:
+        if raise_on_error and is_retryable(e):
+            raise RetryableError(f"{type(e).__name__}: {e}") from e
         logging.error(f"调用本地 API 时发生错误 (audio: {audio_path.name if audio_path != '' else 'text query'}): {e}", exc_info=True)
         return None   
     
@@ -702,24 +1441,54 @@ def call_local_api(
 #         return None
 
 
-def process_file(args: argparse.Namespace):
-    # 1) Preparing file paths
-    input_file = Path(args.input_file)
-    if args.audio_dir is None:
-        audio_dir = ""
-    else:
-        audio_dir = Path(args.audio_dir)
-    output_file = Path(args.output_file)
-    output_file.parent.mkdir(parents=True, exist_ok=True)
+WARMUP_QUERY = "你好"
 
-    try:
-        with open(input_file, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-    except FileNotFoundError:
-        logging.error(f"Error: Cannot find test input file {input_file}")
-        return
 
-    # 2) Few-shot：Build shot-list
+def warm_up(args: argparse.Namespace, endpoint_urls: List[str], shot_list: List[Dict[str, Any]], concurrency: int,
+            client: Optional[ClientSettings]=None, prefix_messages: Optional[List[Dict[str, Any]]]=None):
+    """
+    对每个端点送出 --warmup-requests 次共用的 system prompt + few-shot 前缀 (max_tokens=1)，
+    预先填好 prefix cache 并触发 CUDA graph 等首批开销，结果不计入正式执行。
+    每个请求的第一次调用都使用第一阶段的前缀 (`prefix_messages`，未提供时由 shot_list 建立)，
+    --stage 2 另外预热第二次调用的前缀。
+    """
+    if prefix_messages is None:
+        prefix_messages = build_prefix_messages(shot_list, "", args.audio_transport, client)
+    prefixes = [prefix_messages]
+    if args.stage == 2:
+        prefixes.append(build_prefix_messages(shot_list, "[]", args.audio_transport, client))
+
+    def send(url: str):
+        for prefix in prefixes:
+            call_local_api(
+                api_base=url,
+                model_name=args.model_name,
+                text_query=WARMUP_QUERY,
+                audio_path="",
+                temperature=args.temperature,
+                max_tokens=1,
+                prefix_messages=prefix,
+                audio_transport=args.audio_transport,
+                client=client,
+            )
+
+    start = time.perf_counter()
+    # 先各送一次让前缀进入 cache，其余并行送出以涵盖较大的 batch
+    for _ in ordered_map(send, endpoint_urls, concurrency=concurrency):
+        pass
+    for _ in ordered_map(send, endpoint_urls * (args.warmup_requests - 1), concurrency=concurrency):
+        pass
+    logging.info(
+        f"预热完成: {len(endpoint_urls)} 个端点 × {args.warmup_requests} 次 × {len(prefixes)} 个前缀，"
+        f"耗时 {time.perf_counter() - start:.1f}s"
+    )
+
+
+@timed("load_shots")
+def build_shot_list(args: argparse.Namespace) -> Optional[List[Dict[str, Any]]]:
+    """
+    依 --n-shot / --train-input-file / --train-audio-dir / --seed 选出 few-shot 示例；参数错误时回传 None。
+    """
     shot_list = []
     if(args.n_shot > 0):
         """
@@ -735,7 +1504,7 @@ def process_file(args: argparse.Namespace):
         ## Checking train text file
         if(args.train_input_file is None):
             logging.error("Error: 使用 few-shot 时，必须提供 --train-file 参数。")
-            return
+            return None
         train_input_file = Path(args.train_input_file)
 
         ## Load train text lines
@@ -744,14 +1513,17 @@ def process_file(args: argparse.Namespace):
                 train_lines = f.readlines()
         except FileNotFoundError:
             logging.error(f"Error: Cannot find train input file {train_input_file}")
-            return
+            return None
 
         ## randomly select n-shot examples
         if(len(train_lines) < args.n_shot):
             logging.error(f"Error: The number of train dataset ({len(train_lines)}) is less than number of shots ({args.n_shot})。")
-            return
+            return None
 
-        shot_indices = random.sample(range(len(train_lines)), args.n_shot)
+        if getattr(args, "shard", None) is not None and args.seed is None:
+            logging.warning("使用 --shard 但未设定 --seed，各分片的 few-shot 示例会不同。")
+        import random
+        shot_indices = random.Random(args.seed).sample(range(len(train_lines)), args.n_shot)
 
         ## Checking audio dir for train set
         if args.train_audio_dir is None:
@@ -761,7 +1533,7 @@ def process_file(args: argparse.Namespace):
 
         ## Build shot list
         for idx in shot_indices:
-            shot_data = json.loads(train_lines[idx])
+            shot_data = loads(train_lines[idx])
             item_id = shot_data.get("id")
             query = shot_data.get("query")
             semantics = shot_data.get("semantics", [])
@@ -779,81 +1551,475 @@ def process_file(args: argparse.Namespace):
                 "query": query,
                 "semantics": semantics
             })
-        
+    return shot_list
+
+
+def build_token_budget(args: argparse.Namespace) -> TokenBudget:
+    """由训练集学习语义帧大小与意图数量的统计值；未提供训练集时使用预设值。"""
+    token_budget = TokenBudget(max_tokens=args.max_tokens)
+    if args.train_input_file is None:
+        logging.warning("--dynamic-max-tokens 未提供 --train-input-file，使用预设的语义帧统计值。")
+        return token_budget
+
+    samples = []
+    durations = {}
+    train_audio_dir = Path(args.train_audio_dir) if args.train_audio_dir else None
+    try:
+        with open(args.train_input_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    data = loads(line)
+                    query = data.get("query", "")
+                    samples.append((query, transform_semantics_to_standard(data.get("semantics", {}))))
+                except (json.JSONDecodeError, AttributeError, KeyError, TypeError):
+                    continue
+                if train_audio_dir is not None and query:
+                    duration = wav_duration_seconds(train_audio_dir / f"id_{data.get('id')}.wav")
+                    if duration:
+                        durations[query] = duration
+    except FileNotFoundError:
+        logging.error(f"Error: Cannot find train input file {args.train_input_file}")
+        return token_budget
+    return token_budget.fit(samples, durations)
+
+
+def write_failure_manifest(path: Path, failures: List[Tuple[Any, BaseException, int]]):
+    """
+    把重试用尽的输入行 (打包模式下为整组) 写成 JSONL：原始记录加上 error 与 attempts，可直接作为 --input-file 重跑，
+    再以 `shard_util.py merge <重跑输出> <原输出>` 合并 (重复 id 保留先出现者)。
+    """
+    count = 0
+    with JsonlWriter(path) as f:
+        for item, error, attempts in failures:
+            for line in (item if isinstance(item, list) else [item]):
+                try:
+                    data = loads(line)
+                except json.JSONDecodeError:
+                    continue
+                f.write(dict(data, error=f"{type(error).__name__}: {error}", attempts=attempts))
+                count += 1
+    logging.warning(f"{count} 条请求重试用尽仍失败 (以空语义帧写出)，清单已保存到 {path}")
+
+
+def process_file(
+    args: argparse.Namespace,
+    lines: Optional[List[str]]=None,
+    shot_list: Optional[List[Dict[str, Any]]]=None,
+    ground_truth: Optional[Dict[str, Any]]=None,
+) -> Optional[Dict[str, Any]]:
+    """
+    执行一次推理。`lines` / `shot_list` / `ground_truth` 可由呼叫端预先载入 (sweep.py 在多个配置间共用)，
+    未提供时依 args 读取。`ground_truth` 或 --live-eval-file 会启用即时评分。
+    回传执行摘要 (条数、耗时、放弃的条数，以及有评分时的指标)；参数错误时回传 None。
+    """
+    # 1) Preparing file paths
+    input_file = Path(args.input_file)
+    if args.audio_dir is None:
+        audio_dir = ""
+    else:
+        audio_dir = Path(args.audio_dir)
+    output_file = Path(args.output_file)
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+
+    if lines is None:
+        try:
+            with open(input_file, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            logging.error(f"Error: Cannot find test input file {input_file}")
+            return
+    lines = filter_shard_lines(lines, args.shard)
+
+    # 2) Few-shot：Build shot-list
+    if shot_list is None:
+        shot_list = build_shot_list(args)
+    if shot_list is None:
+        return
+
+    if args.self_consistency > 1 and args.temperature <= 0:
+        logging.warning(f"--self-consistency {args.self_consistency} 搭配 --temperature 0 时各采样相同，投票没有效果。")
+
+    # 动态 max_tokens：依训练集统计为每个请求估计生成预算
+    token_budget = build_token_budget(args) if args.dynamic_max_tokens else None
+
+    # 快速路径：训练集中逐字出现过且标注一致的查询直接查表 (只用于文本模式)
+    fast_path_table = None
+    if args.fast_path_table:
+        fast_path_table = ExactMatchTable.load(args.fast_path_table)
+    elif args.fast_path:
+        if args.train_input_file is None:
+            logging.error("Error: 使用 --fast-path 时，必须提供 --train-input-file 参数。")
+            return
+        fast_path_table = ExactMatchTable.from_training_file(args.train_input_file)
+    if fast_path_table is not None and audio_dir != "":
+        logging.warning("快速路径只用于文本模式 (音频模式没有可用的转写)，已停用。")
+        fast_path_table = None
+    fast_path_hits = fast_path_checked = fast_path_correct = 0
+
+    # 列式结果库：推理开始前就建立 writer，缺少 pyarrow 时立即失败而不是跑完才发现
+    store_writer = None
+    if args.results_store:
+        import results_store
+        run_name = args.run_name or output_file.stem
+        try:
+            store_writer = results_store.RunWriter(
+                results_store.run_path(args.results_store, run_name, args.store_format),
+                run=run_name,
+                metadata=results_store.run_metadata_from_args(args, "slu_icl"),
+            )
+        except ImportError as e:
+            logging.error(f"Error: {e}")
+            return
+
     # 3) Processing each line
     logging.info(f"Starting to process {len(lines)} lines from {input_file}...")
+    parse_totals = {"recovered": 0, "repaired": 0, "dropped": 0, "truncated": 0, "repaired_output": 0}
+
+    live_evaluator = None
+    if ground_truth is not None or args.live_eval_file:
+        from metrics import StreamingEvaluator, load_ground_truth
+        live_evaluator = StreamingEvaluator(
+            ground_truth if ground_truth is not None else load_ground_truth(args.live_eval_file),
+            early_stop_metric=args.early_stop_metric,
+            early_stop_threshold=args.early_stop_threshold,
+            min_samples=args.early_stop_min_samples,
+        )
     
-    with open(output_file, 'w', encoding='utf-8') as outfile:
-        for line in tqdm(lines, desc="Processing dataset"):
-            try:
-                data = json.loads(line)
-                item_id = data.get("id")
-                ground_truth_query = data.get("query")
-                if not item_id:
-                    logging.warning(f"Miss line id: {line.strip()}")
-                    continue
-                
-                if (audio_dir != ""):
-                    audio_path = audio_dir / f"id_{item_id}.wav"
-                    if not audio_path.exists():
-                        logging.warning(f"Cannot find the audio: {audio_path}")
-                        continue
+    # 正式执行前：等待服务载入完成，并预热 prefix cache
+    endpoint_urls = parse_endpoints(args.api_base)
+    if args.provider == "local" and args.ready_timeout > 0:
+        endpoint_urls = wait_until_ready(endpoint_urls, timeout=args.ready_timeout)
+        if not endpoint_urls:
+            logging.error("Error: 没有可用的端点。")
+            return
+    concurrency = args.concurrency or len(endpoint_urls)
+    # 本次执行专属的 client 选项与音频传输状态 (sweep 并行的配置之间互不影响)；
+    # 由排程器负责重试，openai 客户端本身不再原地重试 (会占住 worker)
+    client = ClientSettings(
+        timeout=args.request_timeout,
+        max_retries=0 if args.max_attempts > 1 else 2,
+    )
+    # 多端點：least-outstanding 負載平衡，可選 prefix affinity
+    endpoint_pool = EndpointPool(
+        endpoint_urls,
+        policy=args.lb_policy,
+        max_failures=args.max_endpoint_failures,
+        affinity_slack=args.affinity_slack,
+    )
+    endpoint_pool.start_health_checks()
+    affinity_key = shot_prefix_key(shot_list, args.stage)
+
+    # 第一阶段的 system prompt + few-shot 前缀对所有请求相同，只建立一次 (few-shot 音频只编码一次)；
+    # 服务端拒绝 file:// 之后改以 inline base64 重建
+    prefix_cache: Dict[bool, List[Dict[str, Any]]] = {}
+
+    def stage1_prefix() -> List[Dict[str, Any]]:
+        rejected = client.file_url_rejected.is_set()
+        if rejected not in prefix_cache:
+            prefix_cache[rejected] = build_prefix_messages(shot_list, "", args.audio_transport, client)
+        return prefix_cache[rejected]
+
+    if args.provider == "local" and args.warmup_requests > 0:
+        warm_up(args, endpoint_urls, shot_list, concurrency, client=client, prefix_messages=stage1_prefix())
+
+    # 失败感知排程：暂时性错误移到队列后方、退避后重送；错误率过高时熔断暂停送出
+    scheduler = RetryScheduler(
+        max_attempts=args.max_attempts,
+        base_delay=args.retry_base_delay,
+        max_delay=args.retry_max_delay,
+        breaker=CircuitBreaker(
+            window=args.breaker_window,
+            threshold=args.breaker_threshold,
+            min_requests=min(10, args.breaker_window),
+            cooldown=args.breaker_cooldown,
+        ),
+        seed=args.seed,
+    )
+    failure_manifest = Path(args.failure_manifest or f"{output_file}.failures.jsonl")
+
+    def failed_line(line: str, error: BaseException) -> Optional[Dict[str, Any]]:
+        """
+        重试用尽的项目仍以空语义帧写出 (评分时计为错误，不会从分母消失)，并列入 failure manifest。
+        """
+        try:
+            data = loads(line)
+        except json.JSONDecodeError:
+            return None
+        if not data.get("id"):
+            return None
+        result = {"id": data.get("id"), "query": data.get("query"), "semantics": []}
+        return {"result": result, "parse_stats": None}
+
+    def process_line(line: str) -> Optional[Dict[str, Any]]:
+        try:
+            data = loads(line)
+            item_id = data.get("id")
+            ground_truth_query = data.get("query")
+            if not item_id:
+                logging.warning(f"Miss line id: {line.strip()}")
+                return None
+            
+            if (audio_dir != ""):
+                audio_path = audio_dir / f"id_{item_id}.wav"
+                if not audio_path.exists():
+                    logging.warning(f"Cannot find the audio: {audio_path}")
+                    return None
+            else:
+                audio_path = ""
+
+            if fast_path_table is not None:
+                frames = fast_path_table.lookup(ground_truth_query)
+                if frames is not None:
+                    result = {"id": item_id, "query": ground_truth_query, "semantics": copy.deepcopy(frames)}
+                    return {
+                        "result": result,
+                        "parse_stats": None,
+                        "fast_path_hit": True,
+                        # 没有参考答案时为 None，只影响命中准确率的统计
+                        "fast_path_correct": is_correct(frames, data.get("semantics")),
+                    }
+
+            model_output_str = None
+            max_tokens = args.max_tokens
+            if token_budget is not None:
+                if audio_path == "":
+                    max_tokens = token_budget.estimate(query=ground_truth_query)
                 else:
-                    audio_path = ""
-
-                model_output_str = None
-
-                ## ======== Stage 1 ========
-                if args.provider == "local":
-                    model_output_str = call_local_api(
-                        api_base=args.api_base,
-                        model_name=args.model_name,
-                        text_query=ground_truth_query,
-                        audio_path=audio_path,
-                        temperature=args.temperature,
-                        max_tokens=args.max_tokens,
-                        shot_list=shot_list
-                    )
-                
-                ## ======== Stage 2 ========
-                if args.stage == 2 and model_output_str is not None:
-                    model_output_str = call_local_api(
-                        api_base=args.api_base,
-                        model_name=args.model_name,
-                        text_query=ground_truth_query,
-                        audio_path=audio_path,
-                        temperature=args.temperature,
-                        max_tokens=args.max_tokens,
-                        shot_list=shot_list,
-                        previous_res=model_output_str
+                    max_tokens = token_budget.estimate(audio_seconds=wav_duration_seconds(audio_path))
+
+            ## ======== Stage 1 ========
+            if args.provider == "local":
+                model_output_str = call_local_api(
+                    api_base=args.api_base[0],
+                    model_name=args.model_name,
+                    text_query=ground_truth_query,
+                    audio_path=audio_path,
+                    temperature=args.temperature,
+                    max_tokens=max_tokens,
+                    shot_list=shot_list,
+                    endpoint_pool=endpoint_pool,
+                    affinity_key=affinity_key,
+                    token_budget=token_budget,
+                    audio_transport=args.audio_transport,
+                    prefix_messages=stage1_prefix(),
+                    n_samples=args.self_consistency,
+                    raise_on_error=True,
+                    client=client,
+                )
+            
+            ## ======== Stage 2 ========
+            if args.stage == 2 and model_output_str is not None:
+                model_output_str = call_local_api(
+                    api_base=args.api_base[0],
+                    model_name=args.model_name,
+                    text_query=ground_truth_query,
+                    audio_path=audio_path,
+                    temperature=args.temperature,
+                    max_tokens=max_tokens,
+                    shot_list=shot_list,
+                    previous_res=model_output_str,
+                    endpoint_pool=endpoint_pool,
+                    token_budget=token_budget,
+                    audio_transport=args.audio_transport,
+                    n_samples=args.self_consistency,
+                    raise_on_error=True,
+                    client=client,
+                )
+
+            # 容錯解析：被截斷或輕微格式錯誤時，盡量救回完整的語義幀
+            parsed_semantics_list: List[Dict[str, Any]] = []
+            parse_stats = None
+            if model_output_str:
+                parsed_semantics_list, parse_stats = parse_semantic_frames(model_output_str)
+                if parse_stats["truncated"] or parse_stats["dropped"]:
+                    logging.warning(
+                        f"\n模型输出不完整。ID: {item_id}, 救回 {parse_stats['recovered']} 个语义帧 "
+                        f"(修复 {parse_stats['repaired']}, 丢弃 {parse_stats['dropped']}), Output: {model_output_str}"
                     )
+            else:
+                logging.warning(f"\nAPI 调用失败或返回空。ID: {item_id}。")
 
-                # 解析逻辑保持不变
-                parsed_semantics_list: List[Dict[str, Any]] = []
-                if model_output_str:
-                    try:
-                        if model_output_str.startswith("```json"):
-                            model_output_str = model_output_str.strip("```json\n").strip("`")
-                        
-                        parsed_output = json.loads(model_output_str)
-
-                        if isinstance(parsed_output, list):
-                            parsed_semantics_list = parsed_output
-                        else:
-                            raise json.JSONDecodeError("Model output is not a list", model_output_str, 0)
-
-                    except json.JSONDecodeError as e:
-                        logging.warning(f"\n无法解码 JSON。ID: {item_id}, Error: {e}, Output: {model_output_str}")
-                else:
-                    logging.warning(f"\nAPI 调用失败或返回空。ID: {item_id}。")
+            result = {"id": item_id, "query": ground_truth_query, "semantics": parsed_semantics_list}
+            return {"result": result, "parse_stats": parse_stats}
 
-                result = {"id": item_id, "query": ground_truth_query, "semantics": parsed_semantics_list}
-                outfile.write(json.dumps(result, ensure_ascii=False) + '\n')
+        except RetryableError:
+            raise
+        except Exception as e:
+            logging.error(f"处理行时发生意外错误: {line.strip()}. 错误: {e}", exc_info=True)
+            return None
 
-            except Exception as e:
-                logging.error(f"处理行时发生意外错误: {line.strip()}. 错误: {e}", exc_info=True)
-            
+    def process_chunk(chunk: List[str]) -> List[Optional[Dict[str, Any]]]:
+        """
+        把一组文本查询打包成一个请求；打包输出缺少的 id (或整个请求失败) 逐条以 process_line 重送。
+        """
+        results = [None] * len(chunk)
+        pending = []
+        for idx, line in enumerate(chunk):
+            try:
+                data = loads(line)
+            except json.JSONDecodeError:
+                data = {}
+            item_id, query = data.get("id"), data.get("query")
+            if not item_id or not query or (fast_path_table is not None and query in fast_path_table):
+                results[idx] = process_line(line)
+            else:
+                pending.append((idx, str(item_id), query, line))
+
+        packed = {}
+        attempted = len(pending) > 1 and not pack_stats["disabled"]
+        if attempted:
+            packed = call_packed_api(
+                model_name=args.model_name,
+                items=[(item_id, query) for _, item_id, query, _ in pending],
+                temperature=args.temperature,
+                max_tokens=packed_max_tokens(
+                    [query for _, _, query, _ in pending], args.max_tokens, args.pack_max_tokens, token_budget,
+                ),
+                prefix_messages=packed_prefix,
+                endpoint_pool=endpoint_pool,
+                affinity_key=affinity_key,
+                client=client,
+            )
+            with pack_lock:
+                pack_stats["requests"] += 1
+                if packed is None:
+                    pack_stats["failed"] += 1
+                    # 前几个打包请求全部失败 (通常是提示词加 max_tokens 超出 context)：
+                    # 继续打包只会让每一条都多花一次请求，改为逐条送出
+                    if pack_stats["failed"] == pack_stats["requests"] == PACK_FAILURE_LIMIT:
+                        pack_stats["disabled"] = True
+                        logging.warning(
+                            f"前 {PACK_FAILURE_LIMIT} 个打包请求全部失败，本次执行停用打包；"
+                            f"请检查 --pack-max-tokens 与模型的 context 长度"
+                        )
+            packed = packed or {}
+
+        for idx, item_id, query, line in pending:
+            if item_id in packed:
+                result = {"id": item_id, "query": query, "semantics": packed[item_id]}
+                results[idx] = {"result": result, "parse_stats": None}
+                with pack_lock:
+                    pack_stats["packed"] += 1
+            else:
+                results[idx] = process_line(line)
+                if attempted:
+                    with pack_lock:
+                        pack_stats["fallback"] += 1
+        return results
+
+    # 打包：文本模式下每 --pack-size 条查询共用一次请求 (只支援单阶段)
+    pack_size = args.pack_size
+    if pack_size > 1 and (audio_dir != "" or args.stage == 2 or args.provider != "local"):
+        logging.warning("--pack-size 只用于本地接口、文本模式的单阶段提示词，已停用。")
+        pack_size = 1
+    if pack_size > 1 and args.self_consistency > 1:
+        logging.warning("--pack-size 与 --self-consistency 不能同时使用，已停用打包。")
+        pack_size = 1
+    packed_prefix = stage1_prefix() if pack_size > 1 else None
+    pack_stats = {"requests": 0, "packed": 0, "fallback": 0, "failed": 0, "disabled": False}
+    pack_lock = threading.Lock()
+
+    # 依音频时长安排送出顺序 (只用于音频模式；输出仍依输入顺序)
+    dispatch_order = None
+    if args.dispatch_order != "input":
+        if audio_dir == "":
+            logging.warning("--dispatch-order 只用于音频模式 (依音频时长排序)，已改为依档案顺序送出。")
+        else:
+            durations = line_audio_durations(lines, audio_dir)
+            dispatch_order = duration_order(durations, args.dispatch_order, args.duration_bucket)
+            logging.info(f"送出顺序 {args.dispatch_order}: {describe_durations(durations)}")
+
+    processed_count = 0
+    start_time = time.perf_counter()
+    # 缓冲写出；每秒至少 flush 一次，让 metrics.py --follow 能即时读到
+    with JsonlWriter(output_file, flush_interval=1.0) as outfile:
+        # 並行送出請求，但依輸入順序寫出
+        if pack_size > 1:
+            chunks = [lines[i:i + pack_size] for i in range(0, len(lines), pack_size)]
+            # 打包请求失败时整组重送 (打包输出缺少的 id 已在 process_chunk 内逐条处理)
+            results_iter = scheduler.map(
+                process_chunk, chunks, concurrency=concurrency,
+                on_failure=lambda chunk, error: [failed_line(line, error) for line in chunk],
+            )
+            processed_iter = (processed for chunk_results in results_iter for processed in chunk_results)
+        else:
+            results_iter = processed_iter = scheduler.map(
+                process_line, lines, concurrency=concurrency, on_failure=failed_line, order=dispatch_order,
+            )
+        for processed in tqdm(processed_iter, total=len(lines), desc="Processing dataset"):
+            processed_count += 1
+            if processed is None:
+                telemetry.item_done("skipped")
+                continue
+            result = processed["result"]
+            if processed.get("fast_path_hit"):
+                fast_path_hits += 1
+                if processed["fast_path_correct"] is not None:
+                    fast_path_checked += 1
+                    fast_path_correct += processed["fast_path_correct"]
+                telemetry.item_done("fast_path")
+            else:
+                telemetry.item_done("ok" if result["semantics"] else "empty")
+            if processed["parse_stats"] is not None:
+                for key, value in processed["parse_stats"].items():
+                    parse_totals[key] += value
+                    if value and key != "recovered":
+                        telemetry.count(f"parse_{key}", value)
+            with stage("serialize"):
+                record = dumps_line(result)
+            with stage("write_output"):
+                outfile.write_raw(record)
+                if store_writer is not None:
+                    store_writer.add(result)
+
+            ## ======== Live evaluation ========
+            if live_evaluator is not None and live_evaluator.update(result):
+                if live_evaluator.processed_count % 100 == 0:
+                    logging.info(f"即时评估 {live_evaluator.progress_line()}")
+                if live_evaluator.should_stop():
+                    logging.warning(
+                        f"提前停止: {args.early_stop_metric} 低于 {args.early_stop_threshold} "
+                        f"({live_evaluator.progress_line()})"
+                    )
+                    results_iter.close()
+                    break
+
+    elapsed = time.perf_counter() - start_time
+    logging.info(f"计时: {processed_count} 条, {elapsed:.1f}s, {processed_count / max(elapsed, 1e-9):.2f} 条/s (不含预热)")
+    endpoint_pool.close()
+    if len(endpoint_pool) > 1:
+        logging.info(f"端点统计: {endpoint_pool.summary()}")
+    logging.info(f"失败处理: {scheduler.summary()}")
+    if scheduler.failures:
+        write_failure_manifest(failure_manifest, scheduler.failures)
+    if token_budget is not None:
+        logging.info(f"动态 max_tokens: {token_budget.summary()}")
+    if pack_size > 1:
+        logging.info(
+            f"打包请求: {pack_stats['requests']} 次 (每次最多 {pack_size} 条), "
+            f"整个失败 {pack_stats['failed']} 次, 由打包输出取得 {pack_stats['packed']} 条, "
+            f"逐条重送 {pack_stats['fallback']} 条{' (已停用打包)' if pack_stats['disabled'] else ''}"
+        )
+    if fast_path_table is not None:
+        accuracy = f", 命中准确率 {fast_path_correct / fast_path_checked:.4f} ({fast_path_correct}/{fast_path_checked})" if fast_path_checked else ""
+        logging.info(f"快速路径: {fast_path_table.summary()}, 本次输出 {fast_path_hits} 笔{accuracy}")
+    logging.info(
+        f"解析统计: 救回语义帧 {parse_totals['recovered']} (其中修复 {parse_totals['repaired']}), "
+        f"丢弃片段 {parse_totals['dropped']}, 被截断输出 {parse_totals['truncated']}, "
+        f"修复格式的输出 {parse_totals['repaired_output']}"
+    )
+    if live_evaluator is not None:
+        logging.info(f"即时评估结果 {live_evaluator.progress_line()}")
+    if store_writer is not None:
+        store_writer.metadata.update({"seconds": round(elapsed, 3), "failed": len(scheduler.failures)})
+        logging.info(f"结果库: 已写入 {store_writer.close()}")
     logging.info(f"\n处理完成。结果已保存到 {output_file}")
+    return {
+        "processed": processed_count,
+        "seconds": round(elapsed, 3),
+        "failed": len(scheduler.failures),
+        "metrics": live_evaluator.results() if live_evaluator is not None else None,
+    }
 
 
 def main():
@@ -869,11 +2035,12 @@ def main():
             logging.error(f"错误: 使用 '{args.provider}' 提供商时，必须提供 API key。")
             return
     
-    if args.provider == "local" and OpenAI is None:
+    if args.provider == "local" and find_spec("openai") is None:
         logging.error("错误: 要使用 'local' 提供商, 请先安装 openai 库: pip install openai")
         return
 
-    process_file(args)
+    with profile_session(args), telemetry.session(args, "slu_icl"):
+        process_file(args)
 
 if __name__ == "__main__":
     main()
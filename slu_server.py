@@ -0,0 +1,624 @@
+import argparse
+import base64
+import json
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from dispatch import EndpointPool, parse_endpoints, wait_until_ready
+from jsonl_io import dumps_bytes, loads
+from profiling import add_profile_args, session as profile_session, timed
+from slu_icl import (
+    AUDIO_TRANSPORTS,
+    build_prefix_messages,
+    build_query_message,
+    build_shot_list,
+    build_token_budget,
+    call_packed_api,
+    extract_json_string,
+    packed_max_tokens,
+    parse_semantic_frames,
+    request_completion,
+    shot_prefix_key,
+    warm_up,
+)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# openai/httpx 每个请求都会写一行 INFO log，常驻服务中只保留警告
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# --- 常驻 SLU 服务 ---
+# 车内场景一次只来一句话：system prompt / few-shot messages 与 OpenAI client 在启动时建立并预热，
+# 每个请求只需组出最后一则 user message。--max-batch-size > 1 时，短时间窗内到达的文本请求以 slu_icl.py
+# --pack-size 的打包提示词合成一个请求送出 (共用前缀只 prefill 一次)；音频请求与单条请求收到即送出。
+# audio_path 只接受 --audio-dir 之内的档案，服务预设只监听 127.0.0.1。
+#
+#   python slu_server.py serve --api-base http://127.0.0.1:12355/v1 --model-name Qwen2-Audio --n-shot 5 \
+#       --train-input-file train.jsonl --audio-dir audio/ --slo-ms 300
+#   curl -X POST localhost:8080/v1/slu -d '{"text": "打开空调"}'
+#   python slu_server.py loadtest --url http://127.0.0.1:8080 --input-file test_set.jsonl --concurrency 8
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # 预设 backlog 只有 5，并发连线一多就会被拒绝
+    request_queue_size = 256
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    pos = min(len(sorted_values) - 1, max(0, int(round(q * (len(sorted_values) - 1)))))
+    return sorted_values[pos]
+
+
+class LatencyTracker:
+    """
+    Sliding window of the last `window` request latencies (ms).
+    ``total`` is measured from request receipt to response; ``overhead`` is
+    ``total`` minus the time spent waiting for the model server.
+    """
+
+    def __init__(self, window: int = 10000, slo_ms: Optional[float] = None):
+        self.slo_ms = slo_ms
+        self._total = deque(maxlen=window)
+        self._overhead = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.errors = 0
+        self.slo_violations = 0
+
+    def record(self, total_ms: float, upstream_ms: float):
+        with self._lock:
+            self._total.append(total_ms)
+            self._overhead.append(max(0.0, total_ms - upstream_ms))
+            self.count += 1
+            if self.slo_ms is not None and total_ms > self.slo_ms:
+                self.slo_violations += 1
+
+    def record_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def p99(self) -> float:
+        with self._lock:
+            return _percentile(sorted(self._total), 0.99)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            total = sorted(self._total)
+            overhead = sorted(self._overhead)
+            stats = {
+                "count": self.count,
+                "errors": self.errors,
+                "p50_ms": round(_percentile(total, 0.50), 2),
+                "p99_ms": round(_percentile(total, 0.99), 2),
+                "overhead_p50_ms": round(_percentile(overhead, 0.50), 2),
+                "overhead_p99_ms": round(_percentile(overhead, 0.99), 2),
+            }
+            if self.slo_ms is not None:
+                stats["slo_ms"] = self.slo_ms
+                stats["slo_violations"] = self.slo_violations
+                stats["slo_met"] = stats["p99_ms"] <= self.slo_ms
+            return stats
+
+
+class MicroBatcher:
+    """
+    Groups text requests that arrive within `window_ms` (up to `max_batch`)
+    into one packed request via `batch_handler`, so the model server
+    prefills the shared few-shot prefix once per group instead of once per
+    request.
+
+    Requests that `can_batch` rejects (audio, stage 2) are dispatched to the
+    thread pool immediately, as is everything when `max_batch` is 1 or the
+    window is 0. While the tracked p99 exceeds the SLO the window is
+    halved, and it grows back to `window_ms` when p99 is under half the SLO.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[Dict[str, Any]], Dict[str, Any]],
+        batch_handler: Optional[Callable[[List[Dict[str, Any]]], List[Any]]] = None,
+        can_batch: Optional[Callable[[Dict[str, Any]], bool]] = None,
+        window_ms: float = 5.0,
+        max_batch: int = 16,
+        concurrency: int = 16,
+        tracker: Optional[LatencyTracker] = None,
+    ):
+        self.handler = handler
+        self.batch_handler = batch_handler
+        self.can_batch = can_batch or (lambda payload: True)
+        self.max_window_ms = window_ms
+        self.window_ms = window_ms
+        self.max_batch = max_batch
+        self.tracker = tracker
+        self._queue = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self.batches = 0
+        self.batched_items = 0
+        self._thread.start()
+
+    def submit(self, payload: Dict[str, Any]) -> Future:
+        future = Future()
+        if self.batch_handler is None or self.max_batch <= 1 or self.window_ms <= 0 or not self.can_batch(payload):
+            self._executor.submit(self._run, payload, future)
+        else:
+            self._queue.put((payload, future))
+        return future
+
+    def _run(self, payload: Dict[str, Any], future: Future):
+        try:
+            future.set_result(self.handler(payload))
+        except Exception as e:
+            future.set_exception(e)
+
+    def _run_batch(self, batch: List[Any]):
+        if len(batch) == 1:
+            self._run(*batch[0])
+            return
+        try:
+            results = self.batch_handler([payload for payload, _ in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _adapt_window(self):
+        if self.tracker is None or self.tracker.slo_ms is None or self.max_window_ms <= 0:
+            return
+        p99 = self.tracker.p99()
+        if p99 > self.tracker.slo_ms:
+            self.window_ms = self.window_ms / 2 if self.window_ms > 0.25 else 0.0
+        elif p99 < self.tracker.slo_ms / 2:
+            self.window_ms = min(self.max_window_ms, max(self.window_ms * 2, 0.25))
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                batch = [self._queue.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            deadline = time.perf_counter() + self.window_ms / 1000
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._executor.submit(self._run_batch, batch)
+            self.batches += 1
+            self.batched_items += len(batch)
+            if self.batches % 50 == 0:
+                self._adapt_window()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "batches": self.batches,
+            "mean_batch_size": round(self.batched_items / self.batches, 2) if self.batches else 0.0,
+            "window_ms": self.window_ms,
+        }
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self._executor.shutdown(wait=True)
+
+
+class SLUService:
+    """
+    In-process SLU pipeline with the prompt prefix built once at startup.
+    """
+
+    def __init__(self, args: argparse.Namespace, endpoint_urls: List[str]):
+        self.args = args
+        self.shot_list = build_shot_list(args)
+        if self.shot_list is None:
+            raise ValueError("无法建立 few-shot 示例，请检查 --n-shot / --train-input-file")
+        self.prefix_messages = build_prefix_messages(self.shot_list, "", args.audio_transport)
+        self.affinity_key = shot_prefix_key(self.shot_list, args.stage)
+        self.token_budget = build_token_budget(args) if args.dynamic_max_tokens else None
+        self.endpoint_pool = EndpointPool(
+            endpoint_urls, policy=args.lb_policy, max_failures=args.max_endpoint_failures,
+            affinity_slack=args.affinity_slack,
+        )
+        self.endpoint_pool.start_health_checks()
+        self.tracker = LatencyTracker(slo_ms=args.slo_ms)
+        self.audio_dir = Path(args.audio_dir).resolve() if args.audio_dir else None
+        # 打包请求数、整个失败的请求数、因输出缺少而逐条重送的条目数 (见 /stats)
+        self.pack_stats = {"requests": 0, "failed": 0, "fallback": 0}
+        self._pack_lock = threading.Lock()
+
+    def audio_path(self, payload: Dict[str, Any]) -> Optional[Path]:
+        """
+        把请求中的 audio_path 解析到 --audio-dir 之内；未设定 --audio-dir 或路径跳出该目录时拒绝，
+        避免客户端借服务读取机器上的任意档案。
+        """
+        if not payload.get("audio_path"):
+            return None
+        if self.audio_dir is None:
+            raise ValueError("audio_path 需要服务端以 --audio-dir 启动；或改传 audio_base64")
+        path = (self.audio_dir / str(payload["audio_path"])).resolve()
+        if not path.is_relative_to(self.audio_dir):
+            raise ValueError("audio_path 必须位于 --audio-dir 之内")
+        if not path.is_file():
+            raise ValueError(f"找不到音频: {payload['audio_path']}")
+        return path
+
+    def can_pack(self, payload: Dict[str, Any]) -> bool:
+        return self.args.stage == 1 and not payload.get("audio_path") and not payload.get("audio_base64") \
+            and bool(payload.get("text") or payload.get("query"))
+
+    def _query_message(self, payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        if payload.get("audio_base64"):
+            # 验证 base64，避免把错误的内容转给模型服务
+            base64.b64decode(payload["audio_base64"], validate=True)
+            return {
+                "role": "user",
+                "content": [{"type": "audio_url", "audio_url": {"url": f"data:audio/wav;base64,{payload['audio_base64']}"}}],
+            }
+        audio_path = self.audio_path(payload)
+        if audio_path is not None:
+            return build_query_message(audio_path, "", self.args.audio_transport)
+        return build_query_message("", payload.get("text") or payload.get("query") or "", self.args.audio_transport)
+
+    @timed("infer")
+    def infer(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        query_message = self._query_message(payload)
+        if query_message is None:
+            raise ValueError("需要 text、audio_path 或 audio_base64")
+
+        max_tokens = self.args.max_tokens
+        text = payload.get("text") or payload.get("query")
+        if self.token_budget is not None and text and not payload.get("audio_base64") and not payload.get("audio_path"):
+            max_tokens = self.token_budget.estimate(query=text)
+
+        upstream_start = time.perf_counter()
+        model_output_str = extract_json_string(request_completion(
+            api_base=self.endpoint_pool.endpoints[0].url,
+            model_name=self.args.model_name,
+            messages=self.prefix_messages + [query_message],
+            temperature=self.args.temperature,
+            max_tokens=max_tokens,
+            endpoint_pool=self.endpoint_pool,
+            affinity_key=self.affinity_key,
+            token_budget=self.token_budget,
+        ))
+        if self.args.stage == 2 and model_output_str:
+            # 第二阶段沿用第一阶段的 query message (audio_base64 / query 字段的请求无法由 payload 重建)
+            stage2_prefix = build_prefix_messages(self.shot_list, model_output_str, self.args.audio_transport)
+            model_output_str = extract_json_string(request_completion(
+                api_base=self.endpoint_pool.endpoints[0].url,
+                model_name=self.args.model_name,
+                messages=stage2_prefix + [query_message],
+                temperature=self.args.temperature,
+                max_tokens=max_tokens,
+                endpoint_pool=self.endpoint_pool,
+                token_budget=self.token_budget,
+            ))
+        upstream_ms = (time.perf_counter() - upstream_start) * 1000
+
+        semantics, _ = parse_semantic_frames(model_output_str or "")
+        return {"id": payload.get("id"), "semantics": semantics, "upstream_ms": round(upstream_ms, 2)}
+
+    @timed("infer_packed")
+    def infer_packed(self, payloads: List[Dict[str, Any]]) -> List[Any]:
+        """
+        一组文本请求合成一个打包请求；打包输出缺少的条目逐条以 infer() 重送。
+        回传与 payloads 对齐的结果，失败的条目为 Exception。
+        """
+        items = [(str(i), payload.get("text") or payload.get("query")) for i, payload in enumerate(payloads)]
+        max_tokens = packed_max_tokens(
+            [query for _, query in items], self.args.max_tokens, self.args.pack_max_tokens, self.token_budget,
+        )
+        upstream_start = time.perf_counter()
+        packed = call_packed_api(
+            model_name=self.args.model_name,
+            items=items,
+            temperature=self.args.temperature,
+            max_tokens=max_tokens,
+            prefix_messages=self.prefix_messages,
+            endpoint_pool=self.endpoint_pool,
+            affinity_key=self.affinity_key,
+        )
+        upstream_ms = round((time.perf_counter() - upstream_start) * 1000, 2)
+        with self._pack_lock:
+            self.pack_stats["requests"] += 1
+            if packed is None:
+                self.pack_stats["failed"] += 1
+            packed = packed or {}
+            self.pack_stats["fallback"] += sum(key not in packed for key, _ in items)
+        results = []
+        for (key, _), payload in zip(items, payloads):
+            if key in packed:
+                results.append({"id": payload.get("id"), "semantics": packed[key], "upstream_ms": upstream_ms})
+                continue
+            try:
+                results.append(self.infer(payload))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def close(self):
+        self.endpoint_pool.close()
+
+
+def make_handler(service: SLUService, batcher: MicroBatcher, request_timeout: float):
+    class SLURequestHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # header 与 body 分两次写出；不关闭 Nagle 时 keep-alive 连线每个回应会多等一次 delayed ACK (~40ms)
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+        def _send_json(self, obj: Dict[str, Any], code: int = 200):
+            body = dumps_bytes(obj)
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._send_json({"status": "ok"})
+            elif self.path == "/stats":
+                self._send_json({**service.tracker.snapshot(), **batcher.stats(), "pack": dict(service.pack_stats)})
+            else:
+                self._send_json({"error": "not found"}, 404)
+
+        def do_POST(self):
+            if self.path not in ("/v1/slu", "/slu"):
+                self._send_json({"error": "not found"}, 404)
+                return
+            start = time.perf_counter()
+            try:
+                payload = loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if not isinstance(payload, dict):
+                    raise ValueError("request body must be a JSON object")
+            except (ValueError, json.JSONDecodeError) as e:
+                self._send_json({"error": f"invalid request: {e}"}, 400)
+                return
+
+            try:
+                result = batcher.submit(payload).result(timeout=request_timeout)
+            except ValueError as e:
+                self._send_json({"error": str(e)}, 400)
+                return
+            except Exception as e:
+                service.tracker.record_error()
+                logging.error(f"SLU 请求失败: {e}")
+                self._send_json({"error": str(e)}, 502)
+                return
+
+            total_ms = (time.perf_counter() - start) * 1000
+            service.tracker.record(total_ms, result["upstream_ms"])
+            result["latency_ms"] = round(total_ms, 2)
+            self._send_json(result)
+
+    return SLURequestHandler
+
+
+def serve(args: argparse.Namespace):
+    endpoint_urls = parse_endpoints(args.api_base)
+    if args.ready_timeout > 0:
+        endpoint_urls = wait_until_ready(endpoint_urls, timeout=args.ready_timeout)
+        if not endpoint_urls:
+            logging.error("Error: 没有可用的端点。")
+            return
+    service = SLUService(args, endpoint_urls)
+    if args.warmup_requests > 0:
+        warm_up(args, endpoint_urls, service.shot_list, args.concurrency, prefix_messages=service.prefix_messages)
+
+    batcher = MicroBatcher(
+        service.infer,
+        batch_handler=service.infer_packed,
+        can_batch=service.can_pack,
+        window_ms=args.batch_window_ms,
+        max_batch=args.max_batch_size,
+        concurrency=args.concurrency,
+        tracker=service.tracker,
+    )
+    server = _HTTPServer((args.host, args.port), make_handler(service, batcher, args.request_timeout))
+    logging.info(f"SLU 服务启动: http://{args.host}:{args.port}/v1/slu (few-shot {len(service.shot_list)}, 端点 {endpoint_urls})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        service.close()
+        logging.info(f"延迟统计: {json.dumps(service.tracker.snapshot(), ensure_ascii=False)}")
+
+
+def load_test(args: argparse.Namespace):
+    """
+    以固定并发送出请求，回报客户端量测的 p50/p99 与服务端 /stats。
+    """
+    import urllib.error
+    import urllib.request
+
+    payloads = []
+    with open(args.input_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                data = loads(line)
+            except json.JSONDecodeError:
+                continue
+            if args.audio_dir:
+                # 相对于服务端 --audio-dir 的路径
+                payloads.append({"id": data.get("id"), "audio_path": f"id_{data.get('id')}.wav"})
+            else:
+                payloads.append({"id": data.get("id"), "text": data.get("query", "")})
+    if not payloads:
+        logging.error("Error: 输入文件没有可用的请求。")
+        return
+    payloads = [payloads[i % len(payloads)] for i in range(args.requests)]
+
+    url = args.url.rstrip("/") + "/v1/slu"
+
+    def send(payload):
+        request = urllib.request.Request(url, data=dumps_bytes(payload), headers={"Content-Type": "application/json"})
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=60) as resp:
+                resp.read()
+                ok = resp.status == 200
+        except (urllib.error.URLError, OSError):
+            ok = False
+        return ok, (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(send, payloads))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(ms for ok, ms in results if ok)
+    report = {
+        "requests": len(results),
+        "errors": sum(1 for ok, _ in results if not ok),
+        "throughput_rps": round(len(results) / elapsed, 2),
+        "client_p50_ms": round(_percentile(latencies, 0.50), 2),
+        "client_p99_ms": round(_percentile(latencies, 0.99), 2),
+    }
+    try:
+        with urllib.request.urlopen(args.url.rstrip("/") + "/stats", timeout=5) as resp:
+            report["server"] = loads(resp.read())
+    except (urllib.error.URLError, OSError, ValueError):
+        pass
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+def mock_model(args: argparse.Namespace):
+    """
+    最小的 OpenAI 相容 chat completions 服务：等待 --delay-ms 后回传 "[]"，用于量测客户端开销与压测。
+    """
+    class MockHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, obj, code=200):
+            body = json.dumps(obj).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._send_json({})
+            elif self.path.endswith("/models"):
+                self._send_json({"object": "list", "data": [{"id": "mock", "object": "model"}]})
+            else:
+                self._send_json({}, 404)
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            time.sleep(args.delay_ms / 1000)
+            self._send_json({
+                "id": "mock", "object": "chat.completion", "created": 0, "model": body.get("model", "mock"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "[]"}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 1, "total_tokens": 1},
+            })
+
+    server = _HTTPServer((args.host, args.port), MockHandler)
+    logging.info(f"Mock model server: http://{args.host}:{args.port}/v1 (delay {args.delay_ms} ms)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def setup_arg_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Low-latency MAC-SLU serving daemon")
+    add_profile_args(parser)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="Run the SLU HTTP service")
+    serve_parser.add_argument("--host", type=str, default="127.0.0.1",
+                              help="监听位址；对外提供服务时才改为 0.0.0.0 (请配合防火墙或反向代理)")
+    serve_parser.add_argument("--port", type=int, default=8080)
+    serve_parser.add_argument("--api-base", type=str, nargs="+", default=["http://0.0.0.0:12355/v1"],
+                              help="本地LLM服务的API基地址，可传入多个进行负载平衡")
+    serve_parser.add_argument("--lb-policy", type=str, default="least-outstanding", choices=EndpointPool.POLICIES)
+    serve_parser.add_argument("--affinity-slack", type=float, default=0.25,
+                              help="prefix-affinity 的负载容许量，以每台平均在途数的倍数表示 (见 slu_icl.py)")
+    serve_parser.add_argument("--max-endpoint-failures", type=int, default=3)
+    serve_parser.add_argument("--model-name", type=str, required=True)
+    serve_parser.add_argument("--temperature", type=float, default=0.0)
+    serve_parser.add_argument("--max-tokens", type=int, default=512)
+    serve_parser.add_argument("--dynamic-max-tokens", action="store_true",
+                              help="依文本长度与训练集统计估计每个请求的 max_tokens (见 slu_icl.py)")
+    serve_parser.add_argument("--n-shot", type=int, default=0)
+    serve_parser.add_argument("--train-input-file", type=str, default=None)
+    serve_parser.add_argument("--train-audio-dir", type=str, default=None)
+    serve_parser.add_argument("--seed", type=int, default=None, help="few-shot 示例的随机种子")
+    serve_parser.add_argument("--stage", type=int, default=1, choices=[1, 2])
+    serve_parser.add_argument("--audio-transport", type=str, default="base64", choices=AUDIO_TRANSPORTS)
+    serve_parser.add_argument("--audio-dir", type=str, default=None,
+                              help="audio_path 请求所在的目录；路径相对于此目录解析，跳出此目录的请求被拒绝。"
+                                   "未设定时只接受 text 与 audio_base64")
+    serve_parser.add_argument("--ready-timeout", type=float, default=600,
+                              help="启动时等待端点 /health 与 /models 就绪的秒数 (0 表示不等待)")
+    serve_parser.add_argument("--warmup-requests", type=int, default=3,
+                              help="启动时对每个端点送出共用前缀的次数，预热 prefix cache")
+    serve_parser.add_argument("--concurrency", type=int, default=32, help="同时送往模型服务的请求上限")
+    serve_parser.add_argument("--batch-window-ms", type=float, default=2.0,
+                              help="搭配 --max-batch-size > 1：收集文本请求的窗口 (毫秒)；0 表示收到即送出")
+    serve_parser.add_argument("--max-batch-size", type=int, default=1,
+                              help="窗口内最多几条文本请求合成一个打包请求 (slu_icl.py --pack-size 的提示词，只用于单阶段)；"
+                                   "1 表示不打包，每个请求收到即送出")
+    serve_parser.add_argument("--pack-max-tokens", type=int, default=2048,
+                              help="打包请求的 max_tokens 上限 (见 slu_icl.py --pack-max-tokens)")
+    serve_parser.add_argument("--slo-ms", type=float, default=None,
+                              help="p99 延迟目标 (毫秒)；超过时缩短 micro-batch 窗口，并在 /stats 回报是否达标")
+    serve_parser.add_argument("--request-timeout", type=float, default=30.0)
+
+    load_parser = subparsers.add_parser("loadtest", help="Load-test a running SLU service")
+    load_parser.add_argument("--url", type=str, default="http://127.0.0.1:8080")
+    load_parser.add_argument("--input-file", type=str, required=True, help="JSONL with id/query (text mode)")
+    load_parser.add_argument("--audio-dir", type=str, default=None,
+                             help="Send audio_path id_<id>.wav (relative to the server's --audio-dir) instead of text")
+    load_parser.add_argument("--requests", type=int, default=1000)
+    load_parser.add_argument("--concurrency", type=int, default=8)
+
+    mock_parser = subparsers.add_parser("mock-model", help="Run a minimal OpenAI-compatible mock model server")
+    mock_parser.add_argument("--host", type=str, default="127.0.0.1")
+    mock_parser.add_argument("--port", type=int, default=12355)
+    mock_parser.add_argument("--delay-ms", type=float, default=20.0, help="Simulated model latency")
+
+    return parser
+
+
+def main():
+    args = setup_arg_parser().parse_args()
+    with profile_session(args):
+        if args.command == "serve":
+            serve(args)
+        elif args.command == "loadtest":
+            load_test(args)
+        else:
+            mock_model(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+import argparse
+import csv
+import itertools
+import json
+import logging
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from importlib.util import find_spec
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from profiling import add_profile_args, session as profile_session
+import telemetry
+
+# --- 批次实验 (grid sweep) ---
+# 在同一个行程内依序 (或并行) 跑多组 slu_icl.py 配置：输入档、few-shot 示例 (含编码后的音频) 与标注只载入一次，
+# 测试音频的 base64 编码在配置之间共用；每组的输出直接交给 metrics 的 StreamingEvaluator 评分，最后汇整成一张表。
+#
+# 规格档 (JSON)：
+# {
+#   "base": {"input_file": "test.jsonl", "provider": "local", "api_base": ["http://0.0.0.0:12355/v1"],
+#            "train_input_file": "train.jsonl", "seed": 42},
+#   "grid": {"model_name": ["qwen2-audio"], "n_shot": [0, 5], "stage": [1, 2],
+#            "temperature": [0.0, 0.7], "audio_dir": [null, "audio/test"]},
+#   "label_file": "icl_label.jsonl"
+# }
+# base / grid 的键为 slu_icl.py 的参数名 (--n-shot 或 n_shot 皆可)。
+
+RESULT_COLUMNS = [
+    "overall_accuracy", "intent_accuracy", "slot_precision", "slot_recall", "slot_f1",
+    "total_count", "processed", "failed", "seconds",
+]
+
+
+def load_spec(path: str) -> Dict[str, Any]:
+    with open(path, 'r', encoding='utf-8') as f:
+        spec = json.load(f)
+    if not isinstance(spec.get("grid", {}), dict) or not isinstance(spec.get("base", {}), dict):
+        raise ValueError(f"{path}: 'base' and 'grid' must be JSON objects")
+    return spec
+
+
+def _dest(key: str) -> str:
+    return key.lstrip("-").replace("-", "_")
+
+
+def expand_grid(grid: Dict[str, List[Any]]) -> List[Dict[str, Any]]:
+    """
+    各参数取值的笛卡尔积，依规格中键的顺序展开；单一值视为只有一个取值的列表。
+    """
+    keys = [_dest(key) for key in grid]
+    values = [value if isinstance(value, list) else [value] for value in grid.values()]
+    return [dict(zip(keys, combo)) for combo in itertools.product(*values)]
+
+
+def config_name(index: int, point: Dict[str, Any]) -> str:
+    parts = [f"{key}-{Path(str(value)).name if value else value}" for key, value in point.items()]
+    return re.sub(r"[^\w.=-]+", "_", f"{index:03d}_" + "_".join(parts))
+
+
+def build_args(parser: argparse.ArgumentParser, settings: Dict[str, Any], output_file: Path) -> argparse.Namespace:
+    """
+    以 slu_icl.py 的参数解析器取得预设值，再套用 base + grid 的设定；未知的参数名视为错误。
+    """
+    if "input_file" not in settings:
+        raise ValueError("The sweep spec needs input_file in base or grid")
+    args = parser.parse_args(["--input-file", str(settings["input_file"]), "--output-file", str(output_file)])
+    for key, value in settings.items():
+        if not hasattr(args, key):
+            raise ValueError(f"Unknown slu_icl.py argument in sweep spec: {key}")
+        if key == "api_base" and isinstance(value, str):
+            value = [value]
+        setattr(args, key, value)
+    args.output_file = str(output_file)
+    return args
+
+
+class SharedState:
+    """
+    Inputs that several sweep configurations would otherwise each reload.
+
+    Input lines and ground truth are keyed by path. Few-shot lists are keyed
+    by the arguments that select them (n-shot, training files, seed), so
+    configurations that differ only in model, stage or temperature use the
+    very same examples. Safe to use from concurrently running
+    configurations; each key is loaded once.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key_locks: Dict[Tuple, threading.Lock] = {}
+        self._values: Dict[Tuple, Any] = {}
+        self.hits = 0
+        self.loads = 0
+
+    def _get(self, key: Tuple, load):
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key in self._values:
+                self.hits += 1
+                return self._values[key]
+            value = load()
+            self.loads += 1
+            self._values[key] = value
+            return value
+
+    def lines(self, path: str) -> List[str]:
+        def load():
+            with open(path, 'r', encoding='utf-8') as f:
+                return f.readlines()
+        return self._get(("lines", str(path)), load)
+
+    def shot_list(self, args: argparse.Namespace) -> Optional[List[Dict[str, Any]]]:
+        from slu_icl import build_shot_list
+
+        key = ("shots", args.n_shot, args.train_input_file, args.train_audio_dir, args.seed)
+        return self._get(key, lambda: build_shot_list(args))
+
+    def ground_truth(self, path: str) -> Dict[str, Any]:
+        from metrics import load_ground_truth
+
+        return self._get(("ground_truth", str(path)), lambda: load_ground_truth(path))
+
+
+def run_config(name: str, args: argparse.Namespace, state: SharedState, label_file: Optional[str]) -> Dict[str, Any]:
+    from slu_icl import process_file
+
+    logging.info(f"[{name}] 开始")
+    try:
+        lines = state.lines(args.input_file)
+    except FileNotFoundError:
+        return {"status": f"input not found: {args.input_file}"}
+    shot_list = state.shot_list(args)
+    if shot_list is None:
+        return {"status": "invalid few-shot settings"}
+    ground_truth = state.ground_truth(label_file) if label_file else None
+    summary = process_file(args, lines=lines, shot_list=shot_list, ground_truth=ground_truth)
+    if summary is None:
+        return {"status": "failed"}
+    row = {"status": "ok", "processed": summary["processed"], "failed": summary["failed"], "seconds": summary["seconds"]}
+    row.update(summary["metrics"] or {})
+    logging.info(f"[{name}] 完成: {row}")
+    return row
+
+
+def score_existing(output_file: Path, label_file: Optional[str]) -> Dict[str, Any]:
+    """--resume：已存在的输出不重跑，只重新评分。"""
+    row: Dict[str, Any] = {"status": "resumed"}
+    if label_file:
+        from metrics import calculate_metrics
+        row.update(calculate_metrics(str(output_file), label_file))
+    return row
+
+
+def write_results(rows: List[Dict[str, Any]], keys: List[str], output_dir: Path) -> Tuple[Path, Path]:
+    columns = ["config"] + keys + ["status"] + RESULT_COLUMNS + ["output_file"]
+    csv_file = output_dir / "results.csv"
+    with open(csv_file, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows)
+    json_file = output_dir / "results.json"
+    with open(json_file, 'w', encoding='utf-8') as f:
+        json.dump(rows, f, ensure_ascii=False, indent=2)
+    return csv_file, json_file
+
+
+def print_table(rows: List[Dict[str, Any]], keys: List[str]):
+    """依 overall_accuracy 由高到低印出结果表。"""
+    metric_columns = ["overall_accuracy", "intent_accuracy", "slot_f1", "seconds"]
+    header = keys + metric_columns + ["status"]
+    table = [[str(row.get(key, "")) for key in keys]
+             + [f"{row[col]:.4f}" if isinstance(row.get(col), float) else str(row.get(col, "")) for col in metric_columns]
+             + [row.get("status", "")]
+             for row in sorted(rows, key=lambda r: -(r.get("overall_accuracy") or 0.0))]
+    widths = [max(len(h), *(len(line[i]) for line in table)) for i, h in enumerate(header)] if table else [len(h) for h in header]
+    print("  ".join(h.ljust(w) for h, w in zip(header, widths)))
+    for line in table:
+        print("  ".join(cell.ljust(w) for cell, w in zip(line, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a grid of slu_icl.py configurations in one process and tabulate their metrics")
+    parser.add_argument("--spec", type=str, required=True, help="Sweep spec JSON with 'base', 'grid' and optionally 'label_file'")
+    parser.add_argument("--output-dir", type=str, required=True,
+                        help="One prediction JSONL per configuration, plus results.csv / results.json")
+    parser.add_argument("--label-file", type=str, default=None,
+                        help="Ground truth JSONL for scoring (overrides label_file in the spec)")
+    parser.add_argument("--parallel-configs", type=int, default=1,
+                        help="Configurations run at the same time; each still uses its own --concurrency against the endpoints")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip configurations whose output file already exists and only score it")
+    parser.add_argument("--no-audio-cache", action="store_true",
+                        help="Do not keep base64-encoded test audio in memory between configurations")
+    parser.add_argument("--dry-run", action="store_true", help="List the configurations and exit")
+    add_profile_args(parser)
+    telemetry.add_metrics_args(parser)
+    args = parser.parse_args()
+
+    spec = load_spec(args.spec)
+    base = {_dest(key): value for key, value in spec.get("base", {}).items()}
+    points = expand_grid(spec.get("grid", {}))
+    keys = list(points[0]) if points else []
+    label_file = args.label_file or spec.get("label_file")
+    output_dir = Path(args.output_dir)
+
+    import slu_icl
+
+    icl_parser = slu_icl.setup_arg_parser()
+    configs = []
+    for index, point in enumerate(points):
+        name = config_name(index, point)
+        configs.append((name, point, build_args(icl_parser, {**base, **point}, output_dir / f"{name}.jsonl")))
+
+    if args.dry_run:
+        for name, _, config_args in configs:
+            print(f"{name}: {config_args.output_file}")
+        return
+
+    if any(config_args.provider == "local" for _, _, config_args in configs) and find_spec("openai") is None:
+        logging.error("错误: 要使用 'local' 提供商, 请先安装 openai 库: pip install openai")
+        return
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if not args.no_audio_cache:
+        slu_icl.enable_audio_cache()
+
+    state = SharedState()
+    rows: List[Optional[Dict[str, Any]]] = [None] * len(configs)
+
+    def run(i: int):
+        name, point, config_args = configs[i]
+        output_file = Path(config_args.output_file)
+        if args.resume and output_file.exists():
+            row = score_existing(output_file, label_file)
+        else:
+            try:
+                row = run_config(name, config_args, state, label_file)
+            except Exception as e:
+                logging.error(f"[{name}] 执行失败: {e}", exc_info=True)
+                row = {"status": f"error: {e}"}
+        rows[i] = {"config": name, **point, **row, "output_file": str(output_file)}
+
+    with profile_session(args), telemetry.session(args, "sweep"):
+        with ThreadPoolExecutor(max_workers=max(1, args.parallel_configs)) as executor:
+            list(executor.map(run, range(len(configs))))
+
+    logging.info(f"共用状态: 载入 {state.loads} 次, 重复使用 {state.hits} 次")
+    csv_file, json_file = write_results(rows, keys, output_dir)
+    print_table(rows, keys)
+    logging.info(f"结果表已保存到 {csv_file} 与 {json_file}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
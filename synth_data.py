@@ -0,0 +1,163 @@
+import argparse
+import json
+import logging
+import random
+import re
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from jsonl_io import JsonlWriter
+
+# --- 合成 MAC-SLU 资料 ---
+# 依 slu_icl.py 提示词中的本体 (领域/意图列表、各领域的槽位与示例值) 产生形状贴近真实资料的记录，
+# 供 benchmark.py 在 10^3 到 10^7 的规模下量测。全部以 generator 逐笔产生，写档时记忆体固定。
+
+_EXAMPLES_RE = re.compile(r'例如(.+?)。?$')
+_FILLER = ["帮我", "请", "我想", "麻烦", "", "", ""]
+
+
+def load_ontology() -> Dict[str, Any]:
+    """
+    从 slu_icl.DOMAIN_INTENT_LIST / SLOT_LIST 解析出
+    {"intents": {领域: [意图...]}, "slots": {领域: {槽位: [示例值...]}}}。
+    """
+    from slu_icl import DOMAIN_INTENT_LIST, SLOT_LIST
+
+    intents: Dict[str, List[str]] = {}
+    domain = None
+    for line in DOMAIN_INTENT_LIST.splitlines():
+        if not line.strip().startswith("- "):
+            continue
+        name = line.strip()[2:].strip()
+        if line.startswith("- "):
+            domain = name
+            intents.setdefault(domain, [])
+        elif domain is not None and name not in intents[domain]:
+            intents[domain].append(name)
+
+    slots: Dict[str, Dict[str, List[str]]] = {}
+    for line in SLOT_LIST.splitlines():
+        if not line.startswith("- ") or ":" not in line:
+            continue
+        key, description = line[2:].split(":", 1)
+        slot_domain, _, slot_name = key.partition("-")
+        match = _EXAMPLES_RE.search(description.strip())
+        examples = [v.strip().strip('"“”') for v in match.group(1).split("、")] if match else []
+        slots.setdefault(slot_domain, {})[slot_name] = [v for v in examples if v] or [slot_name]
+
+    return {"intents": {d: i for d, i in intents.items() if i}, "slots": slots}
+
+
+class RecordGenerator:
+    """
+    Deterministic generator of synthetic labelled MAC-SLU records.
+
+    Each record has 1-3 frames (weighted towards one). Each frame draws a
+    domain and intent from the ontology and 1-4 slots with example values
+    from that domain. The query joins a filler word and the slot values, so
+    its length and character set follow the real data. ``prediction()``
+    derives an imperfect model output from a label.
+    """
+
+    def __init__(self, seed: int = 0, ontology: Optional[Dict[str, Any]] = None):
+        self.rng = random.Random(seed)
+        self.ontology = ontology or load_ontology()
+        self.domains = sorted(self.ontology["intents"])
+        # 预先排序好各领域的槽位名，避免每个语义帧重复排序
+        self.slot_names = {d: sorted(self.ontology["slots"].get(d, {})) for d in self.domains}
+
+    def frame(self) -> Dict[str, Any]:
+        rng = self.rng
+        domain = rng.choice(self.domains)
+        intent = rng.choice(self.ontology["intents"][domain])
+        domain_slots = self.ontology["slots"].get(domain, {})
+        slot_names = self.slot_names[domain]
+        names = rng.sample(slot_names, min(len(slot_names), rng.randint(1, 4))) if slot_names else []
+        return {"domain": domain, "intent": intent, "slots": {name: rng.choice(domain_slots[name]) for name in names}}
+
+    def record(self, item_id: int) -> Dict[str, Any]:
+        frames = [self.frame() for _ in range(self.rng.choices([1, 2, 3], weights=[80, 17, 3])[0])]
+        query = self.rng.choice(_FILLER) + "".join(v for f in frames for v in f["slots"].values())
+        return {"id": str(item_id), "query": query, "semantics": frames}
+
+    def records(self, n: int, start: int = 1) -> Iterator[Dict[str, Any]]:
+        for item_id in range(start, start + n):
+            yield self.record(item_id)
+
+    def prediction(self, record: Dict[str, Any], error_rate: float = 0.2) -> Dict[str, Any]:
+        """
+        以 error_rate 的机率改错一个槽位值、漏掉一个语义帧或多出一个语义帧。
+        """
+        frames = [dict(f, slots=dict(f["slots"])) for f in record["semantics"]]
+        if self.rng.random() < error_rate:
+            kind = self.rng.randrange(3)
+            if kind == 0 and frames[0]["slots"]:
+                frames[0]["slots"][self.rng.choice(list(frames[0]["slots"]))] = "错误值"
+            elif kind == 1 and len(frames) > 1:
+                frames.pop()
+            else:
+                frames.append(self.frame())
+        return {"id": record["id"], "query": record["query"], "semantics": frames}
+
+
+def to_raw_semantics(frames: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    标准语义帧 -> 原始训练集格式 ({"意图1": {领域: [{"name", "value"}, ...]}})，
+    即 transform_semantics_to_standard 的输入。
+    """
+    raw = {}
+    for i, frame in enumerate(frames, 1):
+        items = [{"name": name, "value": value} for name, value in frame["slots"].items()]
+        items.append({"value": frame["intent"], "name": "intent"})
+        raw[f"意图{i}"] = {frame["domain"]: items}
+    return raw
+
+
+def to_model_output(frames: List[Dict[str, Any]], rng: random.Random) -> str:
+    """
+    模拟模型输出：部分带 <think> 区块或 ```json 围栏，即 extract_json_string 要处理的文字。
+    """
+    body = json.dumps(frames, ensure_ascii=False)
+    style = rng.randrange(3)
+    if style == 0:
+        return body
+    if style == 1:
+        return f"```json\n{body}\n```"
+    return f"<think>用户的请求包含 {len(frames)} 个意图。</think>\n{body}"
+
+
+def write_dataset(output_dir: str, n: int, seed: int = 0, error_rate: float = 0.2) -> Dict[str, str]:
+    """
+    写出 labels.jsonl (标准格式)、predictions.jsonl 与 train.jsonl (原始格式)，回传各档案路径。
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    paths = {name: str(output_dir / f"{name}.jsonl") for name in ["labels", "predictions", "train"]}
+    generator = RecordGenerator(seed)
+    with JsonlWriter(paths["labels"]) as f_labels, \
+            JsonlWriter(paths["predictions"]) as f_pred, \
+            JsonlWriter(paths["train"]) as f_train:
+        for record in generator.records(n):
+            f_labels.write(record)
+            f_pred.write(generator.prediction(record, error_rate))
+            f_train.write({"id": record["id"], "query": record["query"], "semantics": to_raw_semantics(record["semantics"])})
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic MAC-SLU records from the prompt ontology")
+    parser.add_argument("--output-dir", type=str, required=True,
+                        help="Writes labels.jsonl, predictions.jsonl and train.jsonl here")
+    parser.add_argument("-n", "--num-records", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--error-rate", type=float, default=0.2,
+                        help="Fraction of predictions that differ from the label")
+    args = parser.parse_args()
+
+    paths = write_dataset(args.output_dir, args.num_records, seed=args.seed, error_rate=args.error_rate)
+    logging.info(f"Wrote {args.num_records} records: {', '.join(paths.values())}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
@@ -0,0 +1,361 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+# --- 长时间推理的即时指标 ---
+# slu_icl.py / asr_icl.py 以 --metrics-port 开启 Prometheus 文字格式的 /metrics 端点，或以 --metrics-file
+# 定期写出统计档 (.prom 为 Prometheus 文字格式，可给 node_exporter 的 textfile collector；其余为 JSON)。
+# 未启用时 request() 等 hook 回传共用的空物件，请求路径上只多一次函数呼叫。
+
+# 请求延迟直方图的上界 (秒)；LLM 请求从数十毫秒到数十秒都有
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+RATE_WINDOW_S = 60.0
+
+_active: Optional["JobMetrics"] = None
+
+
+class _NullRequest:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_REQUEST = _NullRequest()
+
+
+class _RequestTimer:
+    __slots__ = ("metrics", "start")
+
+    def __init__(self, metrics: "JobMetrics"):
+        self.metrics = metrics
+
+    def __enter__(self):
+        self.metrics.request_started()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.request_finished(time.perf_counter() - self.start, error_kind(exc) if exc is not None else None)
+        return False
+
+
+def error_kind(exc: BaseException) -> str:
+    """HTTP 错误以状态码分类 (如 "http_503")，其余以例外类别名称分类 (如 "APITimeoutError")。"""
+    status = getattr(exc, "status_code", None)
+    return f"http_{status}" if status is not None else type(exc).__name__
+
+
+class Histogram:
+    """Fixed-bucket histogram; the last bucket is +Inf."""
+
+    def __init__(self, bounds: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """在落点所在的分桶内线性内插；落在 +Inf 分桶时回传最大的有限上界。"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                if i == len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[i - 1] if i else 0.0
+                return lower + (self.bounds[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+
+class JobMetrics:
+    """
+    Thread-safe counters, gauges and a latency histogram for one run.
+
+    Request hooks take one lock and do a few integer updates; everything
+    derived (rates, quantiles, text formats) is computed when a snapshot is
+    taken. ``tick()`` keeps a short history of cumulative counts so that
+    snapshots can report rates over the last `RATE_WINDOW_S` seconds in
+    addition to the whole-run average.
+    """
+
+    def __init__(self, script: str):
+        self.script = script
+        self.started_at = time.time()
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.requests = 0
+        self.errors: Dict[str, int] = {}
+        self.latency = Histogram()
+        self.tokens = {"prompt": 0, "completion": 0}
+        self.items: Dict[str, int] = {}
+        self.counters: Dict[str, int] = {}
+        self._history = deque()
+
+    # --- hooks ---
+    def request_started(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def request_finished(self, seconds: float, error: Optional[str] = None):
+        with self._lock:
+            self.in_flight -= 1
+            self.requests += 1
+            self.latency.observe(seconds)
+            if error is not None:
+                self.errors[error] = self.errors.get(error, 0) + 1
+
+    def add_tokens(self, prompt: int, completion: int):
+        with self._lock:
+            self.tokens["prompt"] += prompt
+            self.tokens["completion"] += completion
+
+    def item_done(self, outcome: str):
+        with self._lock:
+            self.items[outcome] = self.items.get(outcome, 0) + 1
+
+    def count(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    # --- snapshots ---
+    def _totals(self) -> Tuple[float, int, int, int]:
+        return time.monotonic(), sum(self.items.values()), self.requests, self.tokens["completion"]
+
+    def tick(self):
+        with self._lock:
+            sample = self._totals()
+            self._history.append(sample)
+            while len(self._history) > 2 and sample[0] - self._history[1][0] >= RATE_WINDOW_S:
+                self._history.popleft()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            now, items, requests, completion_tokens = self._totals()
+            oldest = self._history[0] if self._history else None
+            snap = {
+                "script": self.script,
+                "started_at": self.started_at,
+                "updated_at": time.time(),
+                "uptime_s": round(now - self._start, 3),
+                "requests": {"in_flight": self.in_flight, "completed": requests,
+                             "errors": sum(self.errors.values()), "errors_by_kind": dict(self.errors)},
+                "items": dict(self.items),
+                "tokens": dict(self.tokens),
+                "counters": dict(self.counters),
+                "latency_s": {
+                    "mean": round(self.latency.sum / self.latency.count, 4) if self.latency.count else 0.0,
+                    **{f"p{int(q * 100)}": round(self.latency.quantile(q), 4) for q in (0.5, 0.9, 0.99)},
+                    "buckets": {str(le): count for le, count in zip(list(self.latency.bounds) + ["+Inf"], self.latency.counts)},
+                },
+            }
+        uptime = max(now - self._start, 1e-9)
+        rates = {
+            "items_per_s": round(items / uptime, 3),
+            "requests_per_s": round(requests / uptime, 3),
+            "completion_tokens_per_s": round(completion_tokens / uptime, 3),
+        }
+        if oldest is not None:
+            then, items0, requests0, tokens0 = oldest
+            elapsed = now - then
+            if elapsed > 0:
+                rates.update({
+                    "items_per_s_recent": round((items - items0) / elapsed, 3),
+                    "requests_per_s_recent": round((requests - requests0) / elapsed, 3),
+                    "completion_tokens_per_s_recent": round((completion_tokens - tokens0) / elapsed, 3),
+                })
+        snap["rates"] = rates
+        return snap
+
+    def prometheus_text(self) -> str:
+        """Prometheus 文字格式 (0.0.4)；速率交给 PromQL 的 rate() 计算。"""
+        label = f'script="{self.script}"'
+        lines: List[str] = []
+
+        def metric(name: str, kind: str, help_text: str, samples: List[Tuple[str, float]]):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{{{label}{labels}}} {value}")
+
+        with self._lock:
+            metric("slu_job_start_time_seconds", "gauge", "Unix time the run started.", [("", self.started_at)])
+            metric("slu_requests_in_flight", "gauge", "Model requests currently in flight.", [("", self.in_flight)])
+            metric("slu_requests_total", "counter", "Model requests finished (successful or not).", [("", self.requests)])
+            metric("slu_request_errors_total", "counter", "Failed model requests by HTTP status or exception type.",
+                   [(f',kind="{kind}"', count) for kind, count in sorted(self.errors.items())])
+            metric("slu_tokens_total", "counter", "Tokens reported in API usage.",
+                   [(f',type="{kind}"', count) for kind, count in self.tokens.items()])
+            metric("slu_items_total", "counter", "Input items written, by outcome.",
+                   [(f',outcome="{outcome}"', count) for outcome, count in sorted(self.items.items())])
+            for name, count in sorted(self.counters.items()):
+                metric(f"slu_{name}_total", "counter", f"Count of {name.replace('_', ' ')}.", [("", count)])
+
+            name = "slu_request_duration_seconds"
+            lines.append(f"# HELP {name} Model request latency.")
+            lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for le, count in zip(list(self.latency.bounds) + ["+Inf"], self.latency.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{label},le="{le}"}} {cumulative}')
+            lines.append(f"{name}_sum{{{label}}} {self.latency.sum}")
+            lines.append(f"{name}_count{{{label}}} {self.latency.count}")
+        return "\n".join(lines) + "\n"
+
+
+# --- hooks (未启用时不做任何事) ---
+def request():
+    """`with request():` 包住一次模型请求：计入在途数、延迟直方图与错误种类。"""
+    metrics = _active
+    if metrics is None:
+        return _NULL_REQUEST
+    return _RequestTimer(metrics)
+
+
+def add_usage(usage: Any):
+    """计入 API 回传的 usage (prompt_tokens / completion_tokens)；服务端未回传时略过。"""
+    metrics = _active
+    if metrics is None or usage is None:
+        return
+    metrics.add_tokens(getattr(usage, "prompt_tokens", 0) or 0, getattr(usage, "completion_tokens", 0) or 0)
+
+
+def item_done(outcome: str):
+    metrics = _active
+    if metrics is not None:
+        metrics.item_done(outcome)
+
+
+def count(name: str, value: int = 1):
+    metrics = _active
+    if metrics is not None:
+        metrics.count(name, value)
+
+
+# --- exporters ---
+def add_metrics_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="在此端口提供 Prometheus 文字格式的 /metrics (以及 JSON 的 /stats)，供监控面板抓取"
+    )
+    parser.add_argument(
+        "--metrics-host",
+        type=str,
+        default="127.0.0.1",
+        help="--metrics-port 绑定的位址；预设只接受本机连线，需让远端 Prometheus 抓取时设为 0.0.0.0"
+    )
+    parser.add_argument(
+        "--metrics-file",
+        type=str,
+        default=None,
+        help="每 --metrics-interval 秒覆写一次的统计档；.prom 结尾写 Prometheus 文字格式 (textfile collector)，否则写 JSON"
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=10.0,
+        help="--metrics-file 的更新间隔 (秒)，也是计算近期速率的取样间隔"
+    )
+
+
+def write_metrics_file(metrics: JobMetrics, path: str):
+    # 先写暂存档再改名，读取端不会读到写到一半的档案
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        if path.endswith(".prom"):
+            f.write(metrics.prometheus_text())
+        else:
+            json.dump(metrics.snapshot(), f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _start_http_server(metrics: JobMetrics, host: str, port: int):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+        def do_GET(self):
+            if self.path.split("?")[0] == "/metrics":
+                body, content_type = metrics.prometheus_text().encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8"
+            elif self.path.split("?")[0] == "/stats":
+                body, content_type = json.dumps(metrics.snapshot(), ensure_ascii=False).encode("utf-8"), "application/json; charset=utf-8"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logging.info(f"即时指标: http://{host}:{port}/metrics")
+    return server
+
+
+@contextmanager
+def session(args: argparse.Namespace, script: str):
+    """
+    依 --metrics-port / --metrics-file 启用指标收集与输出；两者皆未指定时不做任何事。
+    """
+    global _active
+    port, path = getattr(args, "metrics_port", None), getattr(args, "metrics_file", None)
+    if port is None and not path:
+        yield None
+        return
+
+    metrics = JobMetrics(script)
+    metrics.tick()
+    server = None
+    if port is not None:
+        server = _start_http_server(metrics, getattr(args, "metrics_host", "127.0.0.1"), port)
+    stop = threading.Event()
+
+    def ticker():
+        while not stop.wait(args.metrics_interval):
+            metrics.tick()
+            if path:
+                try:
+                    write_metrics_file(metrics, path)
+                except OSError as e:
+                    logging.warning(f"写出指标档失败: {e}")
+
+    thread = threading.Thread(target=ticker, name="metrics-ticker", daemon=True)
+    thread.start()
+    _active = metrics
+    try:
+        yield metrics
+    finally:
+        _active = None
+        stop.set()
+        thread.join()
+        if path:
+            write_metrics_file(metrics, path)
+        if server is not None:
+            server.shutdown()
+            server.server_close()
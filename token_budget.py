@@ -0,0 +1,145 @@
+import json
+import logging
+import math
+import threading
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# --- 动态 max_tokens ---
+# 依输入长度、预测的意图数量与训练集学到的语义帧大小，为每个请求估计生成预算。
+# vLLM 依 max_tokens 预留调度容量；预算越贴近实际输出，同时能排进同一批的请求就越多。
+
+
+def _quantile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    pos = min(len(values) - 1, max(0, math.ceil(q * len(values)) - 1))
+    return values[pos]
+
+
+class TokenBudget:
+    """
+    Per-request max_tokens estimator.
+
+    ``fit()`` learns from training (query, frames) pairs:
+    - the number of frames per query, as a high quantile per query-length bucket
+      (a cheap predictor of how many intents an utterance carries);
+    - the fixed serialized size of one frame (domain, intent, keys, punctuation);
+    - how many characters of slot values are emitted per query character.
+
+    ``estimate()`` combines them into a budget clamped to ``[min_tokens, max_tokens]``.
+    When an output is still truncated, ``escalate()`` returns a doubled budget
+    (up to ``max_tokens``) for a single retry.
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = 512,
+        min_tokens: int = 32,
+        quantile: float = 0.95,
+        tokens_per_char: float = 1.0,
+        safety: float = 1.2,
+        bucket_chars: int = 5,
+    ):
+        self.max_tokens = max_tokens
+        self.min_tokens = min_tokens
+        self.quantile = quantile
+        self.tokens_per_char = tokens_per_char
+        self.safety = safety
+        self.bucket_chars = bucket_chars
+
+        # 没有训练数据时的保守预设值
+        self.frames_by_bucket: Dict[int, float] = {}
+        self.default_frames = 2.0
+        self.frame_fixed_chars = 80.0
+        self.value_chars_per_query_char = 1.0
+        self.chars_per_second = 5.0
+
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.budget_total = 0
+        self.retries = 0
+
+    def fit(self, samples: Iterable[Tuple[str, List[Dict[str, Any]]]], durations: Optional[Dict[str, float]] = None):
+        """
+        samples: (query, standard frames) 对；durations: 可选的 {query: 音频秒数}，用于学习语速。
+        """
+        frames_by_bucket = defaultdict(list)
+        all_frames, fixed_sizes, value_ratios, speech_rates = [], [], [], []
+        for query, frames in samples:
+            query = query or ""
+            n_frames = len(frames)
+            frames_by_bucket[len(query) // self.bucket_chars].append(n_frames)
+            all_frames.append(n_frames)
+
+            value_chars = 0
+            for frame in frames:
+                slots = frame.get("slots", {})
+                frame_value_chars = sum(len(str(v)) for v in slots.values()) if isinstance(slots, dict) else 0
+                value_chars += frame_value_chars
+                fixed_sizes.append(len(json.dumps(frame, ensure_ascii=False)) - frame_value_chars)
+            if query:
+                value_ratios.append(value_chars / len(query))
+            if durations and durations.get(query):
+                speech_rates.append(len(query) / durations[query])
+
+        if not all_frames:
+            logging.warning("TokenBudget.fit: 没有可用的训练样本，使用预设统计值。")
+            return self
+
+        self.frames_by_bucket = {b: _quantile(v, self.quantile) for b, v in frames_by_bucket.items() if len(v) >= 20}
+        self.default_frames = max(1.0, _quantile(all_frames, self.quantile))
+        if fixed_sizes:
+            self.frame_fixed_chars = _quantile(fixed_sizes, self.quantile)
+        if value_ratios:
+            self.value_chars_per_query_char = _quantile(value_ratios, self.quantile)
+        if speech_rates:
+            self.chars_per_second = _quantile(speech_rates, self.quantile)
+        logging.info(
+            f"TokenBudget: {len(all_frames)} 条训练样本, 每帧固定长度 p{int(self.quantile * 100)}="
+            f"{self.frame_fixed_chars:.0f} 字符, 槽位值/查询长度={self.value_chars_per_query_char:.2f}, "
+            f"预设意图数={self.default_frames:.0f}"
+        )
+        return self
+
+    def predict_frames(self, query_chars: int) -> float:
+        return max(1.0, self.frames_by_bucket.get(query_chars // self.bucket_chars, self.default_frames))
+
+    def estimate(self, query: Optional[str] = None, audio_seconds: Optional[float] = None) -> int:
+        """
+        文本模式使用查询长度；音频模式以时长 × 学到的语速估算查询长度。
+        """
+        if query:
+            query_chars = len(query)
+        elif audio_seconds:
+            query_chars = int(math.ceil(audio_seconds * self.chars_per_second))
+        else:
+            return self.max_tokens
+
+        n_frames = self.predict_frames(query_chars)
+        chars = 2 + n_frames * (self.frame_fixed_chars + 2) + query_chars * self.value_chars_per_query_char
+        budget = int(math.ceil(chars * self.tokens_per_char * self.safety))
+        budget = max(self.min_tokens, min(self.max_tokens, budget))
+        with self._lock:
+            self.requests += 1
+            self.budget_total += budget
+        return budget
+
+    def escalate(self, current: int) -> Optional[int]:
+        """
+        输出被截断时返回下一次重试的预算；已达上限时返回 None。
+        """
+        if current >= self.max_tokens:
+            return None
+        with self._lock:
+            self.retries += 1
+        return min(self.max_tokens, current * 2)
+
+    def summary(self) -> str:
+        with self._lock:
+            mean = self.budget_total / self.requests if self.requests else 0.0
+            return (
+                f"平均 max_tokens {mean:.0f} (上限 {self.max_tokens}), "
+                f"请求 {self.requests}, 因截断重试 {self.retries}"
+            )
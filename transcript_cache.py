@@ -0,0 +1,85 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+# --- ASR 转写缓存 ---
+# 以音频内容哈希 + ASR 模型 + temperature + language 为 key，存放在单一 SQLite 文件中。
+# 同一段音频出现在不同 split、或只改了下游 SLU prompt 时，重跑不需要再次调用 ASR。
+
+
+def audio_content_hash(audio_data: bytes) -> str:
+    return hashlib.blake2b(audio_data, digest_size=16).hexdigest()
+
+
+class TranscriptCache:
+    """
+    Thread-safe transcript cache backed by a local SQLite key-value table.
+
+    Keys are derived from the audio *content*, not its path, so renamed or
+    duplicated files still hit. Writes are committed every `commit_every`
+    inserts, at least every `commit_interval` seconds, and on ``close()``.
+    """
+
+    def __init__(self, path: str, commit_every: int = 100, commit_interval: float = 5.0):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS transcripts (key TEXT PRIMARY KEY, text TEXT NOT NULL)")
+        self._conn.commit()
+        self._uncommitted = 0
+        self._last_commit = time.monotonic()
+        self._closed = False
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(content_hash: str, model_name: str, temperature: float, language: str) -> str:
+        return f"{content_hash}|{model_name}|{float(temperature)}|{language}"
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            if self._closed:
+                return None
+            row = self._conn.execute("SELECT text FROM transcripts WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, text: str):
+        with self._lock:
+            # 中断后仍在途的请求可能在 close() 之后才回来
+            if self._closed:
+                return
+            self._conn.execute("INSERT OR REPLACE INTO transcripts (key, text) VALUES (?, ?)", (key, text))
+            self._uncommitted += 1
+            now = time.monotonic()
+            if self._uncommitted >= self.commit_every or now - self._last_commit >= self.commit_interval:
+                self._conn.commit()
+                self._uncommitted = 0
+                self._last_commit = now
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM transcripts").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._conn.commit()
+            self._conn.close()
+            self._closed = True
+
+    def summary(self) -> str:
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        return f"命中 {self.hits}, 未命中 {self.misses} (命中率 {rate:.1%}), 缓存文件 {self.path}"